@@ -0,0 +1,463 @@
+import json
+import random
+import time
+import argparse
+import os
+import sqlite3
+import tempfile
+import platform
+from datetime import datetime as dt, timedelta
+
+import numpy as np
+import pandas as pd
+
+import chargingmodel.preprocessing as preprocessing
+import chargingmodel.optimize as optimize
+import chargingmodel.postprocessing as postprocessing
+import chargingmodel.uncontrolled as uncontrolled
+import chargingmodel.tools as tools
+
+grb = optimize.grb # None if Gurobi is not installed -> only the benchmarks suite, output and postprocessing run
+
+# Reference: Scalar construction of the per-agent model (one addVar/addLConstr per element).
+# Same model as optimize.setAgentConstr() and the objective of optimize.solveAgentGurobi().
+def buildScalar(*, model, agent, events, slack, mxEbatEnd, eBatStart, etaTimesDelta, eBatGoal, residualLoad):
+    eBatPre, pCharge, eBatPost = {}, {}, {}
+    eBatPre[0] = eBatStart
+    for eventIdx, event in enumerate(events):
+        for t in range(event.start, event.stop):
+            pCharge[t] = model.addVar(ub=event.pMax)
+        eBatPre[eventIdx + 1] = model.addVar(ub=agent.capacity)
+        eBatPost[eventIdx] = model.addVar(ub=agent.capacity)
+        model.addLConstr(lhs=grb.quicksum(pCharge[t] for t in range(event.start, event.stop)) * etaTimesDelta + eBatPre[eventIdx],
+                         sense=grb.GRB.EQUAL,
+                         rhs=eBatPost[eventIdx])
+        model.addLConstr(lhs=eBatPost[eventIdx] - event.consumption + slack[eventIdx],
+                         sense=grb.GRB.EQUAL,
+                         rhs=eBatPre[eventIdx + 1])
+    model.addLConstr(lhs=min(mxEbatEnd, eBatGoal), sense=grb.GRB.LESS_EQUAL, rhs=eBatPre[len(events)])
+
+    objective = grb.QuadExpr()
+    for event in events:
+        for t in range(event.start, event.stop):
+            objective.addTerms(2 * residualLoad[t], pCharge[t])
+    objective.add(grb.quicksum(pCharge[t]*pCharge[t] for t in pCharge))
+    model.ModelSense = grb.GRB.MINIMIZE
+    model.setObjective(objective)
+
+# Matrix API construction as used by optimize.solveAgentGurobi()
+def buildMatrix(*, model, agent, events, slack, mxEbatEnd, eBatStart, etaTimesDelta, eBatGoal, residualLoad):
+    ts, pCharge, _ = optimize.setAgentConstr(model=model, agent=agent, events=events, slack=slack,
+                                             mxEbatEnd=mxEbatEnd, eBatStart=eBatStart, etaTimesDelta=etaTimesDelta,
+                                             eBatGoal=eBatGoal)
+    model.setMObjective(Q=optimize.sparse.identity(len(ts)), c=2 * residualLoad[ts], constant=0.0,
+                        xQ_L=pCharge, xQ_R=pCharge, xc=pCharge, sense=grb.GRB.MINIMIZE)
+
+builders = {"scalar": buildScalar, "matrix": buildMatrix}
+
+# Time the model construction (without solving) of every agent of the bundled inputs.
+# Full-year horizon, i.e. one model per agent.
+def benchmarkBuild(*, scenario="Realistic", nAgents=None, verbose=True):
+    dirname = os.path.dirname(__file__)
+    with open(os.path.join(dirname, 'config.json')) as f:
+        config = json.load(f)
+    regionIDs = pd.read_csv(os.path.join(dirname, "input/regions.csv"), sep=";")["ID"].astype(str).values
+    resolution = config["resolution"]
+    agents = preprocessing.Fleet.concat([preprocessing.getFleet(scenario, config, regionID, resolution=resolution)
+                                         for regionID in regionIDs])
+    if nAgents is not None:
+        agents = agents[:nAgents]
+    residualLoad = np.asarray(preprocessing.getResidual("all", resolution=resolution), dtype=float)
+    etaTimesDelta = config["chargingEfficiency"] * tools.getDeltaT(resolution)
+
+    env = grb.Env(params={"OutputFlag": 0})
+    results = {"agents": len(agents), "events": int(agents.nEvents.sum())}
+    for name, build in builders.items():
+        tBuild = 0
+        for agent in agents:
+            eBatStart = config["SOCStart"] * agent.capacity
+            slack, mxEbatEnd = optimize.getSlack(agent=agent, events=agent.events, eBatStart=eBatStart,
+                                                 etaTimesDelta=etaTimesDelta)
+            start = time.time()
+            model = grb.Model(env=env)
+            build(model=model, agent=agent, events=agent.events, slack=slack, mxEbatEnd=mxEbatEnd,
+                  eBatStart=eBatStart, etaTimesDelta=etaTimesDelta, eBatGoal=eBatStart, residualLoad=residualLoad)
+            model.update()
+            tBuild += time.time() - start
+            model.dispose()
+        results[name] = tBuild
+        if verbose:
+            print(f"{name}: {tBuild:.2f} secs ({1000 * tBuild / len(agents):.1f} ms per agent)")
+    env.dispose()
+    return results
+
+# Compare the output formats: Size of the database and time to read all agent profiles.
+# Output of the Uncontrolled strategy on the bundled inputs.
+def benchmarkOutput(*, scenario="Realistic", outputDir=None, verbose=True):
+    dirname = os.path.dirname(__file__)
+    if outputDir is None:
+        outputDir = os.path.join(dirname, "output")
+    with open(os.path.join(dirname, 'config.json')) as f:
+        config = json.load(f)
+    regionData = pd.read_csv(os.path.join(dirname, "input/regions.csv"), sep=";")
+    regionIDs = regionData["ID"].astype(str).values
+
+    results = {}
+    for outputFormat in ("sparse", "dense"):
+        dbName = os.path.join(outputDir, f"benchmark_{outputFormat}.db")
+        tools.innitDB(dbName, resolution=config["resolution"])
+        random.seed(123) # Same agents for all formats
+        start = time.time()
+        uncontrolled.run(scenario=scenario, config=dict(config, outputFormat=outputFormat), dbName=dbName,
+                         regionIDs=regionIDs, aggFactors=np.ones(len(regionIDs)), n_worker=1, verbose=False)
+        tWrite = time.time() - start
+
+        # Read the profiles of all agents as array (agent x time step)
+        start = time.time()
+        if outputFormat == "sparse":
+            conn = sqlite3.connect(dbName)
+            df = pd.read_sql("SELECT Time, AgentID, PowerMW FROM TimeSeries", conn, parse_dates="Time")
+            conn.close()
+            df.pivot_table(index="AgentID", columns="Time", values="PowerMW", fill_value=0).to_numpy()
+        else:
+            postprocessing.getProfileArray(dbName)
+        tRead = time.time() - start
+
+        results[outputFormat] = {"MB": os.path.getsize(dbName) / 1e6, "write": tWrite, "read": tRead}
+        if verbose:
+            print(f"{outputFormat}: {results[outputFormat]['MB']:.1f} MB, run + write: {tWrite:.2f} secs, "
+                  f"read: {tRead:.2f} secs")
+    return results
+
+# Reference: Regional aggregation with one query (full scan) per region
+def processRegionalLoadLoop(dbName, regionIDs):
+    conn = sqlite3.connect(dbName)
+    c = conn.cursor()
+    tools.createLoadTable(c, "Regions")
+    for regionID in regionIDs:
+        c.execute("""INSERT INTO Regions (Time, PowerMW, Type)
+            Select Time, SUM(PowerMW), Region
+            From TimeSeries
+            INNER JOIN Agents on Agents.AgentID = TimeSeries.AgentID
+            Where Region = (?)
+            GROUP BY Time""", (regionID, ))
+        conn.commit()
+    conn.close()
+
+# Time the regional aggregation (postprocessing.processRegionalLoad) as a function of the number of regions.
+# Synthetic output: Every agent charges in nCharging random time steps.
+def benchmarkPostprocessing(*, regionCounts=(5, 20, 80), agentsPerRegion=10, nCharging=500, outputDir=None,
+                            verbose=True):
+    if outputDir is None:
+        outputDir = os.path.join(os.path.dirname(__file__), "output")
+    dbName = os.path.join(outputDir, "benchmark_postprocessing.db")
+    rng = np.random.default_rng(123)
+    nTimesteps = len(tools.getTimeCol())
+
+    results = []
+    for nRegions in regionCounts:
+        tools.innitDB(dbName)
+        regionIDs = [f"Region_{i}" for i in range(nRegions)]
+        for regionID in regionIDs:
+            agents = [preprocessing.Agent(f"{regionID}_{j}", "EV_medium", [], 1, 0.05, 0, regionID)
+                      for j in range(agentsPerRegion)]
+            demands = {agent.name: dict(zip(rng.choice(nTimesteps, nCharging, replace=False).tolist(),
+                                            rng.uniform(0, 0.011, nCharging).tolist())) for agent in agents}
+            tools.saveDB(agents=agents, demands=demands, slacks={agent.name: 0 for agent in agents}, dbName=dbName)
+
+        start = time.time()
+        processRegionalLoadLoop(dbName, regionIDs)
+        tLoop = time.time() - start
+        start = time.time()
+        postprocessing.processRegionalLoad(dbName)
+        tSinglePass = time.time() - start
+
+        results.append({"regions": nRegions, "loop": tLoop, "singlePass": tSinglePass})
+        if verbose:
+            print(f"{nRegions} regions: per-region queries: {tLoop:.2f} secs, single pass: {tSinglePass:.2f} secs")
+    os.remove(dbName)
+    return results
+
+# Reference: Full quadratic program with the objective sum_t (sum_agents pCharge[t])^2, O(T * N^2) quadratic terms
+def buildChargingQPDense(*, env, agents, residualLoad, etaTimesDelta, SOCStart):
+    model = grb.Model(env=env)
+    nTimesteps = len(residualLoad)
+    objective, load = 0, 0
+    for agent in agents:
+        eBatStart = SOCStart * agent.capacity
+        slack, mxEbatEnd = optimize.getSlack(agent=agent, events=agent.events, eBatStart=eBatStart,
+                                             etaTimesDelta=etaTimesDelta)
+        ts, pCharge, _ = optimize.setAgentConstr(model=model, agent=agent, events=agent.events, slack=slack,
+                                                 mxEbatEnd=mxEbatEnd, eBatStart=eBatStart,
+                                                 etaTimesDelta=etaTimesDelta, eBatGoal=eBatStart)
+        objective = objective + (2 * residualLoad[ts]) @ pCharge
+        toFleet = optimize.sparse.csr_matrix((np.ones(len(ts)), (ts, np.arange(len(ts)))), shape=(nTimesteps, len(ts)))
+        load = load + toFleet @ pCharge
+    model.setObjective(objective + load @ load, grb.GRB.MINIMIZE)
+    return model
+
+# Resident memory of this process in MB (Linux only)
+def getRSS():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return None
+
+# Scaling of the full quadratic program (Opt_Exact) with the fleet size: Size, memory, build and solve time
+# of the aggregate-load formulation. The dense reference formulation is only built up to maxDense agents.
+# solve: Also solve the models (requires a Gurobi licence without size limits).
+def benchmarkExact(*, scenario="Realistic", fleetSizes=(2, 4, 8, 16, 32, 64), maxDense=8, solve=False, verbose=True):
+    dirname = os.path.dirname(__file__)
+    with open(os.path.join(dirname, 'config.json')) as f:
+        config = json.load(f)
+    regionIDs = pd.read_csv(os.path.join(dirname, "input/regions.csv"), sep=";")["ID"].astype(str).values
+    resolution = config["resolution"]
+    fleet = preprocessing.Fleet.concat([preprocessing.getFleet(scenario, config, regionID, resolution=resolution)
+                                        for regionID in regionIDs])
+    residualLoad = np.asarray(preprocessing.getResidual("all", resolution=resolution), dtype=float)
+    etaTimesDelta = config["chargingEfficiency"] * tools.getDeltaT(resolution)
+
+    env = grb.Env(params={"OutputFlag": 0})
+    builders = {"aggregate": optimize.buildChargingQP, "dense": lambda **kwargs: (buildChargingQPDense(**kwargs), )}
+    results = []
+    for nAgents in fleetSizes:
+        agents = list(fleet[:nAgents])
+        for name, build in builders.items():
+            if name == "dense" and nAgents > maxDense:
+                continue
+            rss = getRSS()
+            start = time.time()
+            model = build(env=env, agents=agents, residualLoad=residualLoad, etaTimesDelta=etaTimesDelta,
+                          SOCStart=config["SOCStart"])[0]
+            model.update()
+            result = {"formulation": name, "agents": nAgents, "vars": model.NumVars, "qnz": model.NumQNZs,
+                      "build": time.time() - start, "MB": round(getRSS() - rss, 1) if rss is not None else None, "solve": None}
+            if solve:
+                start = time.time()
+                model.optimize()
+                result["solve"] = time.time() - start
+            model.dispose()
+            results.append(result)
+            if verbose:
+                print(f"{name} {nAgents} agents: {result['vars']} vars, {result['qnz']} quadratic terms, "
+                      f"build: {result['build']:.2f} secs, memory: {result['MB']} MB, solve: {result['solve']} secs")
+    env.dispose()
+    return results
+
+# Synthetic behavior table of one region (same format as input/behavior).
+# Every vehicle starts and ends each day at home. Per day: Commute (home -> work -> home) with probability 0.6,
+# evening trip (home -> shopping/leisure -> home) with probability 0.5. The trips are placed in disjoint
+# time slots, so they never overlap.
+def createBehavior(path, *, nVehicles, days, rng, startDate=dt(2030, 1, 1)):
+    vehicles, dayIdx = [a.reshape(-1) for a in np.meshgrid(np.arange(nVehicles), np.arange(days), indexing="ij")]
+    commute = rng.random(len(vehicles)) < 0.6
+    evening = rng.random(len(vehicles)) < 0.5
+    commuteDist = np.clip(rng.lognormal(2.5, 0.7, nVehicles), 1, 60) # Fixed distance to work per vehicle
+
+    # Slots (earliest departure, latest departure) in hours, purpose and distance of each trip
+    trips = [((6, 9), 0, commuteDist[vehicles], commute), ((15, 17.5), 7, commuteDist[vehicles], commute),
+             ((18, 19.5), rng.choice([3, 5], len(vehicles)), np.clip(rng.lognormal(1.8, 0.8, len(vehicles)), 0.5, 40),
+              evening),
+             ((20.5, 22), 7, None, evening)]
+    columns = []
+    for (earliest, latest), purpose, distance, mask in trips:
+        if distance is None:
+            distance = columns[-1][2] # Way back: Same distance
+        departure = dayIdx * 24 + rng.uniform(earliest, latest, len(vehicles))
+        speed = rng.uniform(20, 80, len(vehicles))
+        speed = np.maximum(speed, distance / (50 / 60)) # Trips take at most 50 min
+        arrival = departure + distance / speed
+        purpose = np.broadcast_to(purpose, len(vehicles))
+        columns.append((departure, arrival, distance, purpose, speed, mask))
+    departure, arrival, distance, purpose, speed = [np.concatenate([col[i][col[5]] for col in columns])
+                                                    for i in range(5)]
+    vehicle = np.concatenate([vehicles[col[5]] for col in columns])
+    # Temperature: Seasonal cycle plus noise
+    temperature = 10 - 8 * np.cos(2 * np.pi * departure / (24 * 365)) + rng.normal(0, 3, len(departure))
+
+    toTime = lambda hours: (pd.Timestamp(startDate) + pd.to_timedelta(np.round(hours * 60), unit="min")).strftime("%Y-%m-%d %H:%M")
+    df = pd.DataFrame({"Departure": toTime(departure), "Arrival": toTime(arrival), "Distance [km]": distance.round(1),
+                       "Purpose": purpose, "Vehicle_id": vehicle, "MeanSpeed [km/h]": speed.round(1),
+                       "Temperature [deg_C]": temperature.round(1)})
+    df = df.iloc[np.lexsort((departure, vehicle))]
+    df.to_csv(path, sep=";", index=False)
+    return len(df)
+
+# Synthetic residual load of one region (same format as input/residual-load):
+# Daily, weekly and yearly sine curves plus Gaussian noise in MW, proportional to scale.
+def createResidual(path, *, days, scale, rng, startDate=dt(2030, 1, 1)):
+    index = pd.date_range(startDate, startDate + timedelta(days=days), freq="15T", inclusive="left")
+    hours = np.arange(len(index)) / 4
+    load = scale * (50 + 15 * np.sin(2 * np.pi * (hours - 6) / 24) + 5 * np.sin(2 * np.pi * hours / (24 * 7))
+                    + 10 * np.cos(2 * np.pi * hours / (24 * 365)) + rng.normal(0, 2, len(index)))
+    pd.DataFrame({"TimeStamp": index, "ResidualLoad_MW": load}).to_csv(path, sep=";", index=False)
+
+# Synthetic input directory (behavior, residual-load, regions.csv) for preprocessing.getFleet/getResidual
+def createInputs(inputDir, *, nRegions, nVehicles, days, seed=123, startDate=dt(2030, 1, 1)):
+    rng = np.random.default_rng(seed)
+    regionIDs = [f"Region_{i + 1}" for i in range(nRegions)]
+    for folder in ("behavior", "residual-load"):
+        os.makedirs(os.path.join(inputDir, folder), exist_ok=True)
+    for regionID in regionIDs:
+        createBehavior(os.path.join(inputDir, f"behavior/{regionID}.csv"), nVehicles=nVehicles, days=days, rng=rng,
+                       startDate=startDate)
+        createResidual(os.path.join(inputDir, f"residual-load/{regionID}.csv"), days=days, scale=nVehicles / 100,
+                       rng=rng, startDate=startDate)
+    pd.DataFrame({"ID": regionIDs, "RegisteredCars": nVehicles}).to_csv(os.path.join(inputDir, "regions.csv"),
+                                                                         sep=";", index=False)
+    return regionIDs
+
+# Objective of the optimized strategies for the given charging loads: sum_t (residual + load)^2 - residual^2
+def getObjective(residualLoad, demands):
+    residualLoad = np.asarray(residualLoad, dtype=float)
+    load = np.zeros(len(residualLoad))
+    for demand in demands.values():
+        np.add.at(load, np.fromiter(demand.keys(), dtype=int, count=len(demand)),
+                  np.fromiter(demand.values(), dtype=float, count=len(demand)))
+    return float((load * (load + 2 * residualLoad)).sum())
+
+# Time every stage of the model on synthetic inputs for all combinations of the region count,
+# vehicles per region and horizon (days from 2030-01-01):
+# generate (inputs), preprocessing (getFleet, getResidual without cache), immediate, optimize
+# (optimizeChargingQP_smpl, all agents against the total residual load), saveDB (optimized results),
+# postprocessing (processRegionalLoad, processTotalLoad).
+# solver: Default: config.json, "native" without Gurobi. resolution: Default: config.json
+# coarse: Resolution of the first stage of the two stage solve, e.g. "1H" (see optimize.solveAgentCoarse).
+#   Adds the stage optimizeCoarse, its speedup and the deviation of the objective from the single stage solve.
+# jsonFile: The results are appended to the list in this file -> track regressions and speedups over time.
+def benchmarkSuite(*, scenario="Realistic", regionCounts=(2, ), vehiclesPerRegion=(50, ), days=(28, ), solver=None,
+                   resolution=None, coarse=None, jsonFile=None, verbose=True):
+    dirname = os.path.dirname(__file__)
+    with open(os.path.join(dirname, 'config.json')) as f:
+        config = json.load(f)
+    if solver is None:
+        solver = config["solver"] if grb is not None else "native"
+    resolution = resolution or config["resolution"]
+    deltaT = tools.getDeltaT(resolution)
+    startDate = dt(2030, 1, 1)
+
+    results = []
+    for nRegions in regionCounts:
+        for nVehicles in vehiclesPerRegion:
+            for nDays in days:
+                endDate = startDate + timedelta(days=nDays)
+                stages = {}
+                with tempfile.TemporaryDirectory() as tmp:
+                    inputDir = os.path.join(tmp, "input")
+                    start = time.time()
+                    regionIDs = createInputs(inputDir, nRegions=nRegions, nVehicles=nVehicles, days=nDays,
+                                             startDate=startDate)
+                    stages["generate"] = time.time() - start
+
+                    random.seed(123)
+                    start = time.time()
+                    fleets = [preprocessing.getFleet(scenario, config, regionID, startDate=startDate, endDate=endDate,
+                                                     resolution=resolution, cache=False, inputDir=inputDir)
+                              for regionID in regionIDs]
+                    residualLoad = preprocessing.getResidual("all", startDate=startDate, endDate=endDate, cache=False,
+                                                             inputDir=inputDir, resolution=resolution)
+                    stages["preprocessing"] = time.time() - start
+                    agents = preprocessing.Fleet.concat(fleets)
+
+                    start = time.time()
+                    for fleet in fleets:
+                        optimize.immediate(agents=fleet, eta=config["chargingEfficiency"], SOCStart=config["SOCStart"],
+                                           deltaT=deltaT, verbose=False)
+                    stages["immediate"] = time.time() - start
+
+                    residualLoad = np.asarray(residualLoad, dtype=float)
+                    start = time.time()
+                    demands, slacks = optimize.optimizeChargingQP_smpl(agents=agents, residualLoad=residualLoad.copy(),
+                                                                      eta=config["chargingEfficiency"],
+                                                                      SOCStart=config["SOCStart"], deltaT=deltaT,
+                                                                      verbose=False, solver=solver)
+                    stages["optimize"] = time.time() - start
+
+                    if coarse is not None:
+                        factor = tools.getCoarseFactor({"resolution": resolution, "coarseResolution": coarse})
+                        start = time.time()
+                        coarseDemands, _ = optimize.optimizeChargingQP_smpl(agents=agents,
+                                                                            residualLoad=residualLoad.copy(),
+                                                                            eta=config["chargingEfficiency"],
+                                                                            SOCStart=config["SOCStart"], deltaT=deltaT,
+                                                                            verbose=False, solver=solver, coarse=factor)
+                        stages["optimizeCoarse"] = time.time() - start
+                        objective = getObjective(residualLoad, demands)
+                        coarseObjective = getObjective(residualLoad, coarseDemands)
+                        twoStage = {"resolution": coarse, "objective": objective, "coarseObjective": coarseObjective,
+                                    "deviation": (coarseObjective - objective) / abs(objective),
+                                    "speedup": stages["optimize"] / stages["optimizeCoarse"]}
+
+                    dbName = os.path.join(tmp, "benchmark.db")
+                    tools.innitDB(dbName, startDate=startDate, endDate=endDate, resolution=resolution)
+                    start = time.time()
+                    tools.saveDB(agents=agents, demands=demands, slacks=slacks, dbName=dbName, startDate=startDate,
+                                 endDate=endDate, resolution=resolution)
+                    stages["saveDB"] = time.time() - start
+
+                    start = time.time()
+                    postprocessing.processRegionalLoad(dbName)
+                    postprocessing.processTotalLoad(dbName)
+                    stages["postprocessing"] = time.time() - start
+
+                result = {"date": dt.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+                          "numpy": np.__version__, "gurobi": grb is not None, "solver": solver, "scenario": scenario,
+                          "resolution": resolution,
+                          "regions": nRegions, "vehiclesPerRegion": nVehicles, "days": nDays, "agents": len(agents),
+                          "events": int(agents.nEvents.sum()), "secs": stages}
+                if coarse is not None:
+                    result["twoStage"] = twoStage
+                results.append(result)
+                if verbose:
+                    print(f"{nRegions} regions x {nVehicles} vehicles, {nDays} days ({result['events']} events): "
+                          + ", ".join(f"{stage}: {secs:.2f}" for stage, secs in stages.items()) + " secs")
+                    if coarse is not None:
+                        print(f"Two stage ({coarse}): {twoStage['speedup']:.1f}x faster, objective deviation: "
+                              f"{100 * twoStage['deviation']:+.3f} %")
+
+    if jsonFile is not None:
+        history = []
+        if os.path.isfile(jsonFile):
+            with open(jsonFile) as f:
+                history = json.load(f)
+        with open(jsonFile, "w") as f:
+            json.dump(history + results, f, indent=1)
+    return results
+
+benchmarks = {"build": benchmarkBuild, "output": benchmarkOutput, "postprocessing": benchmarkPostprocessing,
+              "exact": benchmarkExact, "suite": benchmarkSuite}
+
+def getArgs():
+    parser = argparse.ArgumentParser()
+    # Benchmark: build (model construction), output (output formats)
+    parser.add_argument("--benchmark", default="build", choices=list(benchmarks))
+    # EVSE availability scenario
+    parser.add_argument("--scenario", default="Realistic")
+    # Only use the first n agents
+    parser.add_argument("--nAgents", default=None, type=int)
+    # Exact: Solve the models too
+    parser.add_argument("--solve", action="store_true")
+    # Suite: Size of the synthetic inputs, solver and result file
+    parser.add_argument("--regions", dest="regionCounts", nargs="+", default=[2], type=int)
+    parser.add_argument("--vehicles", dest="vehiclesPerRegion", nargs="+", default=[50], type=int)
+    parser.add_argument("--days", nargs="+", default=[28], type=int)
+    parser.add_argument("--solver", default=None)
+    parser.add_argument("--resolution", default=None)
+    parser.add_argument("--coarse", default=None)
+    parser.add_argument("--json", dest="jsonFile", default=None)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = vars(getArgs())
+    benchmark = benchmarks[args.pop("benchmark")]
+    if benchmark is not benchmarkBuild:
+        args.pop("nAgents")
+    if benchmark is not benchmarkExact:
+        args.pop("solve")
+    if benchmark is benchmarkPostprocessing:
+        args.pop("scenario")
+    if benchmark is not benchmarkSuite:
+        for key in ("regionCounts", "vehiclesPerRegion", "days", "solver", "resolution", "coarse", "jsonFile"):
+            args.pop(key)
+    benchmark(**args)
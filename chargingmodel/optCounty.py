@@ -1,53 +1,99 @@
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, current_process
+import random
+
+import numpy as np
 
 import chargingmodel.preprocessing as preprocessing
 import chargingmodel.optimize as optimize
 import chargingmodel.tools as tools
+import chargingmodel.profiling as profiling
+import chargingmodel.reduction as reduction
 
 # Optimize the charging for every region individually.
 # Runs for all regions in parrallel.
-def run(*, scenario, config, dbName, regionIDs, aggFactors, n_worker, verbose):
+# The workers only receive the region ID, they preprocess the region themselves (getFleet, getResidual).
+# seed: Random draws per region, same as in the other strategies (see run.py).
+#   Default: Drawn from the global random state -> the regions do not depend on the order of the workers.
+# With config["reductionFactor"] > 1 representative agents are optimized (see reduction).
+def run(*, scenario, config, dbName, regionIDs, aggFactors, n_worker, verbose, seed=None):
+    if seed is None:
+        seed = random.getrandbits(32)
     # Set optimization horizon
     if config["horizon"] == "full":
         segments = False
     else:
-        segments = tools.createSegmentation(config["horizon"])
+        segments = tools.createSegmentation(config["horizon"], resolution=config["resolution"])
+    coarse = tools.getCoarseFactor(config)
+    reducer = reduction.fromConfig(config) # Statistics of the workers' reductions
 
     # Run for all chosen counties independently
     queue = Queue()
     currentWork = []
-    for i, regionID in enumerate(regionIDs):
-        # Preprocess data
-        agents = preprocessing.getAgents(scenario, config, regionID, aggFac=aggFactors[i])
-        residualLoad = preprocessing.getResidual(regionID)
-
-        # Create process
-        kwargs = {"agents": agents, "residualLoad": residualLoad,
-                  "config": config, "queue": queue, "segments": segments}
-        p = Process(target=runCounty, name=str(regionID),
-                    kwargs=kwargs)
-        currentWork.append(p)
-
-        # Run porcesses, will wait for all to complete
-        if len(currentWork) >= n_worker:
+    with tools.DBWriter(dbName, verbose=verbose, outputFormat=config["outputFormat"],
+                        resolution=config["resolution"]) as writer:
+        for i, regionID in enumerate(regionIDs):
+            # Create process
+            kwargs = {"scenario": scenario, "regionID": regionID, "aggFac": aggFactors[i], "seed": seed,
+                      "config": config, "queue": queue, "segments": segments, "coarse": coarse}
+            p = Process(target=runCounty, name=str(regionID),
+                        kwargs=kwargs)
+            currentWork.append(p)
+
+            # Run porcesses, will wait for all to complete
+            if len(currentWork) >= n_worker:
+                results = tools.runProcesses(currentWork, verbose, queue)
+                currentWork = []
+                save(writer, results, reducer)
+
+        # Run remaining processes
+        if currentWork:
             results = tools.runProcesses(currentWork, verbose, queue)
-            currentWork = []
-            
-            for result in results:
-                tools.saveDB(agents=result[0], demands=result[1], slacks=result[2], dbName=dbName)
-
-    # Run remaining processes
-    if currentWork:
-        results = tools.runProcesses(currentWork, verbose, queue)
-
-        for result in results:
-            tools.saveDB(agents=result[0], demands=result[1], slacks=result[2], dbName=dbName)
-
-
-def runCounty(*, agents, residualLoad, config, queue, segments):
-    demands, slacks = optimize.optimizeChargingQP_smpl(agents=agents, residualLoad=residualLoad,
-                                                      eta=config["chargingEfficiency"],
-                                                      SOCStart=config["SOCStart"],
-                                                      deltaT=0.25, verbose=False,
-                                                      segments=segments)
-    queue.put((agents, demands, slacks))
+            save(writer, results, reducer)
+    if reducer is not None:
+        if verbose:
+            print(reducer.summary())
+        reducer.checkError()
+
+# Save the results of the workers
+def save(writer, results, reducer):
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    for agents, demands, slacks, rows, stats, records in results:
+        writer.put(agents=agents, demands=demands, slacks=slacks, reduction=rows)
+        if reducer is not None:
+            reducer.merge(stats)
+        profiling.merge(records)
+
+# Worker: Preprocess and optimize one region.
+# Returns the agents (Fleet), their demands and slacks, the reduction rows and statistics and the
+# instrumentation records. The loads of representatives are already split between their members.
+def runCounty(*, scenario, regionID, aggFac, seed, config, queue, segments, coarse=1):
+    profiling.collect() # Discard the records inherited from the parent
+    try:
+        with profiling.profile(current_process().name):
+            # Preprocess data
+            agents = preprocessing.getFleet(scenario, config, regionID, aggFac=aggFac, seed=seed,
+                                            resolution=config["resolution"])
+            reducer = reduction.fromConfig(config)
+            if reducer is not None:
+                agents = reducer.reduce(agents)
+            # Private copy: The optimization updates the residual load
+            residualLoad = np.array(preprocessing.getResidual(regionID, resolution=config["resolution"]), dtype=float)
+
+            demands, slacks = optimize.optimizeChargingQP_smpl(agents=agents, residualLoad=residualLoad,
+                                                              eta=config["chargingEfficiency"],
+                                                              SOCStart=config["SOCStart"],
+                                                              deltaT=tools.getDeltaT(config["resolution"]),
+                                                              verbose=False, segments=segments,
+                                                              solver=config["solver"], reuse=config["reuseModel"],
+                                                              order=config["segmentOrder"], coarse=coarse)
+            rows, stats = None, None
+            if reducer is not None:
+                agents, demands, slacks, rows = reducer.disaggregate(agents, demands, slacks)
+                stats = reducer.stats
+    except Exception as e:
+        queue.put(e)
+        return
+    # Instrumentation records of this process go to the parent (see profiling)
+    queue.put((agents, demands, slacks, rows, stats, profiling.collect()))
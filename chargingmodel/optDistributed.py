@@ -0,0 +1,227 @@
+from multiprocessing import Process, Queue, current_process
+import random
+
+import numpy as np
+
+import chargingmodel.preprocessing as preprocessing
+import chargingmodel.optimize as optimize
+import chargingmodel.tools as tools
+import chargingmodel.profiling as profiling
+
+# Joint optimization of all agents by parallel best responses (Jacobi iteration with exact line search).
+# Start: Greedy solution (optimizeChargingQP_smpl) of the agents of every worker.
+# Every iteration:
+#   1. All agents compute their best response to the current load of all other agents (in parallel).
+#   2. All agents move towards their best response by the same step, chosen to minimize the objective.
+# The objective decreases monotonically and converges to the joint optimum (Opt_Exact).
+# The distance to the optimum is bounded in every iteration by a Frank-Wolfe lower bound.
+# seed: Random draws per region (see run.py). Default: Drawn from the global random state.
+def run(*, scenario, config, dbName, regionIDs, aggFactors, n_worker, verbose, seed=None):
+    if seed is None:
+        seed = random.getrandbits(32)
+    # Preprocess data
+    if verbose:
+        print("Processing...")
+    fleets = []
+    for i, regionID in enumerate(regionIDs):
+        fleets.append(preprocessing.getFleet(scenario, config, regionID, aggFac=aggFactors[i], seed=seed,
+                                             resolution=config["resolution"]))
+        # Progressbar
+        if verbose:
+            tools.tickProg((i+1)/len(regionIDs))
+    agents = preprocessing.Fleet.concat(fleets)
+    if verbose:
+        print("\nData preprocessed!")
+
+    residualLoad = preprocessing.getResidual("all", resolution=config["resolution"])
+    demands, slacks, _ = optimizeJacobi(agents=agents, residualLoad=residualLoad,
+                                        eta=config["chargingEfficiency"], SOCStart=config["SOCStart"],
+                                        deltaT=tools.getDeltaT(config["resolution"]), n_worker=n_worker,
+                                        solver=config["solver"], maxIter=config["maxIter"], gapTol=config["gapTol"],
+                                        verbose=verbose)
+    with tools.DBWriter(dbName, verbose=verbose, outputFormat=config["outputFormat"],
+                        resolution=config["resolution"]) as writer:
+        writer.put(agents=agents, demands=demands, slacks=slacks)
+
+# Returns the demands, slacks and the history of the iterations.
+# gapTol: Stop if the gap to the lower bound is below gapTol * |objective - objective without EVs|.
+def optimizeJacobi(*, agents, residualLoad, eta, SOCStart, deltaT, n_worker=1, solver="native", maxIter=50,
+                   gapTol=1e-3, verbose=True):
+    agents = preprocessing.Fleet.fromAgents(agents) if not isinstance(agents, preprocessing.Fleet) else agents
+    residualLoad = np.asarray(residualLoad, dtype=float)
+    n_worker = max(1, min(n_worker, len(agents)))
+
+    # Residual load and load of the fleet in shared memory. Only the parent writes.
+    shmResid, _ = tools.createSharedArray(residualLoad)
+    shmLoad, load = tools.createSharedArray(np.zeros(len(residualLoad)))
+    results = Queue()
+    tasks = [Queue() for _ in range(n_worker)]
+    workers = []
+    history = []
+    failed = True
+    try:
+        for i in range(n_worker):
+            # Every worker owns a fixed set of agents and keeps their current schedules
+            kwargs = {"agents": agents[np.arange(i, len(agents), n_worker)], "residualName": shmResid.name,
+                      "loadName": shmLoad.name, "nTimesteps": len(residualLoad), "eta": eta, "deltaT": deltaT,
+                      "SOCStart": SOCStart, "solver": solver, "tasks": tasks[i], "results": results}
+            p = Process(target=runWorker, name="Worker_" + str(i), kwargs=kwargs)
+            p.start()
+            workers.append(p)
+
+        # Start solution
+        for aggregate in broadcast(tasks, results, ("init", )):
+            load += aggregate
+        baseObj = (residualLoad**2).sum()
+        # Sum of pMax^2 of all charging time steps, scales the error of the linear minimization
+        sumPMaxSq = (np.maximum(agents.stop - agents.start, 0) * agents.pMax**2).sum()
+
+        bestBound = -np.inf
+        for iteration in range(maxIter + 1):
+            # Best responses and lower bound
+            net = residualLoad + load
+            objective = (net**2).sum()
+            direction = np.zeros(len(load))
+            bound = objective
+            # Bound loss eps * sumPMaxSq: 1% of the tolerance, limited by the floating point precision
+            eps = max(0.01 * gapTol * abs(objective - baseObj) / max(sumPMaxSq, 1e-12),
+                      1e-9 * np.abs(net).max() / max(agents.pMax[agents.pMax > 0].min(initial=np.inf), 1e-12))
+            for aggregate, boundTerm in broadcast(tasks, results, ("respond", eps)):
+                direction += aggregate
+                bound += 2 * boundTerm
+            bestBound = max(bestBound, bound)
+            gap = objective - bestBound
+            relGap = gap / max(abs(objective - baseObj), 1e-12)
+
+            # Exact line search: min_step sum((net + step * direction)^2)
+            denom = (direction**2).sum()
+            step = min(1.0, max(0.0, -(net @ direction) / denom)) if denom > 0 else 0.0
+
+            history.append({"iteration": iteration, "objective": objective - baseObj, "gap": gap,
+                            "relGap": relGap, "step": step})
+            if verbose:
+                print(f"Iteration {iteration}: objective {objective - baseObj:.6g}, gap {gap:.3g} "
+                      f"({100 * relGap:.3f}%), step {step:.3f}")
+            if relGap <= gapTol or step == 0 or iteration == maxIter:
+                break
+
+            broadcast(tasks, results, ("step", step))
+            load += step * direction
+
+        # Solution
+        demands, slacks = {}, {}
+        for workerDemands, workerSlacks, records in broadcast(tasks, results, ("result", )):
+            demands.update(workerDemands)
+            slacks.update(workerSlacks)
+            profiling.merge(records)
+        failed = False
+    finally:
+        tools.stopWorkers(workers, tasks, terminate=failed)
+        del load
+        for shm in (shmResid, shmLoad):
+            shm.close()
+            shm.unlink()
+    return demands, slacks, history
+
+# Send a task to all workers and wait for their answers
+def broadcast(tasks, results, task):
+    for queue in tasks:
+        queue.put(task)
+    answers = [results.get() for _ in tasks]
+    for answer in answers:
+        if isinstance(answer, Exception):
+            raise answer
+    return answers
+
+# Schedule array (aligned with the event time steps) from a {t: p} dict
+def toArray(pCharge, nSteps):
+    return np.fromiter(pCharge.values(), dtype=np.float64, count=len(pCharge)) if pCharge else np.zeros(nSteps)
+
+def runWorker(*, agents, residualName, loadName, nTimesteps, eta, deltaT, SOCStart, solver, tasks, results):
+    etaTimesDelta = eta * deltaT
+    shmResid, residualLoad = tools.attachSharedArray(residualName, (nTimesteps,))
+    shmLoad, load = tools.attachSharedArray(loadName, (nTimesteps,))
+    env = None
+    if solver == "gurobi" and optimize.grb is not None:
+        env = optimize.grb.Env(params={"OutputFlag": 0})
+    agents = list(agents)
+
+    # Per agent: Problem data, current schedule and best response
+    problems, schedules, responses = {}, {}, {}
+    for agent in agents:
+        eBatStart = SOCStart * agent.capacity
+        slack, mxEbatEnd = optimize.getSlack(agent=agent, events=agent.events, eBatStart=eBatStart,
+                                             etaTimesDelta=etaTimesDelta)
+        ts, eventOfStep = optimize.getEventSteps(agent.events)
+        pMax = np.array([event.pMax for event in agent.events])[eventOfStep]
+        problems[agent.name] = (ts, pMax, {"agent": agent, "events": agent.events, "slack": slack,
+                                           "mxEbatEnd": mxEbatEnd, "eBatStart": eBatStart,
+                                           "etaTimesDelta": etaTimesDelta, "eBatGoal": eBatStart})
+    profiling.collect() # Discard the records inherited from the parent
+    profiler = profiling.startProfile()
+    try:
+        for task in iter(tasks.get, None):
+            try:
+                if task[0] == "init":
+                    demands, slacks = optimize.optimizeChargingQP_smpl(agents=agents, residualLoad=residualLoad.copy(),
+                                                                      eta=eta, SOCStart=SOCStart, deltaT=deltaT,
+                                                                      verbose=False, solver=solver, env=env)
+                    aggregate = np.zeros(nTimesteps)
+                    for agent in agents:
+                        ts = problems[agent.name][0]
+                        schedules[agent.name] = np.array([demands[agent.name].get(t, 0.0) for t in ts.tolist()])
+                        aggregate[ts] += schedules[agent.name]
+                    results.put(aggregate)
+                elif task[0] == "respond":
+                    results.put(respond(problems, schedules, responses, residualLoad + load, solver, env, task[1]))
+                elif task[0] == "step":
+                    for name, schedule in schedules.items():
+                        schedule += task[1] * (responses[name] - schedule)
+                    results.put(None)
+                elif task[0] == "result":
+                    demands = {name: {t: p for t, p in zip(problems[name][0].tolist(), schedule.tolist()) if p > 0}
+                               for name, schedule in schedules.items()}
+                    # Instrumentation records of this worker go to the parent (see profiling)
+                    results.put((demands, slacks, profiling.collect()))
+            except Exception as e:
+                results.put(e)
+    finally:
+        profiling.dumpProfile(profiler, current_process().name)
+        if env is not None:
+            env.dispose()
+        del residualLoad, load
+        shmResid.close()
+        shmLoad.close()
+
+# Best responses of the agents of a worker and their part of the lower bound.
+# net: Residual load + load of the whole fleet.
+# Lower bound (convexity): F* >= F(p) + 2 * sum_agents min_q (net @ (q - p)).
+# min_q net @ q is approximated by the QP min_q (net @ q + eps/2 * |q|^2), which can be solved
+# like a best response (residual net / eps). Subtracting eps/2 * max|q|^2 keeps the bound valid.
+def respond(problems, schedules, responses, net, solver, env, eps):
+    aggregate = np.zeros(len(net))
+    boundTerm = 0.0
+    for name, (ts, pMax, kwargs) in problems.items():
+        schedule = schedules[name]
+        if len(ts) == 0:
+            responses[name] = schedule
+            continue
+
+        # Best response: Residual load seen by this agent without its own schedule
+        others = net.copy()
+        others[ts] -= schedule
+        if solver == "native":
+            with profiling.timer("solve"):
+                pCharge, _ = optimize.solveAgentNative(residualLoad=others, **kwargs)
+        else:
+            pCharge, _ = optimize.solveAgentGurobi(env=env, residualLoad=others, **kwargs)
+        responses[name] = toArray(pCharge, len(ts))
+        aggregate[ts] += responses[name] - schedule
+
+        # Linear minimization (always with the native solver)
+        with profiling.timer("bound"):
+            pLinear, _ = optimize.solveAgentNative(residualLoad=net / eps, **kwargs)
+        q = toArray(pLinear, len(ts))
+        netTs = net[ts]
+        boundTerm += netTs @ q + eps / 2 * (q @ q) - eps / 2 * (pMax @ pMax) - netTs @ schedule
+    return aggregate, boundTerm
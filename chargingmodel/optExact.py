@@ -0,0 +1,40 @@
+import random
+
+import chargingmodel.preprocessing as preprocessing
+import chargingmodel.optimize as optimize
+import chargingmodel.tools as tools
+
+# Optimize the charging of all agents of all regions jointly (full quadratic program, see optimize.buildChargingQP).
+# Exact solution of the national problem. Requires Gurobi, n_worker sets the number of Gurobi threads.
+# The optimization horizon is always the entire year.
+# seed: Random draws per region (see run.py). Default: Drawn from the global random state.
+def run(*, scenario, config, dbName, regionIDs, aggFactors, n_worker, verbose, seed=None):
+    if seed is None:
+        seed = random.getrandbits(32)
+    # Preprocess data
+    if verbose:
+        print("Processing...")
+
+    residualLoad = preprocessing.getResidual("all", resolution=config["resolution"])
+    fleets = []
+    for i, regionID in enumerate(regionIDs):
+        fleets.append(preprocessing.getFleet(scenario, config, regionID, aggFac=aggFactors[i], seed=seed,
+                                             resolution=config["resolution"]))
+        # Progressbar
+        if verbose:
+            tools.tickProg((i+1)/len(regionIDs))
+    agents = preprocessing.Fleet.concat(fleets)
+
+    if verbose:
+        print("\nData preprocessed!")
+
+    if optimize.grb is None:
+        raise ImportError("gurobipy is not installed! Opt_Exact requires Gurobi.")
+    env = optimize.grb.Env(params={"OutputFlag": int(verbose), "Threads": n_worker})
+    demands, slacks = optimize.optimizeChargingQP(agents=agents, residualLoad=residualLoad,
+                                                  eta=config["chargingEfficiency"],
+                                                  SOCStart=config["SOCStart"],
+                                                  deltaT=tools.getDeltaT(config["resolution"]), env=env)
+    with tools.DBWriter(dbName, verbose=verbose, outputFormat=config["outputFormat"],
+                        resolution=config["resolution"]) as writer:
+        writer.put(agents=agents, demands=demands, slacks=slacks)
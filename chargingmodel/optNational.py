@@ -1,80 +1,253 @@
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Lock, current_process
+import hashlib
+import json
+import os
+import random
+import shutil
+import time
+
+import numpy as np
 
 import chargingmodel.preprocessing as preprocessing
 import chargingmodel.optimize as optimize
 import chargingmodel.tools as tools
-
-# Yield successive n-sized chunks from lst.
-def chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+import chargingmodel.profiling as profiling
+import chargingmodel.reduction as reduction
 
 # Optimize the charging for every region individually.
 # Set n_worker =! 1 to run in parralel batches
 # -> Speed up at the cost of slight errors.
-def run(*, scenario, config, dbName, regionIDs, aggFactors, n_worker, verbose, batchsize=25):
-    # Preprocess data
-    if verbose:
-        print("Processing...")
-        cnt = 0
-
-    residualLoad = preprocessing.getResidual("all")
-    agents = []
-    for i, regionID in enumerate(regionIDs):
-        agents.extend(preprocessing.getAgents(scenario, config, regionID, aggFac=aggFactors[i]))
-        # Progressbar
-        if verbose:
-            cnt += 1
-            tools.tickProg(cnt/len(regionIDs))
-    agents = sorted(agents, key=lambda x: x.capacity)
+# Every config["checkpointInterval"] seconds the completed batches and the residual load are saved
+# with the results (tools.writeCheckpoint).
+# resume: Continue from the checkpoint in dbName. With n_worker = 1 the result is identical to an
+#   uninterrupted run (with more workers the batch order depends on the timing anyway).
+# With config["reductionFactor"] > 1 representative agents are optimized (see reduction).
+# Bounded memory: The workers preprocess the regions and store the agents in the folder [dbName].fleets
+# (see preprocessing.Fleet.save). Only the capacity of every agent is kept here for the global order,
+# the workers load the agents of each batch from the store. The store is rebuilt by every run (also resumed ones)
+# and removed at the end.
+# seed: Random draws per region. Default: Drawn from the global random state.
+def run(*, scenario, config, dbName, regionIDs, aggFactors, n_worker, verbose, batchsize=25, resume=False,
+        seed=None):
+    if seed is None:
+        seed = random.getrandbits(32)
 
-    if verbose:
-        print("\nData preprocessed!")
-    
-    # Create agent batches for parallel computing
-    batches = chunks(agents, batchsize)
+    # Residual load in shared memory. Workers read it, only the parent adds the demands.
+    shm, residualLoad = tools.createSharedArray(preprocessing.getResidual("all", resolution=config["resolution"]))
+    reducer = reduction.fromConfig(config) # Statistics of the workers' reductions
 
     # Create segments if the optimization horizon is not the entire year
     if config["horizon"] == "full":
         segments = False
     else:
-        segments = tools.createSegmentation(config["horizon"])
-
-    # Run in batches
-    queue = Queue()
-    currentWork = []
-    for i, batch in enumerate(batches):
-        kwargs = {"agents": batch, "residualLoad": residualLoad,
-                  "config": config, "queue": queue, "segments": segments}
-        p = Process(target=runBatch, name="Batch_" + str(i),
-                    kwargs=kwargs)
-        currentWork.append(p)
-
-        # Run porcesses, will wait for all to complete
-        if len(currentWork) >= n_worker:
-            results = tools.runProcesses(currentWork, verbose, queue)
-            currentWork = []
-
-            for result in results:
-                tools.saveDB(agents=result[0], demands=result[1], slacks=result[2], dbName=dbName)
-
-            # Update residual load
-            for result in results:
-                for demand in result[1].values():
-                    for t, load in demand.items():
-                        residualLoad[t] += load
-            
-    # Run remaining processes
-    if currentWork:  
-        results = tools.runProcesses(currentWork, verbose, queue)
-
-        for result in results:
-            tools.saveDB(agents=result[0], demands=result[1], slacks=result[2], dbName=dbName)
-
-def runBatch(*, agents, residualLoad, config, queue, segments):   
-    demands, slacks = optimize.optimizeChargingQP_smpl(agents=agents, residualLoad=residualLoad,
-                                                      eta=config["chargingEfficiency"],
-                                                      SOCStart=config["SOCStart"],
-                                                      deltaT=0.25, verbose=False,
-                                                      segments=segments)
-    queue.put((agents, demands, slacks))
\ No newline at end of file
+        segments = tools.createSegmentation(config["horizon"], resolution=config["resolution"])
+    coarse = tools.getCoarseFactor(config)
+
+    # Identifies the run a checkpoint belongs to
+    relevant = {key: value for key, value in config.items() if key != "checkpointInterval"}
+    runKey = hashlib.sha1(json.dumps([scenario, relevant, list(regionIDs), [float(a) for a in aggFactors], batchsize,
+                                      seed], sort_keys=True).encode()).hexdigest()
+
+    # Fleet store. Left over if a run was killed.
+    store = dbName + ".fleets"
+    shutil.rmtree(store, ignore_errors=True)
+    os.makedirs(store)
+
+    # Pool of long-lived workers. They preprocess the regions first, then optimize the batches.
+    tasks, results = Queue(), Queue()
+    lock = Lock() # Guards the shared residual load
+    workers = []
+    kwargs = {"scenario": scenario, "store": store, "seed": seed, "residualName": shm.name,
+              "nTimesteps": len(residualLoad), "config": config, "tasks": tasks, "results": results,
+              "lock": lock, "segments": segments, "coarse": coarse}
+    # Start workers until there are n (at most n_worker)
+    def startWorkers(n):
+        for i in range(len(workers), max(min(n_worker, n), 1)):
+            p = Process(target=runWorker, name="Worker_" + str(i), kwargs=kwargs)
+            p.start()
+            workers.append(p)
+
+    failed = True
+    try:
+        startWorkers(len(regionIDs))
+
+        # Preprocess data
+        if verbose:
+            print("Processing...")
+        for i, regionID in enumerate(regionIDs):
+            tasks.put(("region", i, regionID, aggFactors[i]))
+        capacities = [None] * len(regionIDs)
+        for cnt in range(len(regionIDs)):
+            result = results.get()
+            if isinstance(result, Exception):
+                raise result
+            i, capacities[i], stats, records = result
+            profiling.merge(records)
+            if reducer is not None:
+                reducer.merge(stats)
+            # Progressbar
+            if verbose:
+                tools.tickProg((cnt + 1)/len(regionIDs))
+
+        # Global order by capacity: (region, agent) of every agent
+        regionIdx = np.repeat(np.arange(len(regionIDs)), [len(capacity) for capacity in capacities])
+        agentIdx = np.concatenate([np.arange(len(capacity)) for capacity in capacities] + [np.zeros(0, dtype=int)])
+        order = np.argsort(np.concatenate(capacities + [np.zeros(0)]), kind="stable")
+        regionIdx, agentIdx = regionIdx[order], agentIdx[order]
+        del capacities, order
+
+        if verbose:
+            print("\nData preprocessed!")
+
+        # Create agent batches for parallel computing
+        batches = [(regionIdx[i:i + batchsize], agentIdx[i:i + batchsize]) for i in range(0, len(regionIdx), batchsize)]
+
+        # Resume: Skip the completed batches, continue with their residual load.
+        # Results saved after the checkpoint are deleted and computed again.
+        completed = []
+        if resume:
+            checkpoint = tools.getCheckpoint(dbName)
+            if checkpoint is not None:
+                if checkpoint["runKey"] != runKey:
+                    raise ValueError("Checkpoint belongs to a different run (scenario, config or regions changed)!")
+                completed = checkpoint["batches"].tolist()
+                residualLoad[:] = checkpoint["residualLoad"]
+                done = set(completed)
+                fleets, regionReducer = {}, reduction.fromConfig(config)
+                names = [name for i, batch in enumerate(batches) if i not in done
+                         for name in loadAgents(fleets, regionReducer, store, *batch).name.tolist()]
+                tools.deleteAgents(dbName, names if reducer is None else regionReducer.memberNames(names))
+                del fleets, regionReducer
+                if verbose:
+                    print(f"Resuming: {len(completed)} of {len(batches)} batches completed")
+        done = set(completed)
+        pending = [i for i in range(len(batches)) if i not in done]
+
+        # Run the batches on the workers. More batches than regions -> more workers.
+        startWorkers(len(pending))
+        # A free worker gets the next batch right away, it is optimized against the residual load
+        # including all batches finished so far.
+        nDispatched = 0
+        for _ in range(min(len(workers), len(pending))):
+            tasks.put(("batch", pending[nDispatched], *batches[pending[nDispatched]]))
+            nDispatched += 1
+
+        lastCheckpoint = time.time()
+        with tools.DBWriter(dbName, verbose=verbose, outputFormat=config["outputFormat"],
+                            resolution=config["resolution"], resume=bool(completed)) as writer:
+            for cnt in range(len(pending)):
+                result = results.get()
+                if isinstance(result, Exception):
+                    raise result
+                batchIdx, batch, demands, slacks, rows, stats, records = result
+                profiling.merge(records)
+                if reducer is not None:
+                    reducer.merge(stats)
+
+                # Update residual load
+                with lock:
+                    tools.addDemands(residualLoad, demands)
+                    completed.append(batchIdx)
+                    # Checkpoint
+                    checkpoint = None
+                    if (cnt == len(pending) - 1
+                            or time.time() - lastCheckpoint >= config["checkpointInterval"]):
+                        checkpoint = (runKey, list(completed), np.array(residualLoad))
+                        lastCheckpoint = time.time()
+
+                # Dispatch next batch
+                if nDispatched < len(pending):
+                    tasks.put(("batch", pending[nDispatched], *batches[pending[nDispatched]]))
+                    nDispatched += 1
+
+                # Save (in the background). The loads of representatives are already split between their members.
+                writer.put(agents=batch, demands=demands, slacks=slacks, checkpoint=checkpoint, reduction=rows)
+
+                # Progressbar
+                if verbose:
+                    tools.tickProg((cnt + 1) / len(pending))
+            if verbose:
+                print("\nOptimization done!")
+                if reducer is not None:
+                    print(reducer.summary())
+            if reducer is not None:
+                reducer.checkError()
+        failed = False
+    finally:
+        tools.stopWorkers(workers, [tasks] * len(workers), terminate=failed)
+        del residualLoad
+        shm.close()
+        shm.unlink()
+        shutil.rmtree(store, ignore_errors=True)
+
+# Agents of a batch from the store, in the order of the batch. Loaded regions are kept memory-mapped in fleets.
+# With a reducer the members of the loaded regions are added to it (see reduction.Reduction.load).
+def loadAgents(fleets, reducer, store, regionIdx, agentIdx):
+    regions = np.unique(regionIdx).tolist()
+    for r in regions:
+        if r not in fleets:
+            fleets[r] = preprocessing.Fleet.load(os.path.join(store, str(r)))
+            if reducer is not None:
+                reducer.load(os.path.join(store, f"{r}_reduction"))
+    agents = preprocessing.Fleet.concat([fleets[r][agentIdx[regionIdx == r]] for r in regions])
+    position = np.concatenate([np.flatnonzero(regionIdx == r) for r in regions] + [np.zeros(0, dtype=int)])
+    return agents[np.argsort(position)]
+
+# Worker process: Runs tasks from the task queue until it receives None.
+# ("region", regionIdx, regionID, aggFac): Preprocess a region, save it to the store and return the capacities.
+# ("batch", batchIdx, regionIdx, agentIdx): Optimize a batch of agents.
+# The Gurobi environment is created once per worker.
+def runWorker(*, scenario, store, seed, residualName, nTimesteps, config, tasks, results, lock, segments, coarse=1):
+    shm, sharedResidual = tools.attachSharedArray(residualName, (nTimesteps,))
+    env = None
+    if config["solver"] == "gurobi" and optimize.grb is not None:
+        env = optimize.grb.Env(params={"OutputFlag": 0})
+    reducer = reduction.fromConfig(config) # Members of the loaded regions
+    fleets = {} # Region index -> Fleet (memory-mapped)
+    profiling.collect() # Discard the records inherited from the parent
+    profiler = profiling.startProfile()
+    try:
+        for task in iter(tasks.get, None):
+            try:
+                if task[0] == "region":
+                    _, i, regionID, aggFac = task
+                    agents = preprocessing.getFleet(scenario, config, regionID, aggFac=aggFac, seed=seed,
+                                                    resolution=config["resolution"])
+                    stats = None
+                    if reducer is not None:
+                        regionReducer = reduction.fromConfig(config)
+                        agents = regionReducer.reduce(agents)
+                        regionReducer.save(os.path.join(store, f"{i}_reduction"))
+                        stats = regionReducer.stats
+                    agents.save(os.path.join(store, str(i)))
+                    results.put((i, agents.capacity, stats, profiling.collect()))
+                    continue
+
+                _, batchIdx, regionIdx, agentIdx = task
+                agents = loadAgents(fleets, reducer, store, regionIdx, agentIdx)
+                # Private copy: Agents of this batch are optimized sequentially and update it
+                with lock:
+                    residualLoad = sharedResidual.copy()
+
+                demands, slacks = optimize.optimizeChargingQP_smpl(agents=agents, residualLoad=residualLoad,
+                                                                  eta=config["chargingEfficiency"],
+                                                                  SOCStart=config["SOCStart"],
+                                                                  deltaT=tools.getDeltaT(config["resolution"]),
+                                                                  verbose=False,
+                                                                  segments=segments, solver=config["solver"],
+                                                                  reuse=config["reuseModel"], env=env,
+                                                                  order=config["segmentOrder"], coarse=coarse)
+                rows, stats = None, None
+                if reducer is not None:
+                    agents, demands, slacks, rows = reducer.disaggregate(agents, demands, slacks)
+                    stats = reducer.collect()
+                # Instrumentation records of this batch go to the parent (see profiling)
+                results.put((batchIdx, agents, demands, slacks, rows, stats, profiling.collect()))
+            except Exception as e:
+                results.put(e)
+    finally:
+        profiling.dumpProfile(profiler, current_process().name)
+        if env is not None:
+            env.dispose()
+        del sharedResidual
+        shm.close()
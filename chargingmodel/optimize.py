@@ -1,47 +1,41 @@
-import gurobipy as grb
+import time
+
+import numpy as np
+from scipy import sparse
+try:
+    import gurobipy as grb
+except ImportError:
+    grb = None # Only the native solver is available
 
 import chargingmodel.tools as tools
+import chargingmodel.profiling as profiling
+from chargingmodel.preprocessing import Fleet
 
-# Adapt parking events to the optimization horizon
+# Adapt parking events to the optimization horizon.
+# One list of events per segment (may be empty). Events across segment ends are split, the consumption stays on
+# the last part. Events after the last segment end belong to the last segment.
 def getSegmentEvents(events, segEndings):
-    segEvents, currentSet = [], []
+    segEvents = [[] for _ in segEndings]
     segIdx = 0
-    curSegEnd = segEndings[0]
 
     for event in events:
-        # Normal case
-        if event.stop <= curSegEnd:
-            currentSet.append(event)
+        # Next segment
+        while segIdx < len(segEndings) - 1 and event.start >= segEndings[segIdx]:
+            segIdx += 1
         # Event split between horizonts
-        elif event.start < curSegEnd:
-            # Add first half to current segment
-            currentSet.append(event._replace(stop = curSegEnd, consumption = 0.0))
-
-            # Next Segment
-            segEvents.append(currentSet)
-            currentSet = []
-            segIdx +=1 
-            curSegEnd = segEndings[segIdx]
-
-            # Add later half to new segment
-            currentSet.append(event._replace(start = curSegEnd+1))
-        else:
-            # Next Segment
-            segEvents.append(currentSet)
-            currentSet = []
-            segIdx +=1 
-            curSegEnd = segEndings[segIdx]
-
-            # Add to new segment
-            currentSet.append(event)
+        while segIdx < len(segEndings) - 1 and event.stop > segEndings[segIdx]:
+            segEvents[segIdx].append(event._replace(stop = segEndings[segIdx], consumption = 0.0))
+            event = event._replace(start = segEndings[segIdx])
+            segIdx += 1
+        segEvents[segIdx].append(event)
     return segEvents
 
 # Calculate the slack parameter. Essentially immediate() with less data storing.
 def getSlack(*, agent, events, eBatStart, etaTimesDelta):
     slacks = {}
 
-    # Starting condition
-    eBatCurrently = eBatStart
+    # Starting condition (copy, eBatStart may be a mutable 0-d array)
+    eBatCurrently = float(eBatStart)
     # Simulation loop
     for eventidx, event in enumerate(events):
         # Charge maximum possible
@@ -60,56 +54,248 @@ def getSlack(*, agent, events, eBatStart, etaTimesDelta):
     mxEbatEnd = eBatCurrently
     return slacks, mxEbatEnd
 
-# Define the constraints of one vehicle
-def setAgentConstr(*, model, agent, events, slack, mxEbatEnd, eBatStart, etaTimesDelta, eBatGoal):
-    # Variables
-    eBatPre, pCharge, eBatPost = {}, {}, {}
-
-    # Starting Value
-    eBatPre[0] = eBatStart
-
-    for eventIdx, event in enumerate(events):
-        # Variables
-        # Charging power of EV at time step. Limits: 0 <= pCharge <= P_max[t, car]
-        for t in range(event.start, event.stop):
-            pCharge[t] = model.addVar(ub=event.pMax)
-
-        # Battery energy content before event. Limits: 0 <= eBat <= capacity[car]
-        eBatPre[eventIdx + 1] = model.addVar(ub=agent.capacity)
-
-        # Battery energy content after event. Limits: 0 <= eBat <= capacity[car]
-        eBatPost[eventIdx] = model.addVar(ub=agent.capacity)
-
-        # Constraints
-        # E_bat after charging = E_bat before charging + charged energy
-        model.addLConstr(lhs=grb.quicksum(pCharge[t] for t in range(event.start, event.stop)) * etaTimesDelta + eBatPre[eventIdx],
-                         sense=grb.GRB.EQUAL,
-                         rhs=eBatPost[eventIdx])
-
-        # E_bat after driving = E_bat before driving - consumption + slack
-        model.addLConstr(lhs=eBatPost[eventIdx] - event.consumption + slack[eventIdx],
-                         sense=grb.GRB.EQUAL,
-                         rhs=eBatPre[eventIdx + 1])
+# Time steps of the events and the index of the event of every time step
+def getEventSteps(events):
+    duration = np.array([max(0, event.stop - event.start) for event in events], dtype=int)
+    ts = np.concatenate([np.arange(event.start, event.stop) for event in events] + [np.zeros(0, dtype=int)])
+    return ts, np.repeat(np.arange(len(events)), duration)
+
+# Define the constraints of one vehicle (matrix API)
+# Returns the time steps of the charging power, the charging power (MVar) and the battery energy at the end
+# (0-d MVar, its .X is a 0-d array -> use .X.item()).
+# steps: (ts, eventOfStep, weights) of aggregated time steps, the charging power is the mean of weights time steps.
+#   Default: The time steps of the events (getEventSteps), weight 1.
+def setAgentConstr(*, model, agent, events, slack, mxEbatEnd, eBatStart, etaTimesDelta, eBatGoal, steps=None):
+    nEvents = len(events)
+    if steps is None:
+        ts, eventOfStep = getEventSteps(events)
+        weights = np.ones(len(ts))
+    else:
+        ts, eventOfStep, weights = steps
+    nSteps = len(ts)
+
+    # Variables: x = [pCharge, eBatPre (before event 1..n), eBatPost (after event 0..n-1)]
+    # Charging power of EV at time step. Limits: 0 <= pCharge <= P_max[t, car]
+    # Battery energy content. Limits: 0 <= eBat <= capacity[car]
+    ub = np.concatenate((np.array([event.pMax for event in events])[eventOfStep],
+                         np.full(2 * nEvents, agent.capacity)))
+    lb = np.zeros(nSteps + 2 * nEvents)
     # Time window energy constraint
-    boundEbatEnd = min(mxEbatEnd, eBatGoal)
-    model.addLConstr(lhs=boundEbatEnd, sense=grb.GRB.LESS_EQUAL, rhs=eBatPre[len(events)])
-    return pCharge, eBatPre[len(events)]
-
-# Full quadratic program
-def optimizeChargingQP(*, agents, residualLoad, eta, SOCStart, deltaT):
-    # Repeated calculations
-    etaTimesDelta = eta * deltaT
-
-    # Solution
-    nTimesteps = len(residualLoad)
-    demands = {agent.name: {} for agent in agents}
-    slacks = {agent.name: 0 for agent in agents}
-
-    # Optimization
-    env = grb.Env()
-    # Init model
+    lb[nSteps + nEvents - 1] = min(mxEbatEnd, eBatGoal)
+    x = model.addMVar(nSteps + 2 * nEvents, lb=lb, ub=ub)
+
+    # Constraints
+    steps = sparse.csr_matrix((etaTimesDelta * weights, (eventOfStep, np.arange(nSteps))), shape=(nEvents, nSteps))
+    eye = sparse.identity(nEvents, format="csr")
+    # E_bat after charging = E_bat before charging + charged energy
+    charging = sparse.hstack((steps, sparse.eye(nEvents, k=-1), -eye))
+    rhsCharging = np.zeros(nEvents)
+    rhsCharging[0] = -eBatStart
+    # E_bat after driving = E_bat before driving - consumption + slack
+    driving = sparse.hstack((sparse.csr_matrix((nEvents, nSteps)), -eye, eye))
+    rhsDriving = np.array([event.consumption - slack[eventIdx] for eventIdx, event in enumerate(events)])
+    model.addMConstr(sparse.vstack((charging, driving), format="csr"), x, grb.GRB.EQUAL,
+                     np.concatenate((rhsCharging, rhsDriving)))
+    return ts, x[:nSteps], x[nSteps + nEvents - 1]
+
+# Charged energy if every time step is filled up to the given water level.
+# weights: Number of time steps per entry (aggregated time steps, see solveAgentCoarse). Default: 1.
+def chargedEnergy(level, resid, pMax, etaTimesDelta, weights=None):
+    if weights is None:
+        return etaTimesDelta * np.clip(level - resid, 0, pMax).sum()
+    return etaTimesDelta * (weights * np.clip(level - resid, 0, pMax)).sum()
+
+# Invert chargedEnergy() exactly. The charged energy is piecewise linear in the water level
+# with breakpoints at resid and resid + pMax.
+# upper == False: Lowest level that charges at least target.
+# upper == True: Highest level that charges at most target.
+def getLevel(resid, pMax, etaTimesDelta, target, upper, weights=None):
+    mask = pMax > 0
+    x = np.concatenate((resid[mask], resid[mask] + pMax[mask]))
+    w = np.ones(mask.sum()) if weights is None else weights[mask]
+    if upper and target >= etaTimesDelta * (w * pMax[mask]).sum():
+        return np.inf
+    if not upper and target <= 0:
+        return -np.inf
+    if len(x) == 0:
+        return -np.inf
+
+    # Charged energy at every breakpoint
+    dSlope = np.concatenate((w, -w)) * etaTimesDelta
+    order = np.argsort(x)
+    x, slope = x[order], np.cumsum(dSlope[order])
+    energy = np.concatenate(([0.0], np.cumsum(slope[:-1] * np.diff(x))))
+
+    # Numerical noise can push the target slightly outside of the feasible range
+    target = min(max(target, 0.0), energy[-1])
+    idx = np.searchsorted(energy, target, side="right" if upper else "left")
+    if idx == 0:
+        return x[0]
+    if idx == len(x):
+        return x[-1]
+    return x[idx - 1] + (target - energy[idx - 1]) / slope[idx - 1]
+
+# Solve the QP of one vehicle without Gurobi.
+# Without the battery constraints the optimal schedule fills the residual load to a common water level.
+# The battery constraints bound the cumulative charged energy after every event (a tube).
+# The water level may only change at events where the cumulative energy touches the tube (taut string).
+# Same interface as setAgentConstr, but returns the solution instead of model variables.
+# residualLoad: Float array, as for all per agent solvers (converted once by optimizeChargingQP_smpl).
+def solveAgentNative(*, agent, events, slack, mxEbatEnd, eBatStart, etaTimesDelta, eBatGoal, residualLoad):
+    nEvents = len(events)
+    if nEvents == 0:
+        return {}, eBatStart
+
+    # Time steps and power limits of all events in one array
+    offsets = np.zeros(nEvents + 1, dtype=int)
+    offsets[1:] = np.cumsum([max(0, event.stop - event.start) for event in events])
+    ts = np.concatenate([np.arange(event.start, event.stop) for event in events])
+    resid = residualLoad[ts]
+    pMax = np.concatenate([np.full(max(0, event.stop - event.start), event.pMax, dtype=float) for event in events])
+
+    netCons, lower, upper = getEnergyBounds(agent=agent, events=events, slack=slack, mxEbatEnd=mxEbatEnd,
+                                            eBatStart=eBatStart, eBatGoal=eBatGoal)
+    levels = getLevels(offsets=offsets, resid=resid, pMax=pMax, lower=lower, upper=upper, etaTimesDelta=etaTimesDelta)
+
+    # Charging power
+    p = np.clip(np.repeat(levels, np.diff(offsets)) - resid, 0, pMax)
+    endEBat = eBatStart + etaTimesDelta * p.sum() - netCons[-1]
+    return dict(zip(ts.tolist(), p.tolist())), endEBat
+
+# Net consumption until the end of every event and the bounds of the cumulative charged energy after every event
+def getEnergyBounds(*, agent, events, slack, mxEbatEnd, eBatStart, eBatGoal):
+    netCons = np.cumsum([event.consumption - slack[eventIdx] for eventIdx, event in enumerate(events)])
+    lower = netCons - eBatStart # E_bat after driving >= 0
+    lower[-1] = netCons[-1] + min(mxEbatEnd, eBatGoal) - eBatStart # Time window energy constraint
+    upper = agent.capacity - eBatStart + np.concatenate(([0.0], netCons[:-1])) # E_bat after charging <= capacity
+    return netCons, lower, upper
+
+# Water level of every event (taut string, see solveAgentNative).
+# offsets: Index of the first time step of every event in resid and pMax (+ the end).
+def getLevels(*, offsets, resid, pMax, lower, upper, etaTimesDelta, weights=None):
+    nEvents = len(offsets) - 1
+    if weights is None:
+        stepWeights = lambda i, k: None
+    else:
+        stepWeights = lambda i, k: weights[offsets[i]:offsets[k+1]]
+    levels = np.empty(nEvents)
+    base = 0.0 # Charged energy before the current stretch
+    i = 0
+    while i < nEvents:
+        lowLevel, lowIdx = -np.inf, i
+        upLevel, upIdx = np.inf, i
+        for k in range(i, nEvents):
+            segResid, segPMax = resid[offsets[i]:offsets[k+1]], pMax[offsets[i]:offsets[k+1]]
+            segWeights = stepWeights(i, k)
+            # Only invert if the current level range does not already satisfy event k
+            a = -np.inf
+            if chargedEnergy(lowLevel, segResid, segPMax, etaTimesDelta, segWeights) < lower[k] - base:
+                a = getLevel(segResid, segPMax, etaTimesDelta, lower[k] - base, upper=False, weights=segWeights)
+            b = np.inf
+            if chargedEnergy(upLevel, segResid, segPMax, etaTimesDelta, segWeights) > upper[k] - base:
+                b = getLevel(segResid, segPMax, etaTimesDelta, upper[k] - base, upper=True, weights=segWeights)
+            # Battery full at upIdx
+            if a > upLevel:
+                level, stop = upLevel, upIdx
+                break
+            # Battery empty at lowIdx
+            if b < lowLevel:
+                level, stop = lowLevel, lowIdx
+                break
+            if a >= lowLevel:
+                lowLevel, lowIdx = a, k
+            if b <= upLevel:
+                upLevel, upIdx = b, k
+        else:
+            # Unconstrained optimum is level 0 -> (residual + p) = 0
+            if lowLevel > 0:
+                level, stop = lowLevel, lowIdx
+            elif upLevel < 0:
+                level, stop = upLevel, upIdx
+            else:
+                level, stop = 0.0, nEvents - 1
+        levels[i:stop+1] = level
+        base += chargedEnergy(level, resid[offsets[i]:offsets[stop+1]], pMax[offsets[i]:offsets[stop+1]], etaTimesDelta,
+                              stepWeights(i, stop))
+        i = stop + 1
+    return levels
+
+# Two stage solve of the QP of one vehicle (see optimizeChargingQP_smpl, coarse):
+# 1. Coarse: The time steps of every event are aggregated to blocks of factor time steps, the charging power
+#    is constant within a block. -> About factor times fewer variables.
+# 2. Fine: The charged energy of every event is fixed to the coarse solution and distributed within the event
+#    at full resolution (water filling, closed form). The battery constraints only depend on the energy per event.
+# Approximation: Energy can not move between events compared to the coarse solution.
+def solveAgentCoarse(*, factor, solver, env, agent, events, slack, mxEbatEnd, eBatStart, etaTimesDelta, eBatGoal,
+                     residualLoad, timing=None):
+    nEvents = len(events)
+    if nEvents == 0:
+        return {}, eBatStart
+    ts, eventOfStep = getEventSteps(events)
+    resid = residualLoad[ts]
+    eventPMax = np.array([event.pMax for event in events], dtype=float)
+    netCons, lower, upper = getEnergyBounds(agent=agent, events=events, slack=slack, mxEbatEnd=mxEbatEnd,
+                                            eBatStart=eBatStart, eBatGoal=eBatGoal)
+
+    # Blocks: Time steps of an event within the same interval of factor time steps
+    energy = np.zeros(nEvents)
+    if len(ts) > 0:
+        block = ts // factor
+        first = np.ones(len(ts), dtype=bool)
+        first[1:] = (np.diff(block) != 0) | (np.diff(eventOfStep) != 0)
+        starts = np.nonzero(first)[0]
+        weights = np.diff(np.append(starts, len(ts))).astype(float)
+        blockEvent = eventOfStep[starts]
+        blockResid = np.add.reduceat(resid, starts) / weights # Mean residual load of the time steps
+        blockPMax = eventPMax[blockEvent]
+
+        # Coarse solve
+        if solver == "native":
+            with profiling.timer("solve"):
+                offsets = np.searchsorted(blockEvent, np.arange(nEvents + 1))
+                levels = getLevels(offsets=offsets, resid=blockResid, pMax=blockPMax, lower=lower, upper=upper,
+                                   etaTimesDelta=etaTimesDelta, weights=weights)
+                pBlock = np.clip(np.repeat(levels, np.diff(offsets)) - blockResid, 0, blockPMax)
+        else:
+            st = time.time()
+            model = grb.Model(env=env)
+            _, pCharge, _ = setAgentConstr(model=model, agent=agent, events=events, slack=slack, mxEbatEnd=mxEbatEnd,
+                                           eBatStart=eBatStart, etaTimesDelta=etaTimesDelta, eBatGoal=eBatGoal,
+                                           steps=(block[starts], blockEvent, weights))
+            # Objective: sum(weights * (pCharge^2 + 2 * mean residual * pCharge))
+            model.setMObjective(Q=sparse.diags(weights), c=2 * weights * blockResid, constant=0.0,
+                                xQ_L=pCharge, xQ_R=pCharge, xc=pCharge, sense=grb.GRB.MINIMIZE)
+            model.update()
+            solveStart = time.time()
+            model.optimize()
+            checkStatus(model, agent)
+            solveEnd = time.time()
+            if timing is not None:
+                timing["build"] += solveStart - st
+                timing["solve"] += solveEnd - solveStart
+            addTimes(agent, model, st, solveStart, solveEnd)
+            pBlock = np.clip(pCharge.X, 0, blockPMax)
+        energy = np.bincount(blockEvent, weights=etaTimesDelta * weights * pBlock, minlength=nEvents)
+
+    # Fine solve: Water filling per event
+    with profiling.timer("fine"):
+        offsets = np.searchsorted(eventOfStep, np.arange(nEvents + 1))
+        p = np.zeros(len(ts))
+        for eventIdx in np.nonzero(energy > 0)[0].tolist():
+            i, j = offsets[eventIdx], offsets[eventIdx + 1]
+            pMax = np.full(j - i, eventPMax[eventIdx])
+            level = getLevel(resid[i:j], pMax, etaTimesDelta, energy[eventIdx], upper=False)
+            p[i:j] = np.clip(level - resid[i:j], 0, pMax)
+    endEBat = eBatStart + etaTimesDelta * p.sum() - netCons[-1]
+    return dict(zip(ts.tolist(), p.tolist())), endEBat
+
+# Full quadratic program.
+# One aggregate load variable per time step: load[t] = sum of pCharge[t] of all agents.
+# -> Diagonal objective sum(load^2 + 2 * residual * load) with O(T) quadratic terms instead of O(T * N^2).
+def buildChargingQP(*, env, agents, residualLoad, etaTimesDelta, SOCStart):
+    residualLoad = np.asarray(residualLoad, dtype=float)
     model = grb.Model(env=env)
-    pCharge = {}
+    pCharge, slacks = {}, {}
     for agent in agents:
         # Starting SOC
         eBatStart = SOCStart * agent.capacity
@@ -118,47 +304,84 @@ def optimizeChargingQP(*, agents, residualLoad, eta, SOCStart, deltaT):
         slacks[agent.name] = sum(slack.values())
 
         # Model bounds and constraints
-        pChargeAgent, _ = setAgentConstr(model=model, agent=agent, events=agent.events, slack=slack,
-                                         mxEbatEnd=mxEbatEnd, eBatStart=eBatStart, etaTimesDelta=etaTimesDelta,
-                                         eBatGoal=eBatStart)
-
-        # Add pCharge var to set of fleet
-        for t in range(nTimesteps):
-            pCharge[t, agent.name] = pChargeAgent.get(t, 0)
+        ts, pChargeAgent, _ = setAgentConstr(model=model, agent=agent, events=agent.events, slack=slack,
+                                             mxEbatEnd=mxEbatEnd, eBatStart=eBatStart, etaTimesDelta=etaTimesDelta,
+                                             eBatGoal=eBatStart)
+        pCharge[agent.name] = (ts, pChargeAgent)
+
+    # Aggregate load, only time steps at which any agent can charge
+    allTs = np.concatenate([ts for ts, _ in pCharge.values()] + [np.zeros(0, dtype=int)])
+    fleetTs, fleetIdx = np.unique(allTs, return_inverse=True)
+    load = model.addMVar(len(fleetTs))
+
+    # load - sum(pCharge) = 0
+    if len(allTs) > 0:
+        toFleet = sparse.csr_matrix((-np.ones(len(allTs)), (fleetIdx, np.arange(len(allTs)))),
+                                    shape=(len(fleetTs), len(allTs)))
+        model.addMConstr(sparse.hstack((sparse.identity(len(fleetTs)), toFleet), format="csr"),
+                         grb.hstack([load] + [p for _, p in pCharge.values()]), grb.GRB.EQUAL,
+                         np.zeros(len(fleetTs)))
 
     # Objective
-    linCoefs = [2 * i for i in residualLoad]
-    objective = grb.QuadExpr()
-    for agent in agents:
-        for event in agent.events:
-            for t in range(event.start, event.stop):
-                objective.addTerms(linCoefs[t], pCharge[t, agent.name])
-    objective.add(grb.quicksum(grb.quicksum(pCharge[t, agent.name] for agent in agents)*grb.quicksum(pCharge[t, agent.name] for agent in agents) for t in range(nTimesteps)))
-    model.ModelSense = grb.GRB.MINIMIZE
-    model.setObjective(objective)
+    model.setMObjective(Q=sparse.identity(len(fleetTs)), c=2 * residualLoad[fleetTs], constant=0.0,
+                        xQ_L=load, xQ_R=load, xc=load, sense=grb.GRB.MINIMIZE)
+    return model, pCharge, slacks
+
+def optimizeChargingQP(*, agents, residualLoad, eta, SOCStart, deltaT, env=None):
+    # Repeated calculations
+    etaTimesDelta = eta * deltaT
+
+    # Fleet -> Agent tuples
+    agents = list(agents)
+
+    # Optimization
+    if grb is None:
+        raise ImportError("gurobipy is not installed! The full quadratic program requires Gurobi.")
+    if env is None:
+        env = grb.Env()
+    with profiling.timer("build"):
+        model, pCharge, slacks = buildChargingQP(env=env, agents=agents, residualLoad=residualLoad,
+                                                 etaTimesDelta=etaTimesDelta, SOCStart=SOCStart)
+        model.update()
 
     # Calculation
-    model.optimize()
+    with profiling.timer("solve"):
+        model.optimize()
+    profiling.addSolve(None, model)
 
     # Solution
     if model.status == 13:
-        print(f"Solution suboptimal! Agent ID: {agent.name}")
+        print("Solution suboptimal!")
     elif model.status > 2:
         raise AssertionError(f"Model terminated! Status: {model.status}")
-    
+
     # Solution
-    for agent in agents:
-        for event in agent.events:
-            for t in range(event.start, event.stop):
-                p = pCharge[t, agent.name].X
+    demands = {agent.name: {} for agent in agents}
+    with profiling.timer("extract"):
+        for agent in agents:
+            ts, pChargeAgent = pCharge[agent.name]
+            for t, p in zip(ts.tolist(), pChargeAgent.X.tolist()):
                 if p > 0:
                     demands[agent.name][t] = p
     return demands, slacks
 
 # Approximation see paper
-def optimizeChargingQP_smpl(*, agents, residualLoad, eta, SOCStart, deltaT, segments=False, verbose=True):
+# solver: "gurobi" or "native" (water filling, see solveAgentNative)
+# reuse: Gurobi only. Update one model template in place instead of building a model per segment (see ModelTemplate).
+# env: Gurobi only. Environment to build the models in, e.g. one per worker process. Default: A new one.
+# order: "agent": Agent by agent, every agent through all of its segments.
+#        "segment": Segment by segment (rolling horizon), all agents per segment. The SOC is carried forward.
+# coarse: > 1: Two stage solve on blocks of coarse time steps, then per event at full resolution (see solveAgentCoarse).
+#   Faster, approximate. reuse is ignored.
+def optimizeChargingQP_smpl(*, agents, residualLoad, eta, SOCStart, deltaT, segments=False, verbose=True, solver="gurobi",
+                            reuse=False, env=None, order="agent", coarse=1):
     # Repeated calculations
     etaTimesDelta = eta * deltaT
+    # Once for all solver paths. Updated in place with the demand of every optimized agent.
+    residualLoad = np.asarray(residualLoad, dtype=float)
+
+    # Fleet -> Agent tuples
+    agents = list(agents)
 
     # Solution
     demands = {agent.name: {} for agent in agents}
@@ -170,108 +393,296 @@ def optimizeChargingQP_smpl(*, agents, residualLoad, eta, SOCStart, deltaT, segm
 
     # Optimization
     cnt = 0 # For progressbar
-    env = grb.Env(params={"OutputFlag": 0})
-
-    for agent in agents:
-        # Starting SOC
-        eBatStart = SOCStart * agent.capacity
-        # End SOC of every horizon
-        eBatGoal = eBatStart
-
-        # Segment events
-        if segments == False:
-            segEvents = [agent.events]
+    if solver == "gurobi":
+        if grb is None:
+            raise ImportError("gurobipy is not installed! Use solver='native' instead.")
+        if env is None:
+            env = grb.Env(params={"OutputFlag": 0})
+        templates = {} # Window length -> ModelTemplate
+        timing = {"build": 0.0, "solve": 0.0}
+    elif solver == "native":
+        timing = None
+    else:
+        raise ValueError(f"Solver: {solver} unknown!")
+
+    # Solve one segment of an agent. Returns the charging power and the SOC at the end.
+    def solveSegment(agent, events, eBatStart, eBatGoal):
+        if not events:
+            return {}, eBatStart
+
+        # Get minimal slack
+        slack, mxEbatEnd = getSlack(agent=agent, events=events, eBatStart=eBatStart, etaTimesDelta=etaTimesDelta)
+        slacks[agent.name] += sum(slack.values())
+
+        kwargs = {"agent": agent, "events": events, "slack": slack, "mxEbatEnd": mxEbatEnd, "eBatStart": eBatStart,
+                  "etaTimesDelta": etaTimesDelta, "eBatGoal": eBatGoal, "residualLoad": residualLoad}
+        if coarse > 1:
+            pCharge, eBatEnd = solveAgentCoarse(factor=coarse, solver=solver, env=env, timing=timing, **kwargs)
+        elif solver == "native":
+            with profiling.timer("solve"):
+                pCharge, eBatEnd = solveAgentNative(**kwargs)
+        elif reuse:
+            pCharge, eBatEnd = solveAgentTemplate(templates=templates, env=env, timing=timing, **kwargs)
         else:
-            segEvents = getSegmentEvents(agent.events, segments)
-        for events in segEvents:
-            # Init model
-            model = grb.Model(env=env)
+            pCharge, eBatEnd = solveAgentGurobi(env=env, timing=timing, **kwargs)
+
+        # Solution
+        for t, p in pCharge.items():
+            if p > 0:
+                demands[agent.name][t] = p
+        return pCharge, eBatEnd
+
+    # Segment events
+    if segments == False:
+        segEvents = {agent.name: [agent.events] for agent in agents}
+    else:
+        segEvents = {agent.name: getSegmentEvents(agent.events, segments) for agent in agents}
+
+    if order == "agent":
+        for agent in agents:
+            # Starting SOC
+            eBatStart = SOCStart * agent.capacity
+            # End SOC of every horizon
+            eBatGoal = eBatStart
+
+            for events in segEvents[agent.name]:
+                pCharge, eBatStart = solveSegment(agent, events, eBatStart, eBatGoal)
+
+                # Update residual load
+                for t, p in pCharge.items():
+                    if p > 0:
+                        residualLoad[t] += p
+
+            # Progressbar
+            if verbose:
+                cnt += 1
+                tools.tickProg(cnt/len(agents))
+    elif order == "segment":
+        # SOC carried forward from segment to segment
+        eBat = {agent.name: SOCStart * agent.capacity for agent in agents}
+        nSegments = max((len(agentSegEvents) for agentSegEvents in segEvents.values()), default=0)
+        for segIdx in range(nSegments):
+            for agent in agents:
+                if segIdx >= len(segEvents[agent.name]):
+                    continue
+                pCharge, eBat[agent.name] = solveSegment(agent, segEvents[agent.name][segIdx], eBat[agent.name],
+                                                         SOCStart * agent.capacity)
+
+                # Update residual load
+                for t, p in pCharge.items():
+                    if p > 0:
+                        residualLoad[t] += p
 
-            # Get minimal slack
-            slack, mxEbatEnd = getSlack(agent=agent, events=events, eBatStart=eBatStart, etaTimesDelta=etaTimesDelta)
-            slacks[agent.name] += sum(slack.values())
-
-            # Model bounds and constraints
-            pCharge, endEBat = setAgentConstr(model=model, agent=agent, events=events, slack=slack, mxEbatEnd=mxEbatEnd,
-                                              eBatStart=eBatStart, etaTimesDelta=etaTimesDelta, eBatGoal=eBatGoal)
-
-            # Objective
-            linCoefs = [2 * i for i in residualLoad]
-            objective = grb.QuadExpr()
-            ts = []
-            for event in events:
-                for t in range(event.start, event.stop):
-                    objective.addTerms(linCoefs[t], pCharge[t])
-                    ts.append(t)
-            objective.add(grb.quicksum(pCharge[t]*pCharge[t] for t in ts))
-            model.ModelSense = grb.GRB.MINIMIZE
-            model.setObjective(objective)
-
-            # Calculation
-            model.optimize()
+            # Progressbar
+            if verbose:
+                tools.tickProg((segIdx + 1)/nSegments)
+    else:
+        raise ValueError(f"Order: {order} unknown!")
 
-            # Check Success
-            if model.status == 13:
-                print(f"Solution suboptimal! Agent ID: {agent.name}")
-            elif model.status > 2:
-                raise AssertionError(f"Model terminated! Status: {model.status}, Agent ID: {agent.name}")
-            
-            # Solution
-            for event in events:
-                for t in range(event.start, event.stop):
-                    p = pCharge[t].X
-                    if p > 0:
-                        demands[agent.name][t] = p
+    if verbose and solver == "gurobi":
+        print(f"\nModel build: {timing['build']:.2f} secs, solve: {timing['solve']:.2f} secs")
+    return demands, slacks
 
-            # Update residual load
-            for t, p in demands[agent.name].items():
-                residualLoad[t] += p
+# Solve the QP of one vehicle with Gurobi. Returns the charging power and the SOC at the end.
+def solveAgentGurobi(*, env, agent, events, slack, mxEbatEnd, eBatStart, etaTimesDelta, eBatGoal, residualLoad,
+                     timing=None):
+    st = time.time()
+    # Init model
+    model = grb.Model(env=env)
 
-            # End SOC
-            eBatStart = endEBat.X
+    # Model bounds and constraints
+    ts, pCharge, endEBat = setAgentConstr(model=model, agent=agent, events=events, slack=slack, mxEbatEnd=mxEbatEnd,
+                                          eBatStart=eBatStart, etaTimesDelta=etaTimesDelta, eBatGoal=eBatGoal)
 
-        # Progressbar
-        if verbose:
-            cnt += 1
-            tools.tickProg(cnt/len(agents))
+    # Objective: sum(pCharge^2 + 2 * residual * pCharge)
+    model.setMObjective(Q=sparse.identity(len(ts)), c=2 * residualLoad[ts], constant=0.0,
+                        xQ_L=pCharge, xQ_R=pCharge, xc=pCharge, sense=grb.GRB.MINIMIZE)
 
-    return demands, slacks
+    # Calculation
+    model.update()
+    solveStart = time.time()
+    model.optimize()
+    checkStatus(model, agent)
+    solveEnd = time.time()
+    if timing is not None:
+        timing["build"] += solveStart - st
+        timing["solve"] += solveEnd - solveStart
+    addTimes(agent, model, st, solveStart, solveEnd)
+
+    # Solution
+    solution = dict(zip(ts.tolist(), pCharge.X.tolist())), endEBat.X.item()
+    profiling.add("extract", time.time() - solveEnd)
+    return solution
+
+# Build and solve time and statistics of a Gurobi solve (see profiling)
+def addTimes(agent, model, st, solveStart, solveEnd):
+    profiling.add("build", solveStart - st)
+    profiling.add("solve", solveEnd - solveStart)
+    profiling.addSolve(agent.name, model)
+
+# Check Success
+def checkStatus(model, agent):
+    if model.status == 13:
+        print(f"Solution suboptimal! Agent ID: {agent.name}")
+    elif model.status > 2:
+        raise AssertionError(f"Model terminated! Status: {model.status}, Agent ID: {agent.name}")
+
+# Structural template of the QP of one vehicle for a window of nSteps time steps.
+# Formulated per time step instead of per event:
+#   e[i+1] = e[i] + etaTimesDelta * p[i] - d[i],  0 <= e <= capacity,  0 <= p <= pMax
+# d[i] is the consumption (minus slack) after the last time step of an event.
+# The events only determine bounds, right hand sides and objective coefficients. So one model per
+# window length can be updated in place for every segment and agent. Gurobi keeps the basis of the
+# previous solve for the modified model -> warm start.
+# Window lengths are rounded up to multiples of stepsPerTemplate to share templates. Padding steps are idle.
+class ModelTemplate:
+    stepsPerTemplate = 96
+
+    def __init__(self, env, nSteps, etaTimesDelta):
+        self.nSteps = nSteps
+        self.model = grb.Model(env=env)
+        # Simplex: Warm start from the previous basis. (Barrier can not be warm started.)
+        self.model.Params.Method = 1
+        x = self.model.addMVar(2 * nSteps + 1)
+        self.p, self.e = x[:nSteps], x[nSteps:]
+        # e[i+1] - e[i] - etaTimesDelta * p[i] = -d[i]
+        balance = sparse.hstack((-etaTimesDelta * sparse.identity(nSteps),
+                                 sparse.eye(nSteps, nSteps + 1, k=1) - sparse.eye(nSteps, nSteps + 1)))
+        self.balance = self.model.addMConstr(balance.tocsr(), x, grb.GRB.EQUAL, np.zeros(nSteps))
+        self.model.setMObjective(Q=sparse.identity(nSteps), c=None, constant=0.0,
+                                 xQ_L=self.p, xQ_R=self.p, sense=grb.GRB.MINIMIZE)
+
+    # Returns the charging power of all event time steps and the SOC at the end
+    def solve(self, *, agent, events, slack, mxEbatEnd, eBatStart, eBatGoal, residualLoad, offset, timing=None):
+        st = time.time()
+        pMax = np.zeros(self.nSteps)
+        cons = np.zeros(self.nSteps)
+        ts = []
+        last = 0 # Time step (index) of the last consumption. Index 0 is a dummy step without charging.
+        for eventIdx, event in enumerate(events):
+            if event.stop > event.start:
+                pMax[event.start - offset:event.stop - offset] = event.pMax
+                ts.extend(range(event.start, event.stop))
+                last = event.stop - 1 - offset
+            cons[last] += event.consumption - slack[eventIdx]
+
+        # Bounds, right hand sides and objective
+        eUB = agent.capacity - cons # E_bat after charging <= capacity
+        eLB = np.zeros(self.nSteps + 1)
+        eLB[0] = eBatStart
+        eLB[-1] = min(mxEbatEnd, eBatGoal) # Time window energy constraint
+        self.p.UB = pMax
+        self.e.LB = eLB
+        self.e.UB = np.concatenate(([eBatStart], np.maximum(eUB, 0)))
+        self.balance.RHS = -cons
+        linCoefs = np.zeros(self.nSteps) # Index 0: Dummy step
+        resid = residualLoad[offset + 1:offset + self.nSteps]
+        linCoefs[1:len(resid) + 1] = 2 * resid
+        self.p.Obj = linCoefs
+
+        # Calculation
+        self.model.update()
+        solveStart = time.time()
+        self.model.optimize()
+        checkStatus(self.model, agent)
+        solveEnd = time.time()
+        if timing is not None:
+            timing["build"] += solveStart - st
+            timing["solve"] += solveEnd - solveStart
+        addTimes(agent, self.model, st, solveStart, solveEnd)
+
+        # Solution
+        p = self.p.X
+        solution = {t: p[t - offset] for t in ts}, self.e.X[-1].item()
+        profiling.add("extract", time.time() - solveEnd)
+        return solution
+
+# solveAgentGurobi() with a reused ModelTemplate
+def solveAgentTemplate(*, templates, env, agent, events, slack, mxEbatEnd, eBatStart, etaTimesDelta, eBatGoal,
+                       residualLoad, timing=None):
+    st = time.time()
+    nonEmpty = [event for event in events if event.stop > event.start]
+    if not nonEmpty:
+        return {}, max(eBatStart - sum(event.consumption - slack[i] for i, event in enumerate(events)), 0)
+    # Window with one leading dummy step
+    offset = nonEmpty[0].start - 1
+    nSteps = max(event.stop for event in nonEmpty) - offset
+    nSteps = -(-nSteps // ModelTemplate.stepsPerTemplate) * ModelTemplate.stepsPerTemplate
+    if nSteps not in templates:
+        templates[nSteps] = ModelTemplate(env, nSteps, etaTimesDelta)
+    if timing is not None:
+        timing["build"] += time.time() - st
+    profiling.add("build", time.time() - st, calls=0)
+    return templates[nSteps].solve(agent=agent, events=events, slack=slack, mxEbatEnd=mxEbatEnd, eBatStart=eBatStart,
+                                   eBatGoal=eBatGoal, residualLoad=residualLoad, offset=offset, timing=timing)
 
 # Uncontrolled charging
+# Every event charges at full power until the battery is full (closed form).
+# Vectorized over all agents: Only the SOC chain from one event to the next is a loop.
 def immediate(*, agents, eta, SOCStart, deltaT, verbose=True):
     # Repeated calculations -> Energy to power
     etaTimesDelta = deltaT * eta
 
     # Solution
-    demands = {agent.name: {} for agent in agents}
-    slacks = {agent.name: 0 for agent in agents}
-
-    cnt = 0 # For progressbar
-    for agent in agents:
-        # Starting condition
-        eBatCurrently = agent.capacity * SOCStart
-
-        # Simulation loop
-        for event in agent.events:
-            pMAx = event.pMax
-            
-            for t in range(event.start, event.stop):
-                # Charge maximum possible
-                eCharge = max(0, min(pMAx * etaTimesDelta, agent.capacity - eBatCurrently))
-                # Charged energy to battery
-                eBatCurrently += eCharge
-                # Remember power
-                if eCharge > 0:
-                    demands[agent.name][t] = eCharge / etaTimesDelta
-            # Consumption between charging events
-            eBatCurrently -= event.consumption
-            # Slack
-            if eBatCurrently < 0:
-                slacks[agent.name] += abs(eBatCurrently)
-                eBatCurrently = 0
+    if isinstance(agents, Fleet):
+        names = agents.name.tolist()
+    else:
+        names = [agent.name for agent in agents]
+    demands = {name: {} for name in names}
+    slacks = {name: 0 for name in names}
+    if not names:
+        return demands, slacks
+
+    # Events of all agents as flat arrays
+    fleet = agents if isinstance(agents, Fleet) else Fleet.fromAgents(agents)
+    nEvents, offsets = fleet.nEvents, fleet.offsets
+    start, stop = fleet.start.astype(int), fleet.stop.astype(int)
+    consumption, pMax, capacity = fleet.consumption, fleet.pMax, fleet.capacity
+    duration = np.maximum(stop - start, 0)
+
+    # Simulation loop over the n-th event of every agent
+    eCharge = np.zeros(len(start))
+    eBatCurrently = capacity * SOCStart
+    slack = np.zeros(len(agents))
+    for n in range(nEvents.max()):
+        active = np.nonzero(nEvents > n)[0]
+        idx = offsets[active] + n
+        # Charge maximum possible
+        eCharge[idx] = np.maximum(0, np.minimum(pMax[idx] * etaTimesDelta * duration[idx],
+                                                capacity[active] - eBatCurrently[active]))
+        # Charged energy to battery, consumption between charging events
+        eBatCurrently[active] += eCharge[idx] - consumption[idx]
+        # Slack
+        empty = active[eBatCurrently[active] < 0]
+        slack[empty] -= eBatCurrently[empty]
+        eBatCurrently[empty] = 0
 
         # Progressbar
         if verbose:
-            cnt += 1
-            tools.tickProg(cnt/len(agents))
+            tools.tickProg((n+1)/nEvents.max())
+
+    # Charging profile: Full power for nFull time steps and the remainder in the next one
+    eStep = pMax * etaTimesDelta
+    charging = eCharge > 0
+    nFull = np.zeros(len(start), dtype=int)
+    nFull[charging] = np.minimum(np.floor(eCharge[charging] / eStep[charging]).astype(int), duration[charging])
+    remainder = np.where(nFull < duration, eCharge - nFull * eStep, 0)
+
+    # Time steps of the full power phase
+    eventIdx = np.repeat(np.arange(len(start)), nFull)
+    ts = start[eventIdx] + np.arange(len(eventIdx)) - np.repeat(np.cumsum(nFull) - nFull, nFull)
+    power = (eStep / etaTimesDelta)[eventIdx]
+    # Partial time step
+    partial = np.nonzero(remainder > 0)[0]
+    eventIdx = np.concatenate((eventIdx, partial))
+    ts = np.concatenate((ts, start[partial] + nFull[partial]))
+    power = np.concatenate((power, remainder[partial] / etaTimesDelta))
+
+    # Remember power
+    agentIdx = np.searchsorted(offsets, eventIdx, side="right") - 1
+    order = np.lexsort((ts, agentIdx))
+    for a, t, p in zip(agentIdx[order].tolist(), ts[order].tolist(), power[order].tolist()):
+        demands[names[a]][t] = p
+    for name, s in zip(names, slack.tolist()):
+        slacks[name] = s
     return demands, slacks
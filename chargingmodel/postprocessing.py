@@ -1,58 +1,77 @@
-import sys
 import pandas as pd
+import numpy as np
 import sqlite3
-import os
 
-def processRegionalLoad(dbName):
-    dirname = os.path.dirname(__file__)
-    regionData = pd.read_csv(os.path.join(dirname,"input/regions.csv"), sep=";")
-    regionIDs = regionData["ID"].values
+import chargingmodel.tools as tools
+
+def hasTable(c, table):
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table, ))
+    return c.fetchone() is not None
 
-    # For progressbar
-    cnt = 0
-    length = len(regionIDs)
-    prog_per_it = 40 / length
+# Charging load of every region from the dense output (table Profiles).
+# Streams the profiles once and accumulates them per region.
+def accumulateProfiles(c):
+    loads = {}
+    c.execute("""SELECT Region, Data
+                 FROM Profiles
+                 INNER JOIN Agents on Agents.AgentID = Profiles.AgentID""")
+    while True:
+        rows = c.fetchmany(1000)
+        if not rows:
+            break
+        for region, data in rows:
+            profile = tools.decodeProfile(data)
+            if region in loads:
+                loads[region] += profile
+            else:
+                loads[region] = profile
+    return loads
 
+# Aggregated charging load of every region (table Regions).
+# One pass over the output: GROUP BY Region, Time on the sparse output,
+# NumPy accumulation if only the dense output exists.
+def processRegionalLoad(dbName):
     conn = sqlite3.connect(dbName)
     c = conn.cursor()
+    tools.createLoadTable(c, "Regions")
 
-    c.execute("DROP TABLE IF EXISTS Regions")
-    c.execute("""CREATE TABLE IF NOT EXISTS Regions (
-        Time timestamp,
-        Type text,
-        PowerMW real
-    ) """)
-
-    for regionID in regionIDs:
+    c.execute("SELECT EXISTS (SELECT 1 FROM TimeSeries)")
+    if c.fetchone()[0] or not hasTable(c, "Profiles"):
         c.execute("""INSERT INTO Regions (Time, PowerMW, Type)
             Select Time, SUM(PowerMW), Region
             From TimeSeries
             INNER JOIN Agents on Agents.AgentID = TimeSeries.AgentID
-            Where Region = (?)
-            GROUP BY Time""", (regionID, ))
-        conn.commit()
-        # Progressbar
-        cnt += 1
-        prog = int(cnt * prog_per_it)
-        sys.stdout.write("\r[%-40s] %d%%" % ('=' * prog, 2.5 * prog))
-        sys.stdout.flush()
+            GROUP BY Region, Time""")
+    else:
+        c.execute("""SELECT *
+                     FROM Simulation""")
+        t = c.fetchone()
+        timeCol = tools.getTimeCol(pd.Timestamp(t[0]), pd.Timestamp(t[1]), t[2])
+        for region, load in accumulateProfiles(c).items():
+            # Like the sparse output: Only time steps with charging
+            idx = np.flatnonzero(load > 0)
+            c.executemany("INSERT INTO Regions (Time, PowerMW, Type) VALUES (?, ?, ?)",
+                          ((timeCol[i], p, region) for i, p in zip(idx.tolist(), load[idx].tolist())))
 
+    conn.commit()
     conn.close()
 
+# Aggregated charging load of all regions (table Total).
+# Derived from the table Regions, which is created first if missing.
 def processTotalLoad(dbName):
     conn = sqlite3.connect(dbName)
     c = conn.cursor()
+    regionsMissing = not hasTable(c, "Regions")
+    conn.close()
+    if regionsMissing:
+        processRegionalLoad(dbName)
 
-    c.execute("DROP TABLE IF EXISTS Total")
-    c.execute("""CREATE TABLE IF NOT EXISTS Total (
-        Time timestamp,
-        Type text,
-        PowerMW real
-    ) """)
-
+    conn = sqlite3.connect(dbName)
+    c = conn.cursor()
+    tools.createLoadTable(c, "Total")
     c.execute("""INSERT INTO Total (Time, PowerMW, Type)
         Select Time, SUM(PowerMW), 'Total'
-        FROM TimeSeries
+        FROM Regions
         GROUP BY Time """)
 
     conn.commit()
@@ -77,4 +96,40 @@ def getProcessed(dbName, region="Total"):
     _df = pd.read_sql(sql, conn, index_col="Time", parse_dates="Time").reindex(index).fillna(0)
     
     conn.close()
-    return _df
\ No newline at end of file
+    return _df
+
+# Charging profiles of agents from the dense output (outputFormat "dense" or "both").
+# Returns the AgentIDs and an array (agent x time step) in MW.
+# agentIDs: Selected through a temporary table (any number of agents, no limit of bound variables).
+def getProfileArray(dbName, agentIDs=None):
+    conn = sqlite3.connect(dbName)
+    c = conn.cursor()
+    if agentIDs is None:
+        c.execute("SELECT AgentID, Data FROM Profiles ORDER BY AgentIdx")
+        rows = c.fetchall()
+    else:
+        c.execute("CREATE TEMP TABLE Selected (AgentID text PRIMARY KEY)")
+        c.executemany("INSERT OR IGNORE INTO Selected VALUES (?)", [(agentID, ) for agentID in agentIDs])
+        c.execute("""SELECT AgentID, Data
+                     FROM Profiles
+                     WHERE AgentID IN (SELECT AgentID FROM Selected)""")
+        rows = dict(c.fetchall())
+        rows = [(agentID, rows[agentID]) for agentID in agentIDs]
+    conn.close()
+
+    names = [row[0] for row in rows]
+    profiles = np.array([tools.decodeProfile(row[1]) for row in rows]).reshape(len(rows), -1)
+    return names, profiles
+
+# Same as getProfileArray() as DataFrame: Time x AgentID
+def getProfiles(dbName, agentIDs=None):
+    conn = sqlite3.connect(dbName)
+    c = conn.cursor()
+    c.execute("""SELECT *
+                 FROM Simulation""")
+    t = c.fetchone()
+    conn.close()
+    index = pd.date_range(start=t[0], end=t[1], freq=t[2], inclusive="left")
+
+    names, profiles = getProfileArray(dbName, agentIDs)
+    return pd.DataFrame(profiles.T, index=index, columns=names)
@@ -1,15 +1,21 @@
 import random
+import hashlib
+import json
+import glob
 from datetime import datetime as dt
 from enum import Enum
 from typing import NamedTuple, List
 import math
 import os
+import time
 from os import listdir
 from os.path import isfile, join
 
 import pandas as pd
 import numpy as np
 
+import chargingmodel.profiling as profiling
+
 # Data structures
 class Location(Enum):
     HOME = "home"
@@ -34,25 +40,201 @@ class Agent(NamedTuple):
     evseGroup: int
     regionID: int
 
-def getResidual(regionID, startDate=dt(2030, 1, 1), endDate=dt(2031, 1, 1)):
-    directory = os.path.join(os.path.dirname(__file__), "input/residual-load")
+# Columnar storage of many agents (struct of arrays).
+# The events of agent i are stored at offsets[i]:offsets[i+1] of the event arrays.
+# Cheap to slice and to pickle. Integer indexing and iteration return Agent tuples,
+# so functions written for Agent (getSlack, setAgentConstr, saveDB, ...) accept a Fleet directly.
+class Fleet:
+    eventFields = ("start", "stop", "consumption", "pMax", "purpose")
+    agentFields = ("name", "model", "aggFac", "capacity", "evseGroup", "regionID")
+    dtypes = {"start": np.int32, "stop": np.int32, "consumption": np.float64, "pMax": np.float64,
+              "purpose": np.int8, "name": str, "model": str, "aggFac": np.float64,
+              "capacity": np.float64, "evseGroup": np.int16, "regionID": str}
+
+    def __init__(self, *, offsets, **columns):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        for field in self.eventFields + self.agentFields:
+            setattr(self, field, np.asarray(columns[field], dtype=self.dtypes[field]))
+
+    @classmethod
+    def fromAgents(cls, agents):
+        agents = list(agents)
+        columns = {field: [getattr(event, field) for agent in agents for event in agent.events]
+                   for field in cls.eventFields}
+        columns.update({field: [getattr(agent, field) for agent in agents] for field in cls.agentFields})
+        offsets = np.concatenate(([0], np.cumsum([len(agent.events) for agent in agents])))
+        return cls(offsets=offsets, **columns)
+
+    @classmethod
+    def concat(cls, fleets):
+        fleets = list(fleets)
+        if not fleets:
+            return cls.fromAgents([])
+        columns = {field: np.concatenate([getattr(fleet, field) for fleet in fleets])
+                   for field in cls.eventFields + cls.agentFields}
+        offsets = np.concatenate(([0], np.cumsum(np.concatenate([fleet.nEvents for fleet in fleets]))))
+        return cls(offsets=offsets, **columns)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        # Single agent
+        if isinstance(key, (int, np.integer)):
+            return self.getAgent(int(key))
+        # Subset of agents: slice, index array or boolean mask
+        idx = np.arange(len(self))[key]
+        nEvents = self.nEvents[idx]
+        eventIdx = (np.repeat(self.offsets[idx] - np.cumsum(nEvents) + nEvents, nEvents)
+                    + np.arange(nEvents.sum()))
+        columns = {field: getattr(self, field)[eventIdx] for field in self.eventFields}
+        columns.update({field: getattr(self, field)[idx] for field in self.agentFields})
+        return Fleet(offsets=np.concatenate(([0], np.cumsum(nEvents))), **columns)
+
+    @property
+    def nEvents(self):
+        return np.diff(self.offsets)
+
+    # Events of one agent as Event tuples
+    def getEvents(self, i):
+        window = slice(self.offsets[i], self.offsets[i+1])
+        return [Event(*values) for values in zip(*(getattr(self, field)[window].tolist()
+                                                   for field in self.eventFields))]
+
+    def getAgent(self, i):
+        if i < 0:
+            i += len(self)
+        return Agent(name=str(self.name[i]), model=str(self.model[i]), events=self.getEvents(i),
+                     aggFac=float(self.aggFac[i]), capacity=float(self.capacity[i]),
+                     evseGroup=int(self.evseGroup[i]), regionID=str(self.regionID[i]))
+
+    def byRegion(self, regionID):
+        return self[self.regionID == str(regionID)]
+
+    # Successive n-sized batches
+    def batches(self, n):
+        for i in range(0, len(self), n):
+            yield self[i:i + n]
+
+    # Store the columns as .npy files in a folder. load() maps them into memory -> Subsets only read their part.
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for field in ("offsets", ) + self.eventFields + self.agentFields:
+            np.save(os.path.join(path, f"{field}.npy"), getattr(self, field))
+
+    @classmethod
+    def load(cls, path):
+        return cls(**{field: np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r")
+                      for field in ("offsets", ) + cls.eventFields + cls.agentFields})
+
+# Persistent cache of parsed inputs.
+# Stored as .npy in a ".cache" folder next to the input file. Loaded memory-mapped.
+# Key: Content hash of the file and the parsing parameters (time window, resolution).
+# Up to maxCached entries per input file, the least recently used are removed. Entries of a changed file are
+# never used again and removed the same way -> invalidation is automatic.
+maxCached = 8
+
+def loadCached(path, params, parse, cache=True):
+    if not cache:
+        with profiling.timer("parse"):
+            return parse(path)
+
+    # Key
+    sha = hashlib.sha1()
+    hashFile(path, sha)
+    sha.update(repr(params).encode())
+    key = sha.hexdigest()[:16]
+
+    directory = os.path.join(os.path.dirname(path), ".cache")
+    stem = os.path.splitext(os.path.basename(path))[0]
+    fn = os.path.join(directory, f"{stem}.{key}.npy")
+    if isfile(fn):
+        try:
+            os.utime(fn) # Recently used
+        except OSError:
+            pass
+        return np.load(fn, mmap_mode="r")
+
+    with profiling.timer("parse"):
+        data = parse(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        entries = glob.glob(os.path.join(glob.escape(directory), glob.escape(stem) + ".*.npy"))
+        for old in sorted(entries, key=os.path.getmtime)[:max(len(entries) - maxCached + 1, 0)]:
+            os.remove(old)
+        # Write to a temporary file first. Other processes might read the same entry.
+        tmp = f"{fn}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp, fn)
+    except OSError:
+        pass # Read-only input -> no caching
+    return data
+
+def hashFile(path, sha):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+
+# Config keys the results of the region-independent strategies depend on.
+# Not included: Iteration limits and checkpointing of Opt_National, fleetsize (-> aggFac).
+hashKeys = {
+    "Uncontrolled": ("chargingEfficiency", "SOCStart", "resolution", "outputFormat", "eVModels",
+                     "sensiAdjCap", "sensiAdjP", "sensiAdjCons", "sensiAdjFS"),
+}
+hashKeys["Opt_County"] = hashKeys["Uncontrolled"] + ("horizon", "solver", "reuseModel", "segmentOrder",
+                                                      "coarseResolution", "reductionFactor", "reductionResolution")
+
+# Content hash of everything the result of one region depends on (incremental runs, see run.py):
+# Behavior and residual load input, relevant config keys (of the chosen scenario only), aggregation factor and seed.
+def getRegionHash(scenario, strategy, config, regionID, aggFac, seed):
+    dirname = os.path.dirname(__file__)
+    sha = hashlib.sha1()
+    for path in (f"input/behavior/{regionID}.csv", f"input/residual-load/{regionID}.csv"):
+        path = os.path.join(dirname, path)
+        if isfile(path):
+            hashFile(path, sha)
+    relevant = {key: config.get(key) for key in hashKeys[strategy]}
+    relevant["scenario"] = config["scenarios"][scenario]
+    sha.update(json.dumps([scenario, strategy, relevant, float(aggFac), seed], sort_keys=True).encode())
+    return sha.hexdigest()
+
+def parseResidual(path, startDate, endDate, resolution="15T"):
+    df = pd.read_csv(path, sep=";", parse_dates=["TimeStamp"], index_col="TimeStamp")
+    residualLoad = df.loc[slice(startDate, endDate), :].iloc[:, 0] # pylint: disable=no-member
+    # Drop last value if datetime end was in df
+    if endDate in df.index: # pylint: disable=no-member
+        residualLoad = residualLoad.iloc[:-1]
+
+    # Resample if the input has another resolution: Mean power of every time step
+    index = pd.date_range(startDate, endDate, inclusive="left", freq=resolution)
+    if not residualLoad.index.equals(index):
+        residualLoad = residualLoad.resample(resolution, origin=startDate).mean().reindex(index).ffill()
+    return residualLoad.values
+
+# inputDir: Directory with the input tables. Default: chargingmodel/input
+# resolution: Time step of the model. Other resolutions than the input's are resampled.
+def getResidual(regionID, startDate=dt(2030, 1, 1), endDate=dt(2031, 1, 1), cache=True, inputDir=None,
+                resolution="15T"):
+    directory = os.path.join(inputDir or os.path.join(os.path.dirname(__file__), "input"), "residual-load")
     if regionID == "all":
         fns = [f for f in listdir(directory) if isfile(join(directory, f))]
     else:
         fns = [regionID + ".csv"]
     
-    timeWindow = slice(startDate, endDate)
     residualLoad = None
     for fn in fns:
-        df = pd.read_csv(directory + "/" + fn, sep=";", parse_dates=["TimeStamp"], index_col="TimeStamp")
+        values = loadCached(join(directory, fn), (startDate, endDate, resolution),
+                            lambda path: parseResidual(path, startDate, endDate, resolution), cache=cache)
         if residualLoad is None:
-            residualLoad = df.loc[timeWindow, :].values # pylint: disable=no-member
+            residualLoad = np.array(values)
         else:
-            residualLoad += df.loc[timeWindow, :].values # pylint: disable=no-member
-    # Drop last value if datetime end was in df
-    if endDate in df.index: # pylint: disable=no-member
-        residualLoad = residualLoad[:-1]
-    return list(residualLoad.reshape(-1))
+            residualLoad += values
+    return list(residualLoad)
 
 def getEVModel(N, shares, models):
     # Create a distribution of models
@@ -100,82 +282,106 @@ def getEVSEGroup(N, shares):
                 break
     return groups
 
-def getPMax(loc, evseConfig, evseGroup, pMaxEV=None):
+# Maximum charging power of many events.
+# locs: Location.value of each event, evseGroups: EVSE group of each event's agent.
+# Public charging is random. Drawn in event order -> same random stream as one draw per event.
+def getPMax(locs, evseConfig, evseGroups, pMaxEV=None):
+    locs = np.asarray(locs)
+    pMax = np.zeros(len(locs))
+
     # Public charging
-    if loc == Location.PUBLIC:
-        conf = evseConfig["public"]
-        # Probabilities: [No station found, slow station, fast station]
-        probs = [1 - conf["prob"], conf["prob"]*conf["slow"]["share"],
-                 conf["prob"]*conf["fast"]["share"]]
-        # Charging rates
-        chrgRates = [0.0, conf["slow"]["power"], conf["fast"]["power"]]
-        if abs(sum(probs) - 1) > 1e-6: 
-            raise ValueError("Probabilities don't add up!")
-        # Power at station
-        pMax = random.choices(chrgRates, weights=probs)[0]
-    else:
-        groups = evseConfig["privat"]
-        # Charging rate
-        pMax = groups[evseGroup][loc.value]
+    public = locs == Location.PUBLIC.value
+    conf = evseConfig["public"]
+    # Probabilities: [No station found, slow station, fast station]
+    probs = [1 - conf["prob"], conf["prob"]*conf["slow"]["share"],
+             conf["prob"]*conf["fast"]["share"]]
+    # Charging rates
+    chrgRates = np.array([0.0, conf["slow"]["power"], conf["fast"]["power"]], dtype=float)
+    if abs(sum(probs) - 1) > 1e-6: 
+        raise ValueError("Probabilities don't add up!")
+    # Power at station. Same as random.choices(chrgRates, weights=probs) for every event.
+    cumProbs = np.cumsum(probs)
+    draws = np.array([random.random() for _ in range(public.sum())]) * cumProbs[-1]
+    pMax[public] = chrgRates[np.searchsorted(cumProbs[:-1], draws, side="right")]
+
+    # Charging rate at home and work
+    groups = evseConfig["privat"]
+    evseGroups = np.asarray(evseGroups, dtype=int)
+    for loc in (Location.HOME, Location.WORK):
+        rates = np.array([group[loc.value] for group in groups], dtype=float)
+        mask = locs == loc.value
+        pMax[mask] = rates[evseGroups[mask]]
     
     # Maximum is charging rate of EV
     if pMaxEV is not None:
-        pMax = min(pMaxEV, pMax)
+        pMax = np.minimum(pMaxEV, pMax)
     return pMax
 
-# Turn trips into parking events
-def getEvents(carData, aggFac, evseConfig, evseGroup, endInt, config, consumption, pMaxEV=None):
-    mapPurpLoc = {0: Location.WORK, 1: Location.PUBLIC, 2: Location.PUBLIC, 3: Location.PUBLIC, 4: Location.PUBLIC,
-                  5: Location.PUBLIC, 6: Location.PUBLIC, 7: Location.HOME, 8: Location.HOME, 9: Location.PUBLIC}
-
-    # Get events
-    events = []
-    savedCons = 0
-    lastTimestep = 0
-    currentLoc = Location.HOME # Start condition
-    currentPurp = 7 # Same as above
-    for dep, arr, purp, cons in zip(carData["Departure"],
-                                    carData["Arrival"],
-                                    carData["Purpose"],
-                                    consumption):
-        # Parking event happens in an instant -> save consumption and continue
-        if lastTimestep == dep:
-            savedCons += cons
-            continue
-        
-        # Maximum charging rate at event
-        pMaxEvent = getPMax(currentLoc, evseConfig, evseGroup, pMaxEV=pMaxEV) * config["sensiAdjP"]
-
-        # Parking event
-        events.append(Event(lastTimestep, dep, (cons + savedCons) * aggFac * config["sensiAdjCons"],
-                            pMaxEvent * aggFac, currentPurp))
-
-        # Loop memory
-        lastTimestep = arr
-        currentLoc = mapPurpLoc[purp]
-        currentPurp = purp
-        savedCons = 0
-    
+# Turn trips into parking events. All vehicles at once.
+# Trips have to be sorted by vehicle (agentIdx) and time.
+# Returns the event offsets of every agent, the agent of every event and the event columns
+# (start, stop, consumption in kWh, purpose). The charging power depends on the scenario (see getPMax).
+def getEvents(agentIdx, departure, arrival, purpose, consumption, nAgents, endInt):
+    nTrips = len(agentIdx)
+    pos = np.arange(nTrips)
+    vehicleStart = np.maximum.accumulate(np.where(np.r_[True, agentIdx[1:] != agentIdx[:-1]], pos, 0))
+
+    # Parking event happens in an instant -> save consumption and continue.
+    # Whether a trip is merged depends on the last kept trip. Start by assuming the previous trip is kept
+    # and iterate until stable. Only chains of instant parking events need more than one iteration.
+    merged = np.zeros(nTrips, dtype=bool)
+    while True:
+        lastKept = np.maximum.accumulate(np.where(~merged, pos, -1))
+        prevKept = np.r_[-1, lastKept[:-1]]
+        prevKept[prevKept < vehicleStart] = -1 # Start condition of every vehicle
+        lastTimestep = np.where(prevKept >= 0, arrival[prevKept], 0)
+        newMerged = departure == lastTimestep
+        if (newMerged == merged).all():
+            break
+        merged = newMerged
+    kept = np.nonzero(~merged)[0]
+
+    # Saved consumption is added to the next kept trip of the same vehicle
+    savedCons = np.zeros(nTrips)
+    nextKept = np.searchsorted(kept, pos[merged])
+    valid = nextKept < len(kept)
+    valid[valid] = agentIdx[kept[nextKept[valid]]] == agentIdx[merged][valid]
+    np.add.at(savedCons, kept[nextKept[valid]], consumption[merged][valid])
+
+    # Parking events before each kept trip
+    currentPurp = np.where(prevKept >= 0, purpose[np.maximum(prevKept, 0)], 7) # Start condition: Home
+    evAgent = agentIdx[kept]
+    evStart, evStop = lastTimestep[kept], departure[kept]
+    evCons, evPurp = consumption[kept] + savedCons[kept], currentPurp[kept]
+
     # From last event to end of year
-    pMaxEvent = getPMax(currentLoc, evseConfig, evseGroup, pMaxEV=pMaxEV) * config["sensiAdjP"]
-    events.append(Event(lastTimestep, endInt, 0.0, pMaxEvent * aggFac, currentPurp))
-    return events
+    lastTrip = np.full(nAgents, -1)
+    np.maximum.at(lastTrip, evAgent, kept)
+    hasTrip = lastTrip >= 0
+    finStart = np.where(hasTrip, arrival[np.maximum(lastTrip, 0)], 0)
+    finPurp = np.where(hasTrip, purpose[np.maximum(lastTrip, 0)], 7)
 
-def getAgents(scenario, config, regionID, startDate=dt(2030, 1, 1), endDate=dt(2031, 1, 1), resolution="15T", aggFac=1):
-    # Container for all optimization relevant data of one vehicle.
-    # Output: All units in MW or MWh (kW creates numerical problems).
+    # Merge and order by agent
+    evAgent = np.concatenate((evAgent, np.arange(nAgents)))
+    order = np.argsort(evAgent, kind="stable")
+    evAgent = evAgent[order]
+    evStart = np.concatenate((evStart, finStart))[order]
+    evStop = np.concatenate((evStop, np.full(nAgents, endInt)))[order]
+    evCons = np.concatenate((evCons, np.zeros(nAgents)))[order]
+    evPurp = np.concatenate((evPurp, finPurp))[order]
 
-    # Load behavior data
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(evAgent, minlength=nAgents))))
+    columns = {"start": evStart, "stop": evStop, "consumption": evCons, "purpose": evPurp}
+    return offsets, evAgent, columns
+
+# Container for all optimization relevant data of the vehicles of one region.
+# Output: All units in MW or MWh (kW creates numerical problems).
+def parseBehavior(path, startDate, resolution):
     usecols = ["Departure", "Arrival", "Purpose", "Vehicle_id",
                "MeanSpeed [km/h]", "Temperature [deg_C]", "Distance [km]"]
-    dirname = os.path.dirname(__file__)
-    pathBehave =  os.path.join(dirname, f"input/behavior/{regionID}.csv")
-    dfBehave = pd.read_csv(pathBehave, sep=";", parse_dates=["Departure", "Arrival"],
+    dfBehave = pd.read_csv(path, sep=";", parse_dates=["Departure", "Arrival"],
                            usecols=usecols)
 
-    # Aggregation Factor
-    aggFac *= config["sensiAdjFS"]
-
     # Convert time to integers for faster indexing
     res_in_secs = int(pd.to_timedelta(resolution).total_seconds())
     def idxToInt(x):
@@ -183,49 +389,106 @@ def getAgents(scenario, config, regionID, startDate=dt(2030, 1, 1), endDate=dt(2
         return y
     dfBehave["Departure"] = idxToInt(dfBehave["Departure"])
     dfBehave["Arrival"] = idxToInt(dfBehave["Arrival"])
+    return dfBehave.to_records(index=False)
+
+# Location of each trip purpose
+mapPurpLoc = {0: Location.WORK, 1: Location.PUBLIC, 2: Location.PUBLIC, 3: Location.PUBLIC, 4: Location.PUBLIC,
+              5: Location.PUBLIC, 6: Location.PUBLIC, 7: Location.HOME, 8: Location.HOME, 9: Location.PUBLIC}
+
+# Scenario independent part of the fleet of one region: Vehicles, EV models and parking events.
+# Only depends on the behavior data and the EV models. Scenarios and sensitivities are applied in getFleet().
+# Memoized per process -> A sweep over scenarios and sensitivities (see sweep.py) builds it once per region.
+fleetBases = {}
+
+def getFleetBase(config, regionID, startDate=dt(2030, 1, 1), endDate=dt(2031, 1, 1), resolution="15T", cache=True,
+                 inputDir=None):
+    inputDir = inputDir or os.path.join(os.path.dirname(__file__), "input")
+    key = (regionID, startDate, endDate, resolution, repr(config["eVModels"]), inputDir)
+    if key in fleetBases:
+        return fleetBases[key]
+
+    # Load behavior data
+    pathBehave =  os.path.join(inputDir, f"behavior/{regionID}.csv")
+    dfBehave = pd.DataFrame(loadCached(pathBehave, (startDate, endDate, resolution),
+                                       lambda path: parseBehavior(path, startDate, resolution), cache=cache))
+    st = time.perf_counter()
+
+    res_in_secs = int(pd.to_timedelta(resolution).total_seconds())
     endInt = int(round((endDate - startDate).total_seconds() / res_in_secs)) 
 
     # IDs
-    agentIDs = sorted(dfBehave["Vehicle_id"].unique())
+    agentIDs = np.array(sorted(dfBehave["Vehicle_id"].unique()))
+
+    # EV-Models
+    evConfig = config["eVModels"]
+    models = np.array(getEVModel(len(agentIDs), [i['share'] for i in evConfig.values()], [i for i in evConfig.keys()]))
+
+    # Trips of one EV after another
+    dfBehave = dfBehave.sort_values("Vehicle_id", kind="stable")
+
+    # Cut events not in time window
+    dfBehave = dfBehave[(dfBehave.Departure >= 0) & (dfBehave.Arrival < endInt)]
+    vehicleIDs = dfBehave["Vehicle_id"].values
+    agentIdx = np.searchsorted(agentIDs, vehicleIDs)
+
+    # Calc consumption for each EV model
+    consumption = np.empty(len(dfBehave))
+    tripModels = models[vehicleIDs]
+    for modelID in evConfig:
+        mask = tripModels == modelID
+        consumption[mask] = calcConsumption(dfBehave['MeanSpeed [km/h]'].values[mask],
+                                            dfBehave['Temperature [deg_C]'].values[mask],
+                                            dfBehave['Distance [km]'].values[mask],
+                                            evConfig[modelID])
+
+    # Events
+    offsets, evAgent, columns = getEvents(agentIdx, dfBehave["Departure"].values, dfBehave["Arrival"].values,
+                                          dfBehave["Purpose"].values, consumption, len(agentIDs), endInt)
+    # Location of every event
+    columns["loc"] = np.array([mapPurpLoc[p].value for p in range(max(mapPurpLoc) + 1)])[columns["purpose"]]
+
+    base = {"agentIDs": agentIDs, "models": models, "offsets": offsets, "evAgent": evAgent, **columns}
+    fleetBases[key] = base
+    profiling.add("events", time.perf_counter() - st)
+    return base
+
+# seed: Seed the random draws with the seed and the regionID -> the region does not depend on the regions before
+# inputDir: Directory with the input tables. Default: chargingmodel/input
+def getFleet(scenario, config, regionID, startDate=dt(2030, 1, 1), endDate=dt(2031, 1, 1), resolution="15T", aggFac=1,
+             cache=True, seed=None, inputDir=None):
+    base = getFleetBase(config, regionID, startDate, endDate, resolution, cache=cache, inputDir=inputDir)
+    st = time.perf_counter()
+    if seed is not None:
+        random.seed(f"{seed}_{regionID}")
+    agentIDs, models, evAgent = base["agentIDs"], base["models"], base["evAgent"]
+
+    # Aggregation Factor
+    aggFac *= config["sensiAdjFS"]
 
     # EVSE groups
     evseConfig = config["scenarios"][scenario]
-    evseGroups = getEVSEGroup(len(agentIDs), [i["share"] for i in evseConfig["privat"]])
+    evseGroups = np.array(getEVSEGroup(len(agentIDs), [i["share"] for i in evseConfig["privat"]]))
 
-    # EV-Models
+    # Maximum charging rate at event
+    pMaxEvent = getPMax(base["loc"], evseConfig, evseGroups[agentIDs][evAgent]) * config["sensiAdjP"]
+
+    # Parameter
     evConfig = config["eVModels"]
-    models = getEVModel(len(agentIDs), [i['share'] for i in evConfig.values()], [i for i in evConfig.keys()])
-
-    # Get agents
-    agents = []
-    for agentID in agentIDs:
-        # Data of one EV
-        carData = dfBehave[dfBehave["Vehicle_id"] == agentID]
-        
-        # ID
-        modelID = models[agentID]
-
-        # Cut events not in time window
-        carData = carData[(carData.Departure >= 0) & (carData.Arrival < endInt)]
-
-        # Calc consumption
-        consumption = calcConsumption(carData['MeanSpeed [km/h]'].values,
-                                      carData['Temperature [deg_C]'].values,
-                                      carData['Distance [km]'].values,
-                                      config['eVModels'][modelID])
-
-        # Parameter
-        capacity = config["eVModels"][modelID]["capacity_kWh"] * config["sensiAdjCap"]
-        evseGroup = evseGroups[agentID]
-
-        # Events
-        events = getEvents(carData, aggFac / 1000, evseConfig, evseGroup, endInt, config, consumption)
-
-        agent = Agent(name=regionID+"_"+f'{agentID:02}', events=events, model=modelID,
-                      aggFac=aggFac, capacity=capacity * aggFac / 1000,
-                      evseGroup=evseGroup, regionID=regionID)
-        agents.append(agent)
-    return agents
+    capacity = np.array([evConfig[modelID]["capacity_kWh"] for modelID in models[agentIDs]]) * config["sensiAdjCap"]
+
+    fleet = Fleet(offsets=base["offsets"], start=base["start"], stop=base["stop"],
+                  consumption=base["consumption"] * (aggFac / 1000) * config["sensiAdjCons"],
+                  pMax=pMaxEvent * (aggFac / 1000), purpose=base["purpose"],
+                  name=[regionID + "_" + f'{agentID:02}' for agentID in agentIDs.tolist()],
+                  model=models[agentIDs], aggFac=np.full(len(agentIDs), aggFac),
+                  capacity=capacity * aggFac / 1000, evseGroup=evseGroups[agentIDs],
+                  regionID=np.full(len(agentIDs), regionID))
+    profiling.add("fleet", time.perf_counter() - st)
+    return fleet
+
+# Same as getFleet() but as a list of Agent tuples
+def getAgents(scenario, config, regionID, **kwargs):
+    return list(getFleet(scenario, config, regionID, **kwargs))
 
 def calcConsumption(meanSpeed, temperature, distance, model):
     # Normal consumption
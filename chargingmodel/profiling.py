@@ -0,0 +1,123 @@
+import cProfile
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Instrumentation of the hot paths (see run.py --profile).
+# Per-stage timers and the statistics of every Gurobi solve of this process, saved in the table Profiling.
+# Stages: parse (csv), events (fleet base), fleet (scenario), immediate, build, solve, extract (solution), write (DB).
+# Off by default -> timer(), add() and addSolve() return immediately.
+# Worker processes inherit the state (fork) and return their records with collect(), the parent adds them with merge().
+enabled = False
+cprofilePath = None # cProfile output, see profile()
+stages = {} # Stage -> [calls, secs]
+solves = [] # (AgentID, variables, constraints, iterations, runtime, status)
+lock = threading.Lock() # The DBWriter thread records too
+
+def enable(on=True, *, cprofile=None):
+    global enabled, cprofilePath
+    enabled = on
+    cprofilePath = cprofile if on else None
+    collect()
+
+@contextmanager
+def timer(stage):
+    if not enabled:
+        yield
+        return
+    st = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(stage, time.perf_counter() - st)
+
+def add(stage, secs, calls=1):
+    if not enabled:
+        return
+    with lock:
+        if stage not in stages:
+            stages[stage] = [0, 0.0]
+        stages[stage][0] += calls
+        stages[stage][1] += secs
+
+# Statistics of a solved Gurobi model
+def addSolve(agentID, model):
+    if not enabled:
+        return
+    with lock:
+        solves.append((agentID, model.NumVars, model.NumConstrs, int(model.IterCount) + model.BarIterCount,
+                       model.Runtime, model.Status))
+
+# Records of this process since the last call (reset)
+def collect():
+    global stages, solves
+    with lock:
+        records = (stages, solves)
+        stages, solves = {}, []
+    return records
+
+def merge(records):
+    if not enabled or records is None:
+        return
+    for stage, (calls, secs) in records[0].items():
+        add(stage, secs, calls)
+    with lock:
+        solves.extend(records[1])
+
+# cProfile of the block if enabled with cprofile=path. Dumped to path (name="main") or path.name (workers).
+# Read with: python -m pstats path
+@contextmanager
+def profile(name="main"):
+    profiler = startProfile()
+    try:
+        yield
+    finally:
+        dumpProfile(profiler, name)
+
+def startProfile():
+    if cprofilePath is None:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def dumpProfile(profiler, name="main"):
+    if profiler is None:
+        return
+    profiler.disable()
+    profiler.dump_stats(cprofilePath if name == "main" else f"{cprofilePath}.{name}")
+
+# Table Profiling: One row per stage (AgentID NULL) and one per Gurobi solve (Stage "gurobi").
+# runID: Identifies the run of the rows (several runs can write to the same database, see run.py).
+def write(dbName, runID=None):
+    conn = sqlite3.connect(dbName)
+    with conn:
+        c = conn.cursor()
+        c.execute("""CREATE TABLE IF NOT EXISTS Profiling (
+            RunID text,
+            Stage text,
+            AgentID text,
+            Calls integer,
+            Secs real,
+            Vars integer,
+            Constrs integer,
+            Iterations integer,
+            Status integer
+        ) """)
+        c.executemany("INSERT INTO Profiling (RunID, Stage, Calls, Secs) VALUES (?, ?, ?, ?)",
+                      [(runID, stage, calls, secs) for stage, (calls, secs) in stages.items()])
+        c.executemany("""INSERT INTO Profiling (RunID, Stage, AgentID, Calls, Secs, Vars, Constrs, Iterations, Status)
+                      VALUES (?, 'gurobi', ?, 1, ?, ?, ?, ?, ?)""",
+                      [(runID, agentID, runtime, nVars, nConstrs, iterations, status)
+                       for agentID, nVars, nConstrs, iterations, runtime, status in solves])
+    conn.close()
+
+# Stage timings as text, slowest first
+def summary():
+    lines = [f"{stage}: {secs:.2f} secs ({calls} calls)"
+             for stage, (calls, secs) in sorted(stages.items(), key=lambda x: -x[1][1])]
+    if solves:
+        lines.append(f"gurobi: {len(solves)} solves, {sum(s[3] for s in solves)} iterations, "
+                     f"{sum(s[4] for s in solves):.2f} secs")
+    return "\n".join(lines)
@@ -0,0 +1,287 @@
+import math
+import os
+import warnings
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import cdist
+
+import chargingmodel.tools as tools
+import chargingmodel.optimize as optimize
+from chargingmodel.preprocessing import Fleet
+
+# Representative agents (config "reductionFactor", "reductionResolution").
+# The agents of a region with the same EVSE group and EV model are clustered by their event timing (signature,
+# see getSignatures) into ceil(n / factor) clusters. Every cluster is optimized as one representative agent:
+# The member closest to the others (medoid) with the summed aggFac and capacity of the cluster, its consumption
+# scaled to the total consumption of the cluster and as charging power the sum of the charging power of the
+# members parked at each time step (see setAvailability).
+# The load of a representative is split between its members proportional to their consumption (disaggregate).
+# Error: Energy a member gets above its charging power (only numerical, the load of a representative fits its
+# members) and the energy shifted between the members compared to a split by share. Events of the medoid may not
+# fit the consumption of the cluster -> The slack (consumption that can not be charged) increases.
+class Reduction:
+    def __init__(self, *, factor, nTimesteps, blockSteps, deltaT, eta, SOCStart):
+        self.factor = factor
+        self.nTimesteps = nTimesteps
+        self.blockSteps = blockSteps
+        self.deltaT = deltaT
+        self.eta = eta
+        self.SOCStart = SOCStart
+        self.fleets = [] # Reduced fleets
+        self.members = {} # Representative -> (index in fleets, indices of the members, shares)
+        # Counts, energy of the disaggregated results and slack of the agents and of the representatives in MWh
+        self.stats = dict.fromkeys(("agents", "representatives", "energy", "error", "deviation", "slack",
+                                    "slackReduced"), 0)
+
+    # Representatives of the agents of a fleet
+    def reduce(self, fleet):
+        signatures = getSignatures(fleet, self.nTimesteps, self.blockSteps)
+        consumption = np.add.reduceat(np.append(fleet.consumption, 0.0), fleet.offsets[:-1]) * (fleet.nEvents > 0)
+
+        # Cluster per region, EVSE group and EV model
+        groups = {}
+        for i, key in enumerate(zip(fleet.regionID.tolist(), fleet.evseGroup.tolist(), fleet.model.tolist())):
+            groups.setdefault(key, []).append(i)
+        medoids, clusters = [], []
+        for idx in groups.values():
+            idx = np.array(idx)
+            nClusters = math.ceil(len(idx) / self.factor)
+            if nClusters >= len(idx):
+                labels = np.arange(len(idx))
+            else:
+                tree = linkage(signatures[idx], method="average", metric="cityblock")
+                labels = fcluster(tree, nClusters, criterion="maxclust") - 1
+            for label in np.unique(labels):
+                members = idx[labels == label]
+                distances = cdist(signatures[members], signatures[members], metric="cityblock").sum(axis=1)
+                medoids.append(members[np.argmin(distances)])
+                clusters.append(members)
+
+        # Representatives in the order of the fleet
+        order = np.argsort(medoids, kind="stable")
+        medoids = np.array(medoids, dtype=int)[order]
+        clusters = [clusters[i] for i in order]
+        representatives = fleet[medoids]
+        scale = np.array([fleet.aggFac[members].sum() for members in clusters]) / fleet.aggFac[medoids]
+        totals = np.array([consumption[members].sum() for members in clusters])
+        consScale = scale.copy() # Medoid without consumption: Scaled like aggFac
+        driving = consumption[medoids] > 0
+        consScale[driving] = totals[driving] / consumption[medoids][driving]
+        representatives.consumption *= np.repeat(consScale, representatives.nEvents)
+        representatives.capacity = np.array([fleet.capacity[members].sum() for members in clusters])
+        representatives.aggFac = np.array([fleet.aggFac[members].sum() for members in clusters])
+        representatives = setAvailability(representatives, fleet, clusters)
+
+        # Members and their share of the load
+        for name, members, total in zip(representatives.name.tolist(), clusters, totals.tolist()):
+            if total > 0:
+                shares = consumption[members] / total
+            else:
+                shares = fleet.aggFac[members] / fleet.aggFac[members].sum()
+            self.members[name] = (len(self.fleets), members, shares)
+        self.fleets.append(fleet)
+        self.stats["agents"] += len(fleet)
+        self.stats["representatives"] += len(representatives)
+        self.stats["slack"] += self.getSlack(fleet)
+        self.stats["slackReduced"] += self.getSlack(representatives)
+        return representatives
+
+    # Total slack of a fleet (same as the slack of the optimization, see optimize.getSlack)
+    def getSlack(self, fleet):
+        _, slacks = optimize.immediate(agents=fleet, eta=self.eta, SOCStart=self.SOCStart, deltaT=self.deltaT,
+                                       verbose=False)
+        return sum(slacks.values())
+
+    def getMembers(self, name):
+        key, members, shares = self.members[name]
+        return self.fleets[key][members], shares
+
+    # Names of the members of the representatives
+    def memberNames(self, names):
+        return [member for name in names for member in self.getMembers(name)[0].name.tolist()]
+
+    # Store the fleets and members in a folder (bounded memory, see optNational). load() maps the fleets into memory.
+    def save(self, path):
+        for key, fleet in enumerate(self.fleets):
+            fleet.save(os.path.join(path, str(key)))
+        names = list(self.members)
+        np.save(os.path.join(path, "representatives.npy"), np.array(names, dtype=str))
+        np.save(os.path.join(path, "keys.npy"), np.array([self.members[name][0] for name in names], dtype=int))
+        np.save(os.path.join(path, "counts.npy"), np.array([len(self.members[name][1]) for name in names], dtype=int))
+        np.save(os.path.join(path, "members.npy"),
+                np.concatenate([self.members[name][1] for name in names] + [np.zeros(0, dtype=int)]))
+        np.save(os.path.join(path, "shares.npy"),
+                np.concatenate([self.members[name][2] for name in names] + [np.zeros(0)]))
+
+    def load(self, path):
+        offset = len(self.fleets)
+        keys = np.load(os.path.join(path, "keys.npy"))
+        self.fleets += [Fleet.load(os.path.join(path, str(key))) for key in range(keys.max(initial=-1) + 1)]
+        counts = np.load(os.path.join(path, "counts.npy"))
+        members = np.split(np.load(os.path.join(path, "members.npy")), np.cumsum(counts)[:-1])
+        shares = np.split(np.load(os.path.join(path, "shares.npy")), np.cumsum(counts)[:-1])
+        for name, key, m, share in zip(np.load(os.path.join(path, "representatives.npy")).tolist(), keys.tolist(),
+                                       members, shares):
+            self.members[name] = (offset + key, m, share)
+
+    # Split the results of representatives between their members. Per time step proportional to share * charging
+    # power of the members that can charge (see split), by share if none of them can.
+    # Returns the members (Fleet), their demands and slacks and the rows of the table Reduction.
+    def disaggregate(self, agents, demands, slacks):
+        names = agents.name.tolist() if isinstance(agents, Fleet) else [agent.name for agent in agents]
+        fleets, memberDemands, memberSlacks, rows = [], {}, {}, []
+        for name in names:
+            members, shares = self.getMembers(name)
+            fleets.append(members)
+            demand = demands[name]
+            ts = np.fromiter(demand.keys(), dtype=int, count=len(demand))
+            p = np.fromiter(demand.values(), dtype=float, count=len(demand))
+            limits = np.array([getPowerLimit(members, i, ts) for i in range(len(members))]).reshape(len(members), -1)
+            power = split(p, shares, limits)
+            for i, (member, share) in enumerate(zip(members.name.tolist(), shares.tolist())):
+                pMember = power[i]
+                memberDemands[member] = dict(zip(ts.tolist(), pMember.tolist()))
+                memberSlacks[member] = slacks[name] * share
+                energy = pMember.sum() * self.deltaT
+                # Energy above the charging power of the member and energy shifted from or to other members
+                error = np.maximum(pMember - limits[i], 0).sum() * self.deltaT
+                deviation = energy - p.sum() * share * self.deltaT
+                rows.append((member, name, share, energy, error, deviation))
+                self.stats["energy"] += energy
+                self.stats["error"] += error
+                self.stats["deviation"] += abs(deviation)
+        return Fleet.concat(fleets), memberDemands, memberSlacks, rows
+
+    # Add the stats of a reduction in another process
+    def merge(self, stats):
+        for key, value in stats.items():
+            self.stats[key] += value
+
+    # Stats since the last call (reset)
+    def collect(self):
+        stats = self.stats
+        self.stats = dict.fromkeys(stats, 0)
+        return stats
+
+    def summary(self):
+        stats = self.stats
+        energy = max(stats["energy"], 1e-9)
+        return (f"Representative agents: {stats['agents']} -> {stats['representatives']}, disaggregation error: "
+                f"{stats['error']:.1f} MWh above the charging power ({100 * stats['error'] / energy:.2f} %), "
+                f"{stats['deviation']:.1f} MWh shifted between agents ({100 * stats['deviation'] / energy:.2f} %), "
+                f"slack: {stats['slack']:.1f} MWh -> {stats['slackReduced']:.1f} MWh")
+
+    # Warn if the members get energy above their charging power (physically impossible loads).
+    # Only numerical deviations are expected (see setAvailability) -> relative tolerance.
+    def checkError(self, tol=1e-6):
+        if self.stats["error"] > tol * max(self.stats["energy"], 1e-9):
+            warnings.warn(f"Representative agents: {self.stats['error']:.3g} MWh of the disaggregated load are above "
+                          f"the charging power of the agents (see table Reduction, column ErrorMWh).")
+
+# Reduction of the config, None if off (reductionFactor <= 1)
+def fromConfig(config):
+    if config["reductionFactor"] <= 1:
+        return None
+    blockSteps = tools.getDeltaT(config["reductionResolution"]) / tools.getDeltaT(config["resolution"])
+    if blockSteps < 1 or blockSteps != int(blockSteps):
+        raise ValueError(f"reductionResolution: {config['reductionResolution']} is not a multiple of the resolution!")
+    nTimesteps = len(tools.getTimeCol(resolution=config["resolution"]))
+    return Reduction(factor=config["reductionFactor"], nTimesteps=nTimesteps, blockSteps=int(blockSteps),
+                     deltaT=tools.getDeltaT(config["resolution"]),
+                     eta=config["chargingEfficiency"], SOCStart=config["SOCStart"])
+
+# Charging power of representatives: Their events (of the medoid) are split where the availability of the members
+# changes. pMax of every part: Sum of the charging power of the members parked at that time -> the load of a
+# representative can always be split between its members (see split). The consumption is on the last part.
+def setAvailability(representatives, fleet, clusters):
+    events = [splitEvents(representatives, i, fleet[members]) for i, members in enumerate(clusters)]
+    columns = {field: np.concatenate([e[field] for e in events] + [np.zeros(0)])
+               for field in Fleet.eventFields}
+    columns.update({field: getattr(representatives, field) for field in Fleet.agentFields})
+    offsets = np.concatenate(([0], np.cumsum([len(e["start"]) for e in events])))
+    return Fleet(offsets=offsets, **columns)
+
+# Events of the i-th agent of a fleet split by the availability of the members (see setAvailability)
+def splitEvents(fleet, i, members):
+    window = slice(fleet.offsets[i], fleet.offsets[i+1])
+    start, stop = fleet.start[window], fleet.stop[window]
+    valid = np.flatnonzero(stop > start)
+    bounds = np.unique(np.concatenate((start[valid], stop[valid], members.start, members.stop)))
+    eventIdx = np.searchsorted(start[valid], bounds, side="right") - 1
+    inside = (eventIdx >= 0) & (bounds < stop[valid][np.maximum(eventIdx, 0)])
+    partStart = bounds[inside]
+    partEvent = valid[eventIdx[inside]]
+    pMax = np.zeros(len(partStart))
+    for j in range(len(members)):
+        pMax += getPowerLimit(members, j, partStart)
+
+    # Merge neighbouring parts of an event with the same charging power
+    keep = np.ones(len(partStart), dtype=bool)
+    keep[1:] = (partEvent[1:] != partEvent[:-1]) | (pMax[1:] != pMax[:-1])
+    partStart, partEvent, pMax = partStart[keep], partEvent[keep], pMax[keep]
+    lastPart = np.append(partEvent[1:] != partEvent[:-1], True)
+    partStop = np.where(lastPart, stop[partEvent], np.append(partStart[1:], 0))
+
+    # Events without time steps stay as they are
+    empty = np.flatnonzero(stop <= start)
+    order = np.argsort(np.concatenate((partEvent, empty)), kind="stable")
+    consumption = fleet.consumption[window]
+    return {"start": np.concatenate((partStart, start[empty]))[order],
+            "stop": np.concatenate((partStop, stop[empty]))[order],
+            "consumption": np.concatenate((np.where(lastPart, consumption[partEvent], 0.0),
+                                           consumption[empty]))[order],
+            "pMax": np.concatenate((pMax, fleet.pMax[window][empty]))[order],
+            "purpose": np.concatenate((fleet.purpose[window][partEvent], fleet.purpose[window][empty]))[order]}
+
+# Share of the time steps in which an agent can charge (event with pMax > 0) per block of blockSteps time steps.
+# The steps of every event are added to the blocks directly -> memory O(agents * blocks).
+def getSignatures(fleet, nTimesteps, blockSteps):
+    nBlocks = -(-nTimesteps // blockSteps)
+    agentOfEvent = np.repeat(np.arange(len(fleet)), fleet.nEvents)
+    stop = np.minimum(fleet.stop, nTimesteps)
+    available = (fleet.pMax > 0) & (stop > fleet.start)
+    agent, start, stop = agentOfEvent[available], fleet.start[available], stop[available]
+    first, last = start // blockSteps, (stop - 1) // blockSteps
+
+    # Partial first and last block
+    steps = np.zeros((len(fleet), nBlocks))
+    np.add.at(steps, (agent, first), np.minimum(stop, (first + 1) * blockSteps) - start)
+    inner = last > first
+    np.add.at(steps, (agent[inner], last[inner]), stop[inner] - last[inner] * blockSteps)
+    # Full blocks in between (difference array)
+    full = np.zeros((len(fleet), nBlocks + 1))
+    between = last - first > 1
+    np.add.at(full, (agent[between], first[between] + 1), blockSteps)
+    np.add.at(full, (agent[between], last[between]), -blockSteps)
+    steps += np.cumsum(full[:, :-1], axis=1)
+    blocks = np.arange(0, nTimesteps, blockSteps)
+    return steps / np.diff(np.append(blocks, nTimesteps))
+
+# Charging power of the i-th agent of a fleet at the time steps ts (0 outside of its events)
+def getPowerLimit(fleet, i, ts):
+    window = slice(fleet.offsets[i], fleet.offsets[i+1])
+    start, stop, pMax = fleet.start[window], fleet.stop[window], fleet.pMax[window]
+    eventIdx = np.searchsorted(start, ts, side="right") - 1
+    inside = (eventIdx >= 0) & (ts < stop[np.maximum(eventIdx, 0)])
+    return np.where(inside, pMax[np.maximum(eventIdx, 0)], 0.0)
+
+# Split the power p (per time step) of a representative between its members: Proportional to share * charging power
+# (limits) of the members that can charge, members at their charging power get no more and the rest is distributed
+# between the others. Only power that exceeds the charging power of all members together is split by share
+# (above the charging power -> error, see Reduction.disaggregate).
+def split(p, shares, limits):
+    power = np.zeros(limits.shape)
+    rest = p.copy()
+    active = limits > 0
+    for _ in range(len(shares)):
+        weights = np.where(active, shares[:, None] * limits, 0.0)
+        total = weights.sum(axis=0)
+        pending = (rest > 1e-12 * np.abs(p).max(initial=0.0)) & (total > 0)
+        if not pending.any():
+            break
+        power += np.where(pending, rest * weights / np.where(total > 0, total, 1), 0.0)
+        rest = np.where(pending, np.maximum(power - limits, 0).sum(axis=0), rest)
+        power = np.where(pending, np.minimum(power, limits), power)
+        active &= power < limits
+    return power + shares[:, None] * rest
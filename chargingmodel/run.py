@@ -2,13 +2,18 @@ import json
 import random
 import argparse
 import os
+from datetime import datetime
 
 import pandas as pd
 
 import chargingmodel.tools as tools
+import chargingmodel.preprocessing as preprocessing
+import chargingmodel.profiling as profiling
 import chargingmodel.uncontrolled as uncontrolled
 import chargingmodel.optNational as optNational
 import chargingmodel.optCounty as optCounty
+import chargingmodel.optExact as optExact
+import chargingmodel.optDistributed as optDistributed
 
 def getArgs():
     parser = argparse.ArgumentParser()
@@ -17,26 +22,49 @@ def getArgs():
     # EVSE availability scenario
     parser.add_argument("--scenario", default="Realistic") # See config for all options
     # Strategy
-    parser.add_argument("--strategy", default="Uncontrolled") # Uncontrolled, Opt_National, Opt_County
+    parser.add_argument("--strategy", default="Uncontrolled") # Uncontrolled, Opt_National, Opt_County, Opt_Exact, Opt_Distributed
     # Run configuration
     parser.add_argument("--silent", dest='verbose', action='store_false') # No console printing
     parser.set_defaults(verbose=True)
     parser.add_argument("--n_worker", default=1, type=int) # Number of cores to use
+    parser.add_argument("--incremental", action='store_true') # Only recompute changed regions (see run())
+    parser.add_argument("--resume", action='store_true') # Continue an interrupted Opt_National run
+    # Instrumentation
+    parser.add_argument("--profile", action='store_true') # Stage timers and solver statistics -> table Profiling
+    parser.add_argument("--cprofile", default=None) # cProfile output file (workers: [file].[worker])
     return parser.parse_args()
 
-def run(dbName=None, scenario="Realistic", strategy="Uncontrolled", verbose=True, n_worker=1):
-    # Only the public charging probability contains randomness currently
-    random.seed(123)
+def getConfig():
+    with open(os.path.join(os.path.dirname(__file__), 'config.json')) as f:
+        return json.load(f)
+
+# config: Configuration to use instead of config.json (see sweep.py)
+# incremental: Keep the results of an existing database and only recompute regions whose inputs changed.
+#   Only for strategies with independent regions (Uncontrolled, Opt_County).
+# resume: Continue from the last checkpoint in the database (Opt_National only). Starts fresh if there is none.
+# profile: Record stage timers and Gurobi statistics in the table Profiling (see profiling.py).
+# cprofile: Also run cProfile and write the statistics to this file.
+def run(dbName=None, scenario="Realistic", strategy="Uncontrolled", verbose=True, n_worker=1, config=None,
+        incremental=False, resume=False, profile=False, cprofile=None):
+    # Only the public charging probability contains randomness currently.
+    # Seeded per region (preprocessing.getFleet) in every strategy -> all strategies and incremental runs
+    # get the same fleet of a region.
+    seed = 123
+    random.seed(seed)
 
     dirname = os.path.dirname(__file__)
     # Get config
-    with open(os.path.join(dirname, 'config.json')) as f:
-        config = json.load(f)
+    if config is None:
+        config = getConfig()
 
     # Prepare output sqlite database
     if dbName is None:
         dbName = os.path.join(dirname, f"output/{scenario}_{strategy}.db")
-    tools.innitDB(dbName)
+    if resume and strategy != "Opt_National":
+        raise ValueError(f"Resume is only possible with Opt_National, not with {strategy}!")
+    resume = resume and tools.getCheckpoint(dbName) is not None
+    if not incremental and not resume:
+        tools.innitDB(dbName, resolution=config["resolution"])
 
     # Get Region IDs (In the paper these regions where counties)
     regionData = pd.read_csv(os.path.join(dirname,"input/regions.csv"), sep=";")
@@ -48,15 +76,60 @@ def run(dbName=None, scenario="Realistic", strategy="Uncontrolled", verbose=True
 
     # Run
     kwargs = {"scenario": scenario, "config": config, "dbName":dbName, "regionIDs": regionIDs,
-              "aggFactors": aggFactors, "n_worker": n_worker, "verbose": verbose}
-    if strategy == "Uncontrolled":
-        uncontrolled.run(**kwargs)
-    elif strategy == "Opt_National":
-        optNational.run(**kwargs)
-    elif strategy == "Opt_County":    
-        optCounty.run(**kwargs)
-    else: 
-        print(f"Invalid strategy! {strategy}")
+              "aggFactors": aggFactors, "n_worker": n_worker, "verbose": verbose, "seed": seed}
+    if incremental:
+        if strategy not in ("Uncontrolled", "Opt_County"):
+            raise ValueError(f"Incremental runs need independent regions. Not possible with {strategy}!")
+        hashes = {regionID: preprocessing.getRegionHash(scenario, strategy, config, regionID, aggFactors[i], seed)
+                  for i, regionID in enumerate(regionIDs)}
+        oldHashes = tools.getRegionHashes(dbName)
+        changed = [i for i, regionID in enumerate(regionIDs) if oldHashes.get(regionID) != hashes[regionID]]
+        removed = [regionID for regionID in oldHashes if regionID not in hashes]
+        if verbose:
+            print(f"Incremental run: {len(changed)} of {len(regionIDs)} regions changed, {len(removed)} removed")
+        if not changed and not removed:
+            return
+        # Nothing to keep (or a different time grid in Simulation): Start from a new database
+        if len(changed) == len(regionIDs) or tools.getResolution(dbName) != config["resolution"]:
+            tools.innitDB(dbName, resolution=config["resolution"])
+        else:
+            tools.deleteRegions(dbName, [regionIDs[i] for i in changed] + removed)
+        kwargs.update(regionIDs=regionIDs[changed], aggFactors=aggFactors.values[changed])
+
+    # Instrumentation. Always switched off again, also if the strategy fails.
+    if profile or cprofile:
+        profiling.enable(cprofile=cprofile)
+    profiler = profiling.startProfile()
+    # Incremental and resumed runs add to the table Profiling -> the rows of this run get their own RunID
+    runID = f"{datetime.now().isoformat(timespec='seconds')} {strategy}"
+    try:
+        if strategy == "Uncontrolled":
+            uncontrolled.run(**kwargs)
+        elif strategy == "Opt_National":
+            optNational.run(**kwargs, resume=resume)
+        elif strategy == "Opt_County":    
+            optCounty.run(**kwargs)
+        elif strategy == "Opt_Exact":
+            optExact.run(**kwargs)
+        elif strategy == "Opt_Distributed":
+            optDistributed.run(**kwargs)
+        else: 
+            print(f"Invalid strategy! {strategy}")
+
+        if profiling.enabled:
+            profiling.dumpProfile(profiler)
+            profiling.write(dbName, runID=runID)
+            if verbose:
+                print(profiling.summary())
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if profiling.enabled:
+            profiling.enable(False)
+
+    # Results of the changed regions are complete
+    if incremental:
+        tools.setRegionHashes(dbName, {regionIDs[i]: hashes[regionIDs[i]] for i in changed})
     
 if __name__ == "__main__":
     run(**vars(getArgs()))
@@ -0,0 +1,80 @@
+import itertools
+import argparse
+import os
+from multiprocessing import Process
+
+import pandas as pd
+
+import chargingmodel.preprocessing as preprocessing
+import chargingmodel.tools as tools
+from chargingmodel.run import run, getConfig
+
+# Run every combination of scenarios and sensitivity values.
+# scenarios: EVSE scenarios (see config.json)
+# sensitivities: Values of the sensitivity factors, e.g. {"sensiAdjP": [0.8, 1.2], "sensiAdjCons": [1.1]}
+# Every variant is stored in its own database: [outputDir]/[scenario]_[strategy]_[sensitivities].db
+# The scenario independent preprocessing (preprocessing.getFleetBase) is done once, before the variants are
+# started in up to n_worker parallel processes. Returns the variants and their databases.
+# Raises a RuntimeError with the databases of the failed variants after all variants ran.
+def sweep(*, scenarios, strategy="Uncontrolled", sensitivities=None, outputDir=None, n_worker=1, verbose=True):
+    dirname = os.path.dirname(__file__)
+    if outputDir is None:
+        outputDir = os.path.join(dirname, "output")
+    sensitivities = sensitivities or {}
+    config = getConfig()
+
+    # Shared preprocessing. Inherited by the variant processes.
+    regionIDs = pd.read_csv(os.path.join(dirname, "input/regions.csv"), sep=";")["ID"].astype(str).values
+    for regionID in regionIDs:
+        preprocessing.getFleetBase(config, regionID, resolution=config["resolution"])
+
+    # Variants
+    variants = []
+    for scenario in scenarios:
+        for values in itertools.product(*sensitivities.values()):
+            sensi = dict(zip(sensitivities.keys(), values))
+            tag = "_".join(f"{key}={value}" for key, value in sensi.items())
+            dbName = os.path.join(outputDir, f"{scenario}_{strategy}" + (f"_{tag}" if tag else "") + ".db")
+            variants.append({"scenario": scenario, **sensi, "dbName": dbName})
+
+    # Run
+    failed = []
+    currentWork = []
+    for variant in variants:
+        kwargs = {"dbName": variant["dbName"], "scenario": variant["scenario"], "strategy": strategy,
+                  "verbose": False, "config": dict(config, **{key: variant[key] for key in sensitivities})}
+        currentWork.append(Process(target=run, name=os.path.basename(variant["dbName"]), kwargs=kwargs))
+        if len(currentWork) >= n_worker:
+            failed += runVariants(currentWork, verbose)
+            currentWork = []
+    if currentWork:
+        failed += runVariants(currentWork, verbose)
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(variants)} variants failed: {', '.join(failed)}")
+    return variants
+
+# Run the processes of some variants. Returns the names of the failed ones (their databases are incomplete).
+def runVariants(processes, verbose):
+    tools.runProcesses(processes, verbose)
+    return [p.name for p in processes if p.exitcode != 0]
+
+def getArgs():
+    parser = argparse.ArgumentParser()
+    # EVSE availability scenarios
+    parser.add_argument("--scenarios", nargs="+", default=["Realistic"])
+    # Strategy
+    parser.add_argument("--strategy", default="Uncontrolled")
+    # Sensitivities. Example: --sensi sensiAdjP=0.8,1.2 sensiAdjCons=1.1
+    parser.add_argument("--sensi", nargs="*", default=[])
+    parser.add_argument("--outputDir", default=None)
+    # Run configuration
+    parser.add_argument("--silent", dest='verbose', action='store_false') # No console printing
+    parser.set_defaults(verbose=True)
+    parser.add_argument("--n_worker", default=1, type=int) # Number of parallel variants
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = vars(getArgs())
+    args["sensitivities"] = {key: [float(v) for v in values.split(",")]
+                             for key, values in (sensi.split("=") for sensi in args.pop("sensi"))}
+    sweep(**args)
@@ -1,11 +1,20 @@
 import time
 import sys
+import os
 from datetime import datetime as dt
 import itertools
 import sqlite3
+import threading
+import zlib
+import queue
+from multiprocessing import shared_memory
 
+import numpy as np
 import pandas as pd
 
+from chargingmodel.preprocessing import Fleet
+import chargingmodel.profiling as profiling
+
 # Progressbar
 def tickProg(perc):
     prog = int(perc * 40)
@@ -37,6 +46,52 @@ def runProcesses(processes, verbose, queue=None):
     
     return results
 
+# Stop a pool of worker processes that run tasks until they receive None.
+# terminate: After an error the workers may be blocked, e.g. putting a large result into a queue nobody reads
+#   anymore -> terminate them instead of waiting for them.
+def stopWorkers(workers, tasks, terminate=False):
+    for p, queue in zip(workers, tasks):
+        if terminate:
+            p.terminate()
+        else:
+            queue.put(None)
+    for p in workers:
+        p.join()
+
+# Float array in shared memory. Workers attach by name instead of receiving a pickled copy.
+# The creator has to call close() and unlink() when done.
+def createSharedArray(values):
+    values = np.asarray(values, dtype=np.float64)
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    array = np.ndarray(values.shape, dtype=np.float64, buffer=shm.buf)
+    array[:] = values
+    return shm, array
+
+def attachSharedArray(name, shape):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+# Add the charging demand of agents to the residual load (in place)
+def addDemands(residualLoad, demands):
+    for demand in demands.values():
+        if demand:
+            ts = np.fromiter(demand.keys(), dtype=np.int64, count=len(demand))
+            residualLoad[ts] += np.fromiter(demand.values(), dtype=np.float64, count=len(demand))
+
+# Length of a time step in hours, e.g. "15T" -> 0.25
+def getDeltaT(resolution):
+    return pd.to_timedelta(resolution).total_seconds() / 3600
+
+# Time steps per block of the two stage solve (config "coarseResolution", see optimize.solveAgentCoarse).
+# 1: Single stage.
+def getCoarseFactor(config):
+    if not config["coarseResolution"]:
+        return 1
+    factor = getDeltaT(config["coarseResolution"]) / getDeltaT(config["resolution"])
+    if factor < 1 or factor != int(factor):
+        raise ValueError(f"coarseResolution: {config['coarseResolution']} is not a multiple of the resolution!")
+    return int(factor)
+
 # Split the given time window in individual chunks.
 # Options: "D": Day, "M": Month, "W": Week
 def createSegmentation(horizon, start=dt(2030, 1, 1), end=dt(2031, 1, 1), resolution="15T"):
@@ -94,33 +149,397 @@ def innitDB(dbName, startDate=dt(2030, 1, 1), endDate=dt(2031, 1, 1), resolution
                 ON DELETE CASCADE
     ) """)
 
+    # Dense output: One compressed profile per agent (see encodeProfile)
+    c.execute("DROP TABLE IF EXISTS Profiles")
+    c.execute("""CREATE TABLE Profiles (
+        AgentIdx integer PRIMARY KEY,
+        AgentID text,
+        Data blob,
+        FOREIGN KEY (AgentID)
+            REFERENCES Agents (AgentID)
+                ON DELETE CASCADE
+    ) """)
+
+    # Aggregates of a previous run (see postprocessing)
+    c.execute("DROP TABLE IF EXISTS Regions")
+    c.execute("DROP TABLE IF EXISTS Total")
+
+    # Instrumentation of a previous run (see profiling)
+    c.execute("DROP TABLE IF EXISTS Profiling")
+
+    # Representative of every agent and the error of the disaggregation (see reduction)
+    c.execute("DROP TABLE IF EXISTS Reduction")
+    c.execute("""CREATE TABLE Reduction (
+        AgentID text PRIMARY KEY,
+        Representative text,
+        Share real,
+        EnergyMWh real,
+        ErrorMWh real,
+        DeviationMWh real
+    ) """)
+
+    # Input hash of every computed region (incremental runs, see run.py)
+    c.execute("DROP TABLE IF EXISTS RegionHashes")
+    c.execute("""CREATE TABLE RegionHashes (
+        Region text PRIMARY KEY,
+        Hash text
+    ) """)
+
+    # Last consistent state of a run that can be resumed (Opt_National, see writeCheckpoint)
+    c.execute("DROP TABLE IF EXISTS Checkpoint")
+    c.execute("""CREATE TABLE Checkpoint (
+        RunKey text,
+        Batches blob,
+        Residual blob
+    ) """)
+
     # Meta-Info about simulation
     c.execute("INSERT INTO Simulation VALUES (?, ?, ?)", (startDate, endDate, resolution))
 
     conn.commit()
     conn.close()
 
-# Save results of one agent to database
-def saveDB(*, agents, demands, slacks, dbName, startDate=dt(2030, 1, 1), endDate=dt(2031, 1, 1), resolution="15T"):
-    # SQL - connect
+# Input hashes of the regions in an existing output database. Empty if there is none.
+def getRegionHashes(dbName):
+    if not os.path.isfile(dbName):
+        return {}
+    conn = sqlite3.connect(dbName)
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='RegionHashes'")
+    hashes = dict(c.execute("SELECT Region, Hash FROM RegionHashes").fetchall()) if c.fetchone() else {}
+    conn.close()
+    return hashes
+
+# Resolution an output database was created with. None if there is none.
+def getResolution(dbName):
+    if not os.path.isfile(dbName):
+        return None
+    conn = sqlite3.connect(dbName)
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='Simulation'")
+    row = c.execute("SELECT Resolution FROM Simulation").fetchone() if c.fetchone() else None
+    conn.close()
+    return row[0] if row else None
+
+def setRegionHashes(dbName, hashes):
+    conn = sqlite3.connect(dbName)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO RegionHashes VALUES (?, ?)", hashes.items())
+    conn.close()
+
+# Checkpoint: Indices of the completed batches (int64) and the residual load including them (float64).
+# Written by the DBWriter in the same transaction as the results -> consistent with the saved agents.
+def writeCheckpoint(c, runKey, batches, residualLoad):
+    c.execute("DELETE FROM Checkpoint")
+    c.execute("INSERT INTO Checkpoint VALUES (?, ?, ?)",
+              (runKey, np.asarray(batches, dtype=np.int64).tobytes(),
+               np.asarray(residualLoad, dtype=np.float64).tobytes()))
+
+# Last checkpoint of an output database. None if there is none.
+def getCheckpoint(dbName):
+    if not os.path.isfile(dbName):
+        return None
     conn = sqlite3.connect(dbName)
     c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='Checkpoint'")
+    row = c.execute("SELECT RunKey, Batches, Residual FROM Checkpoint").fetchone() if c.fetchone() else None
+    conn.close()
+    if row is None:
+        return None
+    return {"runKey": row[0], "batches": np.frombuffer(row[1], dtype=np.int64),
+            "residualLoad": np.frombuffer(row[2], dtype=np.float64)}
+
+# Delete all results of the agents (resumed runs: agents saved after the last checkpoint).
+# Drops the aggregates, they are rebuilt by the next DBWriter.
+def deleteAgents(dbName, agentIDs):
+    conn = sqlite3.connect(dbName)
+    with conn:
+        c = conn.cursor()
+        c.execute("CREATE TEMP TABLE Deleted (AgentID text PRIMARY KEY)")
+        c.executemany("INSERT INTO Deleted VALUES (?)", [(agentID, ) for agentID in agentIDs])
+        c.execute("DELETE FROM TimeSeries WHERE AgentID IN (SELECT AgentID FROM Deleted)")
+        c.execute("DELETE FROM Profiles WHERE AgentID IN (SELECT AgentID FROM Deleted)")
+        c.execute("DELETE FROM Reduction WHERE AgentID IN (SELECT AgentID FROM Deleted)")
+        c.execute("DELETE FROM Agents WHERE AgentID IN (SELECT AgentID FROM Deleted)")
+        c.execute("DROP TABLE IF EXISTS Regions")
+        c.execute("DROP TABLE IF EXISTS Total")
+    conn.close()
+
+# Delete all results of the regions (incremental runs). The table Total is rebuilt by the next DBWriter.
+def deleteRegions(dbName, regionIDs):
+    if not regionIDs:
+        return
+    conn = sqlite3.connect(dbName)
+    with conn:
+        c = conn.cursor()
+        c.execute("CREATE TEMP TABLE Deleted (Region text PRIMARY KEY)")
+        c.executemany("INSERT INTO Deleted VALUES (?)", [(regionID, ) for regionID in regionIDs])
+        agents = "SELECT AgentID FROM Agents WHERE Region IN (SELECT Region FROM Deleted)"
+        c.execute(f"DELETE FROM TimeSeries WHERE AgentID IN ({agents})")
+        c.execute(f"DELETE FROM Profiles WHERE AgentID IN ({agents})")
+        c.execute(f"DELETE FROM Reduction WHERE AgentID IN ({agents})")
+        c.execute("DELETE FROM Agents WHERE Region IN (SELECT Region FROM Deleted)")
+        c.execute("DELETE FROM RegionHashes WHERE Region IN (SELECT Region FROM Deleted)")
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='Regions'")
+        if c.fetchone():
+            c.execute("DELETE FROM Regions WHERE Type IN (SELECT Region FROM Deleted)")
+    conn.close()
+
+# Time column of the output: ISO strings, as stored by sqlite3 for datetime objects
+def getTimeCol(startDate=dt(2030, 1, 1), endDate=dt(2031, 1, 1), resolution="15T"):
+    return [t.isoformat(" ") for t in pd.date_range(startDate, endDate, inclusive="left", freq=resolution).to_pydatetime()] # pylint: disable=no-member
+
+# Dense output: Charging power of one agent at every time step as zlib compressed int32 array in kW.
+# Same precision as the sparse output (PowerMW floored to 3 decimals).
+def encodeProfile(demand, nTimesteps):
+    profile = np.zeros(nTimesteps, dtype=np.int32)
+    if demand:
+        ts = np.fromiter(demand.keys(), dtype=np.int64, count=len(demand))
+        p = np.fromiter(demand.values(), dtype=np.float64, count=len(demand))
+        profile[ts] = np.maximum(p * 1000, 0).astype(np.int32)
+    return zlib.compress(profile.tobytes())
 
+# Profile in MW
+def decodeProfile(data):
+    return np.frombuffer(zlib.decompress(data), dtype=np.int32) / 1000
+
+# Rows of the tables Agents, TimeSeries and Profiles for the results of some agents
+# outputFormat: "sparse" (TimeSeries), "dense" (Profiles) or "both"
+def getRows(*, agents, demands, slacks, timeCol, outputFormat="sparse"):
     # Meta-Info about agent
-    metadata = []
-    for agent in agents:
-        metadata.append((agent.name, agent.regionID, int(agent.evseGroup), agent.aggFac,
-                         agent.capacity, agent.model, slacks[agent.name]))
-    c.executemany("INSERT INTO Agents VALUES (?, ?, ?, ?, ?, ?, ?)", metadata)
+    if isinstance(agents, Fleet):
+        names = agents.name.tolist()
+        metadata = list(zip(names, agents.regionID.tolist(), agents.evseGroup.tolist(), agents.aggFac.tolist(),
+                            agents.capacity.tolist(), agents.model.tolist(), [slacks[name] for name in names]))
+    else:
+        names = [agent.name for agent in agents]
+        metadata = []
+        for agent in agents:
+            metadata.append((agent.name, agent.regionID, int(agent.evseGroup), agent.aggFac,
+                             agent.capacity, agent.model, slacks[agent.name]))
 
     # Time series output, saved sparse
     tsData = []
-    timeCol = list(pd.date_range(startDate,endDate, inclusive="left", freq=resolution).to_pydatetime()) # pylint: disable=no-member
-    for agent in agents:
-        for idx, val in demands[agent.name].items():
-            p = int(val * 1000 )/1000 # Floor to 3 decimals
-            if p > 0:
-                tsData.append((timeCol[idx], agent.name, p))
+    if outputFormat in ("sparse", "both"):
+        for name in names:
+            for idx, val in demands[name].items():
+                p = int(val * 1000 )/1000 # Floor to 3 decimals
+                if p > 0:
+                    tsData.append((timeCol[idx], name, p))
+
+    # Time series output, saved dense
+    profiles = []
+    if outputFormat in ("dense", "both"):
+        profiles = [(name, encodeProfile(demands[name], len(timeCol))) for name in names]
+    elif outputFormat != "sparse":
+        raise ValueError(f"Output format: {outputFormat} unknown!")
+    return metadata, tsData, profiles
+
+def insertRows(c, metadata, tsData, profiles):
+    c.executemany("INSERT INTO Agents VALUES (?, ?, ?, ?, ?, ?, ?)", metadata)
     c.executemany("INSERT INTO TimeSeries VALUES (?, ?, ?)", tsData)
+    c.executemany("INSERT INTO Profiles (AgentID, Data) VALUES (?, ?)", profiles)
+
+# Save results of one agent to database
+def saveDB(*, agents, demands, slacks, dbName, startDate=dt(2030, 1, 1), endDate=dt(2031, 1, 1), resolution="15T",
+           outputFormat="sparse"):
+    # SQL - connect
+    conn = sqlite3.connect(dbName)
+    c = conn.cursor()
+
+    insertRows(c, *getRows(agents=agents, demands=demands, slacks=slacks,
+                           timeCol=getTimeCol(startDate, endDate, resolution), outputFormat=outputFormat))
     conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.close()
+
+# Table of aggregated charging loads (Regions, Total)
+def createLoadTable(c, table):
+    c.execute(f"DROP TABLE IF EXISTS {table}")
+    c.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+        Time timestamp,
+        Type text,
+        PowerMW real
+    ) """)
+
+# Writes results to the output database in a background thread.
+# Keeps one connection open (WAL mode) and inserts everything that is queued in one transaction.
+# put() only blocks if maxQueue results are waiting, so the caller can keep dispatching work.
+# aggregate: Sum up the load of every region while writing and store the tables Regions and Total
+# on close() (same content as postprocessing.processRegionalLoad/processTotalLoad).
+# resume: Continue the sums with the results already in the database (resumed runs).
+# Usage:
+#   with DBWriter(dbName) as writer:
+#       writer.put(agents=agents, demands=demands, slacks=slacks)
+class DBWriter:
+    def __init__(self, dbName, *, maxQueue=8, verbose=False, outputFormat="sparse", aggregate=True, resume=False,
+                 startDate=dt(2030, 1, 1), endDate=dt(2031, 1, 1), resolution="15T"):
+        self.dbName = dbName
+        self.outputFormat = outputFormat
+        self.aggregate = aggregate
+        self.resume = resume
+        self.loads = {} # Region -> Charging load in kW (PowerMW floored to 3 decimals, like the output)
+        self.verbose = verbose
+        self.timeCol = getTimeCol(startDate, endDate, resolution)
+        self.queue = queue.Queue(maxsize=maxQueue)
+        self.error = None
+        self.stats = {"results": 0, "rows": 0, "transactions": 0, "secs": 0.0}
+        self.thread = threading.Thread(target=self.work, name="DBWriter", daemon=True)
+        self.thread.start()
+
+    # checkpoint: (runKey, batches, residualLoad) saved together with this result (see writeCheckpoint)
+    # reduction: Rows of the table Reduction of these agents (see reduction.Reduction.disaggregate)
+    def put(self, *, agents, demands, slacks, checkpoint=None, reduction=None):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((agents, demands, slacks, checkpoint, reduction))
+
+    def work(self):
+        conn = sqlite3.connect(self.dbName)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536") # 64 MB
+        if self.aggregate and self.resume:
+            try:
+                self.loadExisting(conn)
+            except Exception as e:
+                self.error = e
+        done = False
+        while not done:
+            items = [self.queue.get()]
+            # Batch everything that is waiting
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if items[-1] is None:
+                items.pop()
+                done = True
+            if self.error is not None or not items:
+                continue
+
+            try:
+                st = time.time()
+                metadata, tsData, profiles = [], [], []
+                checkpoint, reduction = None, []
+                for agents, demands, slacks, newCheckpoint, rows in items:
+                    m, ts, pr = getRows(agents=agents, demands=demands, slacks=slacks, timeCol=self.timeCol,
+                                        outputFormat=self.outputFormat)
+                    metadata += m
+                    tsData += ts
+                    profiles += pr
+                    if self.aggregate:
+                        self.accumulate(agents, demands)
+                    checkpoint = newCheckpoint or checkpoint
+                    reduction += rows or []
+                with conn:
+                    insertRows(conn, metadata, tsData, profiles)
+                    if reduction:
+                        conn.executemany("INSERT INTO Reduction VALUES (?, ?, ?, ?, ?, ?)", reduction)
+                    if checkpoint is not None:
+                        writeCheckpoint(conn, *checkpoint)
+                self.stats["secs"] += time.time() - st
+                profiling.add("write", time.time() - st)
+                self.stats["results"] += len(items)
+                self.stats["rows"] += len(metadata) + len(tsData) + len(profiles)
+                self.stats["transactions"] += 1
+            except Exception as e:
+                self.error = e
+
+        if self.aggregate and self.error is None:
+            try:
+                with profiling.timer("aggregate"):
+                    self.writeLoads(conn)
+            except Exception as e:
+                self.error = e
+        conn.close()
+
+    def accumulate(self, agents, demands):
+        if isinstance(agents, Fleet):
+            agents = zip(agents.name.tolist(), agents.regionID.tolist())
+        else:
+            agents = [(agent.name, agent.regionID) for agent in agents]
+        for name, regionID in agents:
+            if regionID not in self.loads:
+                self.loads[regionID] = np.zeros(len(self.timeCol), dtype=np.int64)
+            demand = demands[name]
+            if demand:
+                ts = np.fromiter(demand.keys(), dtype=np.int64, count=len(demand))
+                p = np.fromiter(demand.values(), dtype=np.float64, count=len(demand))
+                self.loads[regionID][ts] += np.maximum(p * 1000, 0).astype(np.int64)
+
+    # Load of the results already in the database. Same values as accumulate(): The output is floored to kW.
+    def loadExisting(self, conn):
+        for regionID, in conn.execute("SELECT DISTINCT Region FROM Agents").fetchall():
+            self.loads[regionID] = np.zeros(len(self.timeCol), dtype=np.int64)
+        if self.outputFormat == "dense":
+            c = conn.execute("""SELECT Region, Data
+                                FROM Profiles
+                                INNER JOIN Agents on Agents.AgentID = Profiles.AgentID""")
+            for regionID, data in c:
+                self.loads[regionID] += np.frombuffer(zlib.decompress(data), dtype=np.int32)
+        else:
+            timeIdx = {t: i for i, t in enumerate(self.timeCol)}
+            c = conn.execute("""SELECT Region, Time, SUM(ROUND(PowerMW * 1000))
+                                FROM TimeSeries
+                                INNER JOIN Agents on Agents.AgentID = TimeSeries.AgentID
+                                GROUP BY Region, Time""")
+            for regionID, t, p in c:
+                self.loads[regionID][timeIdx[t]] += int(p)
+
+    # Tables Regions and Total. Like the sparse output: Only time steps with charging.
+    # If Regions exists (incremental run), the other regions are kept and Total is rebuilt from Regions.
+    def writeLoads(self, conn):
+        total = np.zeros(len(self.timeCol), dtype=np.int64)
+        with conn:
+            c = conn.cursor()
+            c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='Regions'")
+            incremental = c.fetchone() is not None
+            if incremental:
+                c.executemany("DELETE FROM Regions WHERE Type = ?", [(regionID, ) for regionID in self.loads])
+            else:
+                createLoadTable(c, "Regions")
+            for regionID, load in self.loads.items():
+                total += load
+                idx = np.flatnonzero(load)
+                c.executemany("INSERT INTO Regions (Time, PowerMW, Type) VALUES (?, ?, ?)",
+                              ((self.timeCol[i], p, regionID) for i, p in zip(idx.tolist(), (load[idx] / 1000).tolist())))
+            createLoadTable(c, "Total")
+            if incremental:
+                # Sum in kW -> exact, same result as a full run
+                c.execute("""INSERT INTO Total (Time, PowerMW, Type)
+                    SELECT Time, SUM(ROUND(PowerMW * 1000)) / 1000, 'Total'
+                    FROM Regions
+                    GROUP BY Time""")
+                return
+            idx = np.flatnonzero(total)
+            c.executemany("INSERT INTO Total (Time, PowerMW, Type) VALUES (?, ?, ?)",
+                          ((self.timeCol[i], p, "Total") for i, p in zip(idx.tolist(), (total[idx] / 1000).tolist())))
+
+    # Flush the queue, stop the thread and return the write statistics
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.verbose:
+            rate = self.stats["rows"] / self.stats["secs"] if self.stats["secs"] > 0 else 0
+            print(f"Saved {self.stats['rows']} rows of {self.stats['results']} results in {self.stats['transactions']} "
+                  f"transactions. Write time: {self.stats['secs']:.2f} secs ({rate:.0f} rows/sec)")
+        return self.stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None:
+            self.close()
+        else:
+            # Keep the original exception. No aggregates of an incomplete run.
+            self.verbose = False
+            self.aggregate = False
+            try:
+                self.close()
+            except Exception:
+                pass
@@ -1,45 +1,41 @@
-from multiprocessing import Process, Queue
+import random
+import warnings
 
 import chargingmodel.preprocessing as preprocessing
 import chargingmodel.optimize as optimize
 import chargingmodel.tools as tools
+import chargingmodel.profiling as profiling
 
 # Uncontrolled charging.
 # Every agent charges immediately and as much as possible after arriving at a charging station.
-# Runs for all regions in parrallel.
-def run(*, scenario, config, dbName, regionIDs, aggFactors, n_worker, verbose):
-    queue = Queue()
-    currentWork = []
-    for i, regionID in enumerate(regionIDs):
-        # Preprocess data
-        agents = preprocessing.getAgents(scenario, config, regionID, aggFac=aggFactors[i])
-
-        # Create process
-        kwargs = {"agents": agents, "config": config,
-                  "queue": queue}
-        p = Process(target=runCounty, name=str(regionID),
-                    kwargs=kwargs)
-        currentWork.append(p)
-
-        # Run porcesses, will wait for all to complete
-        if len(currentWork) >= n_worker:
-            results = tools.runProcesses(currentWork, verbose, queue)
-            currentWork = []
-            
-            for result in results:
-                tools.saveDB(agents=result[0], demands=result[1], slacks=result[2], dbName=dbName)
-
-    # Run remaining processes
-    if currentWork:
-        results = tools.runProcesses(currentWork, verbose, queue)
-
-        for result in results:
-            tools.saveDB(agents=result[0], demands=result[1], slacks=result[2], dbName=dbName)
-
-
-def runCounty(*, agents, config, queue):
-    demands, slacks = optimize.immediate(agents=agents,
-                                         eta=config["chargingEfficiency"],
-                                         SOCStart=config["SOCStart"],
-                                         deltaT=0.25)
-    queue.put((agents, demands, slacks))
\ No newline at end of file
+# Agents are independent and immediate() is vectorized over the fleet of a region -> no worker processes.
+# The results of a region are written in the background (DBWriter) while the next region is processed.
+# n_worker: Not used, only for the common interface of the strategies (see run.py). Warns if > 1.
+# seed: Random draws per region, same as in the other strategies (see run.py).
+#   Default: Drawn from the global random state.
+def run(*, scenario, config, dbName, regionIDs, aggFactors, n_worker, verbose, seed=None):
+    if n_worker > 1:
+        warnings.warn(f"Uncontrolled runs in one process, n_worker={n_worker} is ignored.")
+    if seed is None:
+        seed = random.getrandbits(32)
+    if verbose:
+        print("Processing...")
+    with tools.DBWriter(dbName, verbose=verbose, outputFormat=config["outputFormat"],
+                        resolution=config["resolution"]) as writer:
+        for i, regionID in enumerate(regionIDs):
+            # Preprocess data
+            agents = preprocessing.getFleet(scenario, config, regionID, aggFac=aggFactors[i], seed=seed,
+                                            resolution=config["resolution"])
+
+            with profiling.timer("immediate"):
+                demands, slacks = optimize.immediate(agents=agents,
+                                                     eta=config["chargingEfficiency"],
+                                                     SOCStart=config["SOCStart"],
+                                                     deltaT=tools.getDeltaT(config["resolution"]), verbose=False)
+            writer.put(agents=agents, demands=demands, slacks=slacks)
+
+            # Progressbar
+            if verbose:
+                tools.tickProg((i+1)/len(regionIDs))
+        if verbose:
+            print("\nCharging calculated!")
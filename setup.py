@@ -9,5 +9,6 @@ setup(name='chargingmodel',
       install_requires=[
           'gurobipy',
           'numpy',
-          'pandas'
+          'pandas',
+          'scipy'
       ])
\ No newline at end of file
@@ -0,0 +1,70 @@
+import json
+import os
+import sqlite3
+from datetime import datetime as dt, timedelta
+
+import numpy as np
+import pytest
+
+import chargingmodel.benchmark as benchmark
+import chargingmodel.optimize as optimize
+import chargingmodel.preprocessing as preprocessing
+
+DAYS = 3
+RESOLUTION = "1H" # Small models: The Gurobi test licence is size-limited
+START = dt(2030, 1, 1)
+END = START + timedelta(days=DAYS)
+
+@pytest.fixture(scope="session")
+def config():
+    with open(os.path.join(os.path.dirname(optimize.__file__), "config.json")) as f:
+        return json.load(f)
+
+# Synthetic inputs (see benchmark.createInputs): 2 regions with 20 vehicles, DAYS days
+@pytest.fixture(scope="session")
+def inputDir(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("input"))
+    benchmark.createInputs(path, nRegions=2, nVehicles=20, days=DAYS)
+    return path
+
+@pytest.fixture(scope="session")
+def fleet(config, inputDir):
+    return preprocessing.Fleet.concat([preprocessing.getFleet("Realistic", config, regionID, startDate=START,
+                                                              endDate=END, resolution=RESOLUTION, seed=1, cache=False,
+                                                              inputDir=inputDir)
+                                       for regionID in ("Region_1", "Region_2")])
+
+@pytest.fixture(scope="session")
+def residualLoad(inputDir):
+    return np.array(preprocessing.getResidual("all", startDate=START, endDate=END, resolution=RESOLUTION,
+                                               cache=False, inputDir=inputDir))
+
+# Gurobi environment, skips the test without gurobipy or licence
+@pytest.fixture(scope="session")
+def env():
+    if optimize.grb is None:
+        pytest.skip("gurobipy is not installed")
+    try:
+        env = optimize.grb.Env(params={"OutputFlag": 0})
+    except optimize.grb.GurobiError as e:
+        pytest.skip(f"No Gurobi licence: {e}")
+    yield env
+    env.dispose()
+
+# Strategies on the synthetic inputs: getFleet and getResidual read them (also in forked worker processes).
+# Returns the config for RESOLUTION.
+@pytest.fixture
+def synthetic(monkeypatch, inputDir, config):
+    getFleet, getResidual = preprocessing.getFleet, preprocessing.getResidual
+    window = {"startDate": START, "endDate": END, "cache": False, "inputDir": inputDir}
+    monkeypatch.setattr(preprocessing, "getFleet", lambda *args, **kwargs: getFleet(*args, **window, **kwargs))
+    monkeypatch.setattr(preprocessing, "getResidual", lambda *args, **kwargs: getResidual(*args, **window, **kwargs))
+    return dict(config, resolution=RESOLUTION)
+
+# Content of the result tables of an output database
+def readResults(dbName):
+    conn = sqlite3.connect(dbName)
+    tables = {table: sorted(conn.execute(f"SELECT * FROM {table}").fetchall())
+              for table in ("Agents", "TimeSeries", "Profiles", "Regions", "Total")}
+    conn.close()
+    return tables
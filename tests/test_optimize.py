@@ -0,0 +1,213 @@
+import numpy as np
+import pytest
+
+import chargingmodel.benchmark as benchmark
+import chargingmodel.optimize as optimize
+import chargingmodel.optDistributed as optDistributed
+import chargingmodel.preprocessing as preprocessing
+import chargingmodel.tools as tools
+
+from conftest import START, END, RESOLUTION
+
+def solve(agents, residualLoad, config, **kwargs):
+    return optimize.optimizeChargingQP_smpl(agents=agents, residualLoad=residualLoad.copy(),
+                                            eta=config["chargingEfficiency"], SOCStart=config["SOCStart"],
+                                            deltaT=tools.getDeltaT(RESOLUTION), verbose=False, **kwargs)
+
+def assertSame(a, b, residualLoad):
+    demandsA, slacksA = a
+    demandsB, slacksB = b
+    assert benchmark.getObjective(residualLoad, demandsA) == pytest.approx(benchmark.getObjective(residualLoad,
+                                                                                                  demandsB), rel=1e-6)
+    for name in demandsA:
+        assert sum(demandsA[name].values()) == pytest.approx(sum(demandsB[name].values()), rel=1e-6, abs=1e-9)
+        assert slacksA[name] == pytest.approx(slacksB[name], abs=1e-9)
+
+# Native water-filling vs Gurobi, full horizon. reuse: Gurobi model template (ModelTemplate)
+@pytest.mark.parametrize("reuse", [False, True])
+def test_nativeEqualsGurobi(fleet, residualLoad, config, env, reuse):
+    agents = fleet[np.arange(10)]
+    assertSame(solve(agents, residualLoad, config, solver="native"),
+               solve(agents, residualLoad, config, solver="gurobi", env=env, reuse=reuse), residualLoad)
+
+# Random agent: Events in random disjoint windows of nTimesteps, some without charging station
+def getRandomAgent(rng, name, nTimesteps):
+    bounds = np.sort(rng.choice(np.arange(1, nTimesteps), size=2 * rng.integers(1, 5), replace=False))
+    events = [preprocessing.Event(start=int(start), stop=int(stop), consumption=float(rng.uniform(0, 20)),
+                                  pMax=float(rng.choice([0.0, 3.7, 11.0, 22.0])), purpose=0)
+              for start, stop in zip(bounds[::2], bounds[1::2])]
+    return preprocessing.Agent(name=name, model="EV_small", events=events, aggFac=1,
+                               capacity=float(rng.uniform(10, 80)), evseGroup=0, regionID="Region_1")
+
+# Native water-filling vs Gurobi on random instances
+@pytest.mark.parametrize("seed", range(5))
+def test_nativeEqualsGurobiRandom(config, env, seed):
+    rng = np.random.default_rng(seed)
+    residualLoad = rng.normal(50, 20, 48)
+    agents = [getRandomAgent(rng, f"Region_1_{i:02}", len(residualLoad)) for i in range(4)]
+    assertSame(solve(agents, residualLoad, config, solver="native"),
+               solve(agents, residualLoad, config, solver="gurobi", env=env), residualLoad)
+
+# Segmented horizon: The battery energy at the end of a segment is the start of the next one
+@pytest.mark.parametrize("reuse", [False, True])
+def test_segmentedGurobi(fleet, residualLoad, config, env, reuse):
+    agents = fleet[np.arange(10)]
+    segments = tools.createSegmentation("D", start=START, end=END, resolution=RESOLUTION)
+    assertSame(solve(agents, residualLoad, config, solver="native", segments=segments),
+               solve(agents, residualLoad, config, solver="gurobi", env=env, segments=segments, reuse=reuse),
+               residualLoad)
+
+# Events are split at the segment ends: One list per segment, all time steps and the consumption kept
+def test_getSegmentEvents():
+    events = [preprocessing.Event(start=2, stop=5, consumption=1.0, pMax=3.7, purpose=0),
+              preprocessing.Event(start=8, stop=24, consumption=2.0, pMax=11.0, purpose=0),
+              preprocessing.Event(start=31, stop=33, consumption=3.0, pMax=22.0, purpose=0)]
+    segEvents = optimize.getSegmentEvents(events, [10, 20, 30])
+    assert [[(event.start, event.stop, event.consumption) for event in events] for events in segEvents] == [
+        [(2, 5, 1.0), (8, 10, 0.0)], [(10, 20, 0.0)], [(20, 24, 2.0), (31, 33, 3.0)]]
+
+# Battery energy of an agent over the whole horizon with the given charging power.
+# Returns the missing energy (-> slack) and the largest excess over the capacity.
+def simulate(agent, demand, config):
+    eBat, missing, excess = config["SOCStart"] * agent.capacity, 0.0, 0.0
+    for event in agent.events:
+        eBat += config["chargingEfficiency"] * tools.getDeltaT(RESOLUTION) * sum(demand.get(t, 0.0)
+                                                                               for t in range(event.start, event.stop))
+        excess = max(excess, eBat - agent.capacity)
+        eBat -= event.consumption
+        if eBat < 0:
+            missing -= eBat
+            eBat = 0.0
+    return missing, excess
+
+# Rolling horizon (order="segment") vs agent by agent: The segments only share the SOC, so the results are the same
+# for any segment boundaries. The SOC carried over between segments is consistent over the whole horizon.
+@pytest.mark.parametrize("segments", [[24, 48, 72], [12, 36, 60, 72], [5, 72]])
+@pytest.mark.parametrize("seed", range(3))
+def test_segmentOrder(config, seed, segments):
+    rng = np.random.default_rng(seed)
+    residualLoad = rng.normal(50, 20, 72)
+    agents = [getRandomAgent(rng, f"Region_1_{i:02}", len(residualLoad)) for i in range(6)]
+    bySegment = solve(agents, residualLoad, config, solver="native", segments=segments, order="segment")
+    byAgent = solve(agents, residualLoad, config, solver="native", segments=segments, order="agent")
+    assertSame(bySegment, byAgent, residualLoad)
+    demands, slacks = bySegment
+    for agent in agents:
+        assert demands[agent.name] == pytest.approx(byAgent[0][agent.name], abs=1e-9)
+        missing, excess = simulate(agent, demands[agent.name], config)
+        assert missing == pytest.approx(slacks[agent.name], abs=1e-9)
+        assert excess <= 1e-9
+
+# Increase of sum((residual load + charging power)^2) by the charging power of one agent
+def getIncrease(residualLoad, pCharge):
+    load = residualLoad.copy()
+    for t, p in pCharge.items():
+        load[t] += p
+    return (load**2).sum() - (residualLoad**2).sum()
+
+# Two stage solve on coarse time steps (coarseResolution): Feasible at the fine resolution. Not better than the single
+# stage solve and not worse than its solution averaged over the coarse time steps of every event (feasible for the
+# coarse stage, the fine stage only improves within events). factor = 1: The single stage solve.
+@pytest.mark.parametrize("solver", ["native", "gurobi"])
+@pytest.mark.parametrize("factor", [1, 2, 4, 8])
+@pytest.mark.parametrize("seed", range(5))
+def test_solveAgentCoarse(config, request, seed, factor, solver):
+    env = request.getfixturevalue("env") if solver == "gurobi" else None
+    rng = np.random.default_rng(seed)
+    residualLoad = rng.normal(50, 20, 96)
+    etaTimesDelta = config["chargingEfficiency"] * tools.getDeltaT(RESOLUTION)
+    for i in range(3):
+        agent = getRandomAgent(rng, f"Region_1_{i:02}", len(residualLoad))
+        eBatStart = config["SOCStart"] * agent.capacity
+        slack, mxEbatEnd = optimize.getSlack(agent=agent, events=agent.events, eBatStart=eBatStart,
+                                             etaTimesDelta=etaTimesDelta)
+        kwargs = {"agent": agent, "events": agent.events, "slack": slack, "mxEbatEnd": mxEbatEnd,
+                  "eBatStart": eBatStart, "etaTimesDelta": etaTimesDelta, "eBatGoal": eBatStart,
+                  "residualLoad": residualLoad}
+        pCoarse, eBatEnd = optimize.solveAgentCoarse(factor=factor, solver=solver, env=env, **kwargs)
+        pExact, _ = optimize.solveAgentNative(**kwargs)
+
+        # Feasible: Power limits and battery energy after every event
+        netCons, lower, upper = optimize.getEnergyBounds(agent=agent, events=agent.events, slack=slack,
+                                                         mxEbatEnd=mxEbatEnd, eBatStart=eBatStart, eBatGoal=eBatStart)
+        energy = np.cumsum([etaTimesDelta * sum(pCoarse[t] for t in range(event.start, event.stop))
+                            for event in agent.events])
+        assert all(-1e-9 <= pCoarse[t] <= event.pMax + 1e-9
+                   for event in agent.events for t in range(event.start, event.stop))
+        assert np.all(energy >= lower - 1e-6) and np.all(energy <= upper + 1e-6)
+        assert eBatEnd == pytest.approx(eBatStart + energy[-1] - netCons[-1], abs=1e-6)
+
+        # Objective
+        pAveraged = {}
+        for event in agent.events:
+            for block in range(event.start // factor, -(-event.stop // factor)):
+                ts = range(max(event.start, block * factor), min(event.stop, (block + 1) * factor))
+                mean = sum(pExact[t] for t in ts) / len(ts)
+                pAveraged.update((t, mean) for t in ts)
+        increase = getIncrease(residualLoad, pCoarse)
+        assert increase >= getIncrease(residualLoad, pExact) - 1e-6
+        assert increase <= getIncrease(residualLoad, pAveraged) + 1e-6
+        if factor == 1:
+            assert increase == pytest.approx(getIncrease(residualLoad, pExact), abs=1e-6)
+
+# The start energy must not be changed by getSlack (0-d arrays from Gurobi are mutable)
+def test_getSlackCopiesStart(fleet, config):
+    agent = fleet.getAgent(0)
+    eBatStart = np.array(agent.capacity / 2)
+    optimize.getSlack(agent=agent, events=agent.events, eBatStart=eBatStart,
+                      etaTimesDelta=config["chargingEfficiency"] * tools.getDeltaT(RESOLUTION))
+    assert eBatStart == agent.capacity / 2
+
+# Full quadratic program with aggregate load variables: Same optimum as the dense reference formulation,
+# at least as good as the greedy agent by agent solution
+def test_exactQP(config, env):
+    rng = np.random.default_rng(7)
+    residualLoad = rng.normal(50, 20, 48)
+    agents = [getRandomAgent(rng, f"Region_1_{i:02}", len(residualLoad)) for i in range(3)]
+    demands, slacks = optimize.optimizeChargingQP(agents=agents, residualLoad=residualLoad,
+                                                  eta=config["chargingEfficiency"], SOCStart=config["SOCStart"],
+                                                  deltaT=tools.getDeltaT(RESOLUTION), env=env)
+    objective = benchmark.getObjective(residualLoad, demands)
+
+    etaTimesDelta = config["chargingEfficiency"] * tools.getDeltaT(RESOLUTION)
+    dense = benchmark.buildChargingQPDense(env=env, agents=agents, residualLoad=residualLoad,
+                                           etaTimesDelta=etaTimesDelta, SOCStart=config["SOCStart"])
+    dense.optimize()
+    assert objective == pytest.approx(dense.ObjVal, rel=1e-6, abs=1e-6)
+    greedy, greedySlacks = solve(agents, residualLoad, config, solver="native")
+    assert objective <= benchmark.getObjective(residualLoad, greedy) + 1e-6
+    assert slacks == pytest.approx(greedySlacks)
+
+# Parallel best responses: The objective decreases monotonically and converges to the gap tolerance.
+# The lower bound holds for every feasible solution, e.g. the greedy one.
+def test_jacobi(fleet, residualLoad, config):
+    agents = fleet[np.arange(12)]
+    gapTol = 1e-3
+    demands, slacks, history = optDistributed.optimizeJacobi(agents=agents, residualLoad=residualLoad,
+                                                             eta=config["chargingEfficiency"],
+                                                             SOCStart=config["SOCStart"],
+                                                             deltaT=tools.getDeltaT(RESOLUTION), n_worker=2,
+                                                             maxIter=100, gapTol=gapTol, verbose=False)
+    objectives = [h["objective"] for h in history]
+    assert all(b <= a + 1e-9 * abs(a) for a, b in zip(objectives, objectives[1:]))
+    assert history[-1]["relGap"] <= gapTol
+    objective = benchmark.getObjective(residualLoad, demands)
+    assert objective == pytest.approx(objectives[-1], rel=1e-9)
+    lowerBound = objective - history[-1]["gap"]
+    greedy, greedySlacks = solve(agents, residualLoad, config, solver="native")
+    assert benchmark.getObjective(residualLoad, greedy) >= lowerBound - 1e-9
+    assert slacks == pytest.approx(greedySlacks)
+
+# Jacobi vs the optimum of the full quadratic program (random instance, small for the Gurobi test licence)
+def test_jacobiOptimum(config, env):
+    rng = np.random.default_rng(11)
+    residualLoad = rng.normal(50, 20, 48)
+    agents = [getRandomAgent(rng, f"Region_1_{i:02}", len(residualLoad)) for i in range(3)]
+    kwargs = {"agents": agents, "residualLoad": residualLoad, "eta": config["chargingEfficiency"],
+              "SOCStart": config["SOCStart"], "deltaT": tools.getDeltaT(RESOLUTION)}
+    demands, _, history = optDistributed.optimizeJacobi(**kwargs, n_worker=2, maxIter=200, gapTol=1e-4,
+                                                        verbose=False)
+    exact, _ = optimize.optimizeChargingQP(**kwargs, env=env)
+    objective = benchmark.getObjective(residualLoad, demands)
+    optimum = benchmark.getObjective(residualLoad, exact)
+    assert objective - history[-1]["gap"] - 1e-6 <= optimum <= objective + 1e-6
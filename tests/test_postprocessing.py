@@ -0,0 +1,47 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import chargingmodel.postprocessing as postprocessing
+import chargingmodel.tools as tools
+import chargingmodel.uncontrolled as uncontrolled
+
+from conftest import RESOLUTION
+
+# Dense output (Profiles) decoded: The same profiles as the sparse output (TimeSeries)
+def test_denseEqualsSparse(synthetic, tmp_path, monkeypatch):
+    dbNames = {}
+    for outputFormat in ("sparse", "dense"):
+        dbNames[outputFormat] = str(tmp_path / f"{outputFormat}.db")
+        tools.innitDB(dbNames[outputFormat], resolution=RESOLUTION)
+        uncontrolled.run(scenario="Realistic", config=dict(synthetic, outputFormat=outputFormat),
+                         dbName=dbNames[outputFormat], regionIDs=np.array(["Region_1", "Region_2"]),
+                         aggFactors=np.ones(2), n_worker=1, verbose=False, seed=5)
+
+    # Sparse output as Time x AgentID
+    conn = sqlite3.connect(dbNames["sparse"])
+    timeSeries = pd.read_sql("SELECT Time, AgentID, PowerMW FROM TimeSeries", conn)
+    conn.close()
+    assert timeSeries.PowerMW.sum() > 0
+    sparse = timeSeries.pivot(index="Time", columns="AgentID", values="PowerMW")
+    sparse = sparse.reindex(index=tools.getTimeCol(resolution=RESOLUTION)).fillna(0.0)
+
+    dense = postprocessing.getProfiles(dbNames["dense"])
+    assert dense.shape[0] == len(sparse)
+    assert dense.reindex(columns=sparse.columns).values == pytest.approx(sparse.values, abs=1e-9)
+    assert dense.drop(columns=sparse.columns).values.sum() == 0 # Agents without charging
+
+    # Selected agents in the given order, more than the bound variables of one SQLite statement
+    connect = sqlite3.connect
+    def connectLimited(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 10)
+        return conn
+    monkeypatch.setattr(sqlite3, "connect", connectLimited)
+    agentIDs = list(dense.columns[::-1])
+    assert len(agentIDs) > 10
+    names, profiles = postprocessing.getProfileArray(dbNames["dense"], agentIDs)
+    assert names == agentIDs
+    assert profiles == pytest.approx(dense[agentIDs].values.T, abs=1e-9)
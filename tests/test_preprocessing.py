@@ -0,0 +1,57 @@
+import random
+
+import numpy as np
+
+import chargingmodel.preprocessing as preprocessing
+
+from conftest import START, END, RESOLUTION
+
+def getFleet(config, inputDir, regionID, **kwargs):
+    return preprocessing.getFleet("Realistic", config, regionID, startDate=START, endDate=END, resolution=RESOLUTION,
+                                  cache=False, inputDir=inputDir, **kwargs)
+
+# Fleet: Agent tuples in, the same Agent tuples out (iteration, indexing, subsets, concat)
+def test_fleetRoundTrip(fleet):
+    agents = list(fleet)
+    assert len(agents) == len(fleet) == 40
+    assert list(preprocessing.Fleet.fromAgents(agents)) == agents
+    assert fleet[-1] == agents[-1]
+    assert list(fleet[5:9]) == agents[5:9]
+    assert list(fleet[np.array([7, 2, 30])]) == [agents[7], agents[2], agents[30]]
+    mask = fleet.regionID == "Region_2"
+    assert list(fleet[mask]) == list(fleet.byRegion("Region_2")) == [a for a in agents if a.regionID == "Region_2"]
+    assert list(preprocessing.Fleet.concat([fleet[:10], fleet[10:]])) == agents
+    assert [list(batch) for batch in fleet.batches(15)] == [agents[:15], agents[15:30], agents[30:]]
+    assert len(preprocessing.Fleet.concat([])) == 0
+
+def test_fleetSaveLoad(fleet, tmp_path):
+    fleet.save(str(tmp_path / "fleet"))
+    loaded = preprocessing.Fleet.load(str(tmp_path / "fleet"))
+    assert list(loaded) == list(fleet)
+    assert list(loaded[np.array([3, 1])]) == list(fleet[np.array([3, 1])])
+
+# Seeded per region: Same draws regardless of the global random state and the regions processed before
+def test_seedPerRegion(config, inputDir):
+    random.seed(1)
+    a = getFleet(config, inputDir, "Region_2", seed=123)
+    random.seed(2)
+    getFleet(config, inputDir, "Region_1", seed=123)
+    b = getFleet(config, inputDir, "Region_2", seed=123)
+    assert np.array_equal(a.pMax, b.pMax)
+    assert np.array_equal(a.evseGroup, b.evseGroup)
+
+# Entries of other parameters are kept, up to maxCached per input file
+def test_cacheKeepsEntries(tmp_path, monkeypatch):
+    path = tmp_path / "input.csv"
+    path.write_text("1;2;3\n")
+    calls = []
+    def parse(p):
+        calls.append(p)
+        return np.arange(3.0)
+    monkeypatch.setattr(preprocessing, "maxCached", 3)
+    for params in ("15T", "1H", "15T", "1H"):
+        assert np.array_equal(preprocessing.loadCached(str(path), params, parse), np.arange(3.0))
+    assert len(calls) == 2
+    for params in ("2H", "3H", "4H"):
+        preprocessing.loadCached(str(path), params, parse)
+    assert len(list((tmp_path / ".cache").glob("input.*.npy"))) == 3
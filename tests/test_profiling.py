@@ -0,0 +1,34 @@
+import sqlite3
+import sys
+
+import pytest
+
+import chargingmodel.profiling as profiling
+import chargingmodel.run # noqa: F401
+import chargingmodel.uncontrolled as uncontrolled
+
+runModule = sys.modules["chargingmodel.run"] # chargingmodel.run is also the function run()
+
+# A failing strategy must not leave profiling switched on
+def test_profilingOffAfterError(tmp_path, monkeypatch):
+    def fail(**kwargs):
+        profiling.add("fleet", 1.0)
+        raise RuntimeError("strategy failed")
+    monkeypatch.setattr(uncontrolled, "run", fail)
+    with pytest.raises(RuntimeError):
+        runModule.run(dbName=str(tmp_path / "out.db"), strategy="Uncontrolled", verbose=False, profile=True)
+    assert not profiling.enabled
+    assert profiling.collect() == ({}, [])
+
+# Rows of several runs in one database are told apart by their RunID
+def test_profilingRunID(tmp_path):
+    dbName = str(tmp_path / "out.db")
+    try:
+        for runID in ("a", "b"):
+            profiling.enable()
+            profiling.add("solve", 2.0)
+            profiling.write(dbName, runID=runID)
+    finally:
+        profiling.enable(False)
+    rows = sqlite3.connect(dbName).execute("SELECT RunID, Stage, Secs FROM Profiling ORDER BY RunID").fetchall()
+    assert rows == [("a", "solve", 2.0), ("b", "solve", 2.0)]
@@ -0,0 +1,55 @@
+import numpy as np
+
+import chargingmodel.optimize as optimize
+import chargingmodel.reduction as reduction
+import chargingmodel.tools as tools
+
+from conftest import RESOLUTION
+
+def getReduction(config, residualLoad, factor=4):
+    return reduction.Reduction(factor=factor, nTimesteps=len(residualLoad), blockSteps=24,
+                               deltaT=tools.getDeltaT(RESOLUTION), eta=config["chargingEfficiency"],
+                               SOCStart=config["SOCStart"])
+
+def sumByStep(demands):
+    load = {}
+    for demand in demands.values():
+        for t, p in demand.items():
+            load[t] = load.get(t, 0.0) + p
+    return load
+
+# The load of the representatives is split between the members without losing or adding energy
+def test_disaggregateConservesEnergy(fleet, residualLoad, config):
+    reducer = getReduction(config, residualLoad)
+    representatives = reducer.reduce(fleet)
+    assert len(representatives) < len(fleet)
+    demands, slacks = optimize.optimizeChargingQP_smpl(agents=representatives, residualLoad=residualLoad.copy(),
+                                                      eta=config["chargingEfficiency"], SOCStart=config["SOCStart"],
+                                                      deltaT=tools.getDeltaT(RESOLUTION), verbose=False,
+                                                      solver="native")
+    members, memberDemands, memberSlacks, rows = reducer.disaggregate(representatives, demands, slacks)
+
+    assert sorted(members.name.tolist()) == sorted(fleet.name.tolist())
+    expected, actual = sumByStep(demands), sumByStep(memberDemands)
+    for t, p in expected.items():
+        assert np.isclose(actual.get(t, 0.0), p, rtol=1e-9, atol=1e-12)
+    assert np.isclose(sum(memberSlacks.values()), sum(slacks.values()))
+    assert np.isclose(sum(row[3] for row in rows), sum(expected.values()) * tools.getDeltaT(RESOLUTION))
+
+    # No member above its charging power: The representatives only charge with the power of the parked members
+    assert max(row[4] for row in rows) < 1e-9
+    for name in representatives.name.tolist():
+        members, _ = reducer.getMembers(name)
+        i = representatives.name.tolist().index(name)
+        ts = np.arange(len(residualLoad))
+        pMax = reduction.getPowerLimit(representatives, i, ts)
+        limits = sum(reduction.getPowerLimit(members, j, ts) for j in range(len(members)))
+        assert np.all(pMax <= limits + 1e-12)
+
+# Members get at most their charging power while the other members can take the rest.
+# No member can charge -> split by share.
+def test_splitCapsMembers():
+    shares = np.array([0.8, 0.2])
+    limits = np.array([[1.0, 1.0, 0.0], [4.0, 4.0, 0.0]])
+    power = reduction.split(np.array([1.0, 3.0, 2.0]), shares, limits)
+    assert np.allclose(power, [[0.5, 1.0, 1.6], [0.5, 2.0, 0.4]])
@@ -0,0 +1,101 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+import chargingmodel.optNational as optNational
+import chargingmodel.preprocessing as preprocessing
+import chargingmodel.tools as tools
+import chargingmodel.uncontrolled as uncontrolled
+
+from conftest import RESOLUTION, readResults
+
+REGIONS = np.array(["Region_1", "Region_2"])
+
+def runUncontrolled(config, dbName, regionIDs):
+    uncontrolled.run(scenario="Realistic", config=config, dbName=dbName, regionIDs=regionIDs,
+                     aggFactors=np.ones(len(regionIDs)), n_worker=1, verbose=False, seed=5)
+
+# Incremental run: Deleting a region and computing it again gives the same database as a full run
+def test_incremental(synthetic, tmp_path):
+    full, incremental = str(tmp_path / "full.db"), str(tmp_path / "incremental.db")
+    for dbName in (full, incremental):
+        tools.innitDB(dbName, resolution=RESOLUTION)
+        runUncontrolled(synthetic, dbName, REGIONS)
+    assert tools.getResolution(incremental) == RESOLUTION
+    assert tools.getResolution(str(tmp_path / "missing.db")) is None
+    tools.setRegionHashes(incremental, {"Region_1": "a", "Region_2": "b"})
+    tools.deleteRegions(incremental, ["Region_2"])
+    assert tools.getRegionHashes(incremental) == {"Region_1": "a"}
+    runUncontrolled(synthetic, incremental, REGIONS[1:])
+    results = readResults(full)
+    assert results["TimeSeries"] and results["Regions"]
+    assert readResults(incremental) == results
+
+# Uncontrolled runs in one process: n_worker is ignored (with a warning), same results
+def test_uncontrolledWorkers(synthetic, tmp_path):
+    dbNames = [str(tmp_path / f"{n_worker}.db") for n_worker in (1, 2)]
+    for n_worker, dbName in zip((1, 2), dbNames):
+        tools.innitDB(dbName, resolution=RESOLUTION)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            uncontrolled.run(scenario="Realistic", config=synthetic, dbName=dbName, regionIDs=REGIONS,
+                             aggFactors=np.ones(len(REGIONS)), n_worker=n_worker, verbose=False, seed=5)
+        assert any("n_worker=2 is ignored" in str(w.message) for w in caught) == (n_worker > 1)
+    assert readResults(dbNames[0]) == readResults(dbNames[1])
+
+# Region hashes change with everything the region depends on, and only with that
+def test_regionHash(config):
+    def getHash(config=config, regionID="Region_1", aggFac=1.0, seed=123, scenario="Realistic"):
+        return preprocessing.getRegionHash(scenario, "Opt_County", config, regionID, aggFac, seed)
+    base = getHash()
+    assert getHash() == base
+    assert getHash(regionID="Region_2") != base
+    assert getHash(aggFac=2.0) != base
+    assert getHash(seed=124) != base
+    assert getHash(config=dict(config, sensiAdjP=1.2)) != base
+    assert getHash(scenario="Home") != base
+    # Other scenarios and the total fleet size (-> aggFac) do not matter
+    scenarios = dict(config["scenarios"], Home={**config["scenarios"]["Home"], "extra": 1})
+    assert getHash(config=dict(config, scenarios=scenarios)) == base
+    assert getHash(config=dict(config, fleetsize=1)) == base
+    # Settings of Opt_National do not matter
+    for key, value in (("maxIter", 1), ("gapTol", 0.5), ("checkpointInterval", 1)):
+        assert getHash(config=dict(config, **{key: value})) == base
+    # Settings of the optimization only matter for Opt_County
+    horizon = dict(config, horizon="1D")
+    assert getHash(config=horizon) != base
+    assert (preprocessing.getRegionHash("Realistic", "Uncontrolled", horizon, "Region_1", 1.0, 123)
+            == preprocessing.getRegionHash("Realistic", "Uncontrolled", config, "Region_1", 1.0, 123))
+
+def runNational(config, dbName, resume=False):
+    optNational.run(scenario="Realistic", config=config, dbName=dbName, regionIDs=REGIONS,
+                    aggFactors=np.ones(len(REGIONS)), n_worker=1, verbose=False, batchsize=5, resume=resume, seed=5)
+
+# Resume after an interruption: Same results as an uninterrupted run (n_worker = 1)
+@pytest.mark.parametrize("reductionFactor", [1, 2])
+def test_resume(synthetic, tmp_path, monkeypatch, reductionFactor):
+    config = dict(synthetic, solver="native", checkpointInterval=0, reductionFactor=reductionFactor)
+    full, resumed = str(tmp_path / "full.db"), str(tmp_path / "resumed.db")
+    for dbName in (full, resumed):
+        tools.innitDB(dbName, resolution=RESOLUTION)
+    runNational(config, full)
+
+    # Interrupted after 3 batches
+    put = tools.DBWriter.put
+    calls = []
+    def interrupt(self, **kwargs):
+        calls.append(1)
+        if len(calls) > 3:
+            raise KeyboardInterrupt
+        put(self, **kwargs)
+    monkeypatch.setattr(tools.DBWriter, "put", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        runNational(config, resumed)
+    monkeypatch.setattr(tools.DBWriter, "put", put)
+    assert len(tools.getCheckpoint(resumed)["batches"]) == 3
+
+    runNational(config, resumed, resume=True)
+    assert readResults(resumed) == readResults(full)
+    assert not os.path.exists(resumed + ".fleets") # Fleet store removed
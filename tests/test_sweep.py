@@ -0,0 +1,16 @@
+import os
+
+import pytest
+
+import chargingmodel.sweep as sweep
+
+# A failing variant is reported, the other variants still run
+def test_sweepFailedVariant(tmp_path, monkeypatch):
+    def run(*, dbName, scenario, **kwargs):
+        if scenario == "Unknown":
+            raise KeyError(scenario)
+        open(dbName, "w").close()
+    monkeypatch.setattr(sweep, "run", run)
+    with pytest.raises(RuntimeError, match="1 of 3 variants failed: Unknown_Uncontrolled.db"):
+        sweep.sweep(scenarios=["Realistic", "Unknown", "Home"], outputDir=str(tmp_path), n_worker=2, verbose=False)
+    assert sorted(os.listdir(tmp_path)) == ["Home_Uncontrolled.db", "Realistic_Uncontrolled.db"]